@@ -5,23 +5,52 @@ from mininet.node import Host, Switch
 from mininet.log import setLogLevel, info, warn, debug
 from mininet.cli import CLI
 import os
+import glob
 import time
+import shutil
+import subprocess
+import errno
+import heapq
+import random
+import selectors
 import multiprocessing
 import threading
 import socket
-import sys
 import json
+import argparse
+import ipaddress
+from contextlib import closing
+
+import topo_builder
+import connectivity_check
+import throughput_matrix
+import path_verify
+from netns_host import NetnsHost, memoryPerHost
 
 # Constants
 DEFAULT_PIPECONF = "org.onosproject.pipelines.basic"
 BMV2_DEFAULT_DEVICE_ID = 1
 SWITCH_START_TIMEOUT = 10  # seconds
+PROBE_BACKOFF_MIN = 0.001  # seconds between refused gRPC probes, doubling
+PROBE_BACKOFF_MAX = 0.02  # ... up to this
+STARTUP_LATENCY_FILE = "/tmp/bmv2-startup-latency.json"
+SUPERVISOR_TICK = 1  # seconds between keepalive file checks
+SUPERVISOR_PROBE_INTERVAL = 10  # seconds between gRPC probes of one switch
+SUPERVISOR_PROBE_FAILURES = 3  # failed probes in a row before a switch is hung
+STARTUP_LATENCY_BOUNDS = [25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]  # ms
 BMV2_LOG_LINES = 100
 SIMPLE_SWITCH_GRPC = "simple_switch_grpc"
 VALGRIND_PREFIX = "valgrind --leak-check=yes --log-file=/tmp/bmv2-valgrind-%s.log"
 STRATUM_BMV2 = "stratum_bmv2"
 STRATUM_BINARY = "/usr/local/bin/stratum_bmv2"
 STRATUM_INIT_PIPELINE = "/stratum/bmv2/data/bmv2.json"
+OFFLOAD_FEATURES = ["rx", "tx", "sg"]
+IPV6_DISABLE_CONFS = ["all", "default", "lo"]
+SHUTDOWN_GRACE = 2  # seconds bmv2 gets to exit on SIGTERM before SIGKILL
+CGROUP_ROOT = "/sys/fs/cgroup"  # cgroup v2 (unified) mount
+CGROUP_PARENT = "mininet-bmv2"  # one child group per switch below this
+CGROUP_PERIOD = 100000  # us, period of cpu.max
+PLACEMENT_STRATEGIES = ["spread", "pack"]
 
 def parseBoolean(value):
     return str(value).lower() in ['true', '1', 'yes']
@@ -37,66 +66,541 @@ def pickUnusedPort():
     s.close()
     return port
 
-def watchDog(switch):
-    while not switch.stopped and not ONOSBmv2Switch.mininet_exception.value:
-        if not os.path.isfile(switch.keepaliveFile):
-            warn("\n*** Mininet stopped unexpectedly! Killing %s...\n" % switch.name)
-            switch.killBmv2()
-            break
-        time.sleep(1)
+def reportDeath(switch, reason, restarts):
+    """Default restart policy: report the switch and leave it down"""
+    warn("\n*** WARN: switch %s died (%s)\n" % (switch.name, reason))
+    switch.printBmv2Log()
+    return False
+
+def restartPolicy(maxRestarts=3):
+    """Restart policy bringing a dead switch back up to maxRestarts times"""
+    def policy(switch, reason, restarts):
+        reportDeath(switch, reason, restarts)
+        if restarts >= maxRestarts:
+            return False
+        info("*** Restarting %s (%d/%d)\n" % (switch.name, restarts + 1, maxRestarts))
+        switch.restartBmv2()
+        return True
+    return policy
+
+class Liveness(object):
+    __slots__ = ('pid', 'pidfd', 'state', 'since', 'nextProbe', 'failures', 'probeMs')
+
+    def __init__(self, pid, pidfd):
+        self.pid = pid
+        self.pidfd = pidfd
+        self.state = 'up'
+        self.since = time.time()
+        self.nextProbe = self.since + random.uniform(0, SUPERVISOR_PROBE_INTERVAL)
+        self.failures = 0
+        self.probeMs = None
+
+class Supervisor(object):
+    """Watches every running switch from a single thread.
+
+    Process exits arrive on pidfds, keepalive files are checked every
+    SUPERVISOR_TICK and each switch gets one gRPC probe per
+    SUPERVISOR_PROBE_INTERVAL, staggered across switches. policy(switch,
+    reason, restarts) decides what happens to a switch that died or hung
+    and returns True if it restarted it."""
+    instance = None
+
+    @classmethod
+    def get(cls):
+        if cls.instance is None:
+            cls.instance = cls()
+        return cls.instance
+
+    def __init__(self, policy=reportDeath):
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.sel = selectors.DefaultSelector()
+        self.wakeRead, self.wakeWrite = os.pipe()
+        self.sel.register(self.wakeRead, selectors.EVENT_READ, None)
+        self.incoming = []
+        self.watched = {}  # switch -> Liveness, dead and stopped ones included
+        self.restarts = {}  # switch name -> restarts so far
+        self.thread = None
+
+    def watch(self, switch):
+        """Start supervising a switch whose gRPC port is open"""
+        with self.lock:
+            self.incoming.append(switch)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='bmv2-supervisor')
+                self.thread.start()
+        os.write(self.wakeWrite, b'x')
+
+    def adopt(self, switch):
+        old = self.watched.get(switch)
+        if old is not None:
+            self.release(old, old.state)
+        if switch.stopped or switch.bmv2popen is None:
+            return
+        pid = switch.bmv2popen.pid
+        live = Liveness(pid, openPidfd(pid))
+        if live.pidfd is not None:
+            self.sel.register(live.pidfd, selectors.EVENT_READ, switch)
+        self.watched[switch] = live
+
+    def release(self, live, state):
+        live.state = state
+        live.since = time.time()
+        if live.pidfd is not None:
+            self.sel.unregister(live.pidfd)
+            os.close(live.pidfd)
+            live.pidfd = None
+
+    def running(self):
+        return [(sw, l) for sw, l in self.watched.items() if l.state == 'up']
+
+    def run(self):
+        nextTick = 0
+        while True:
+            with self.lock:
+                for switch in self.incoming:
+                    self.adopt(switch)
+                self.incoming = []
+                if not self.running():
+                    self.thread = None
+                    return
+            now = time.time()
+            if now >= nextTick:
+                nextTick = now + SUPERVISOR_TICK
+                self.checkAll()
+            for switch, live in self.running():
+                if now >= live.nextProbe:
+                    self.probe(switch, live)
+            wakeup = min([nextTick] + [l.nextProbe for _, l in self.running()])
+            for key, _ in self.sel.select(max(0, wakeup - time.time())):
+                if key.data is None:
+                    os.read(self.wakeRead, 4096)
+                elif self.watched[key.data].state == 'up':
+                    self.exited(key.data)
+
+    def checkAll(self):
+        failed = ONOSBmv2Switch.mininet_exception.value
+        for switch, live in self.running():
+            if switch.stopped:
+                self.release(live, 'stopped')
+            elif failed or not os.path.isfile(switch.keepaliveFile):
+                warn("\n*** Mininet stopped unexpectedly! Killing %s...\n" % switch.name)
+                switch.killBmv2()
+                self.release(live, 'stopped')
+            elif live.pidfd is None and switch.bmv2popen.poll() is not None:
+                self.exited(switch)
+
+    def exited(self, switch):
+        live = self.watched[switch]
+        popen = switch.bmv2popen
+        if switch.stopped or popen is None:
+            self.release(live, 'stopped')
+            return
+        self.release(live, 'dead')
+        self.died(switch, "exited with status %s" % popen.poll())
+
+    def probe(self, switch, live):
+        start = time.time()
+        ok = switch.grpcReady()
+        live.probeMs = (time.time() - start) * 1000
+        live.nextProbe += SUPERVISOR_PROBE_INTERVAL
+        live.failures = 0 if ok else live.failures + 1
+        if live.failures >= SUPERVISOR_PROBE_FAILURES:
+            self.release(live, 'hung')
+            self.died(switch, "no answer on gRPC port %d" % switch.grpcPort)
+
+    def died(self, switch, reason):
+        restarts = self.restarts.get(switch.name, 0)
+        try:
+            if self.policy(switch, reason, restarts):
+                self.restarts[switch.name] = restarts + 1
+        except Exception as e:
+            warn("*** ERROR: restart policy for %s: %s\n" % (switch.name, e))
+
+    def table(self):
+        """One (name, pid, state, seconds in state, probe ms, failed probes,
+        restarts) row per switch"""
+        now = time.time()
+        with self.lock:
+            rows = [(sw.name, l.pid, l.state, now - l.since, l.probeMs, l.failures,
+                     self.restarts.get(sw.name, 0)) for sw, l in self.watched.items()]
+        return sorted(rows)
+
+def printLivenessTable():
+    info("%-8s %8s %-8s %10s %9s %6s %8s\n" % (
+        "switch", "pid", "state", "for (s)", "probe ms", "fails", "restarts"))
+    for name, pid, state, age, probeMs, failures, restarts in Supervisor.get().table():
+        info("%-8s %8d %-8s %10.0f %9s %6d %8d\n" % (
+            name, pid, state, age, "-" if probeMs is None else "%.1f" % probeMs,
+            failures, restarts))
+
+def parseCpuList(cpus):
+    """'0-3,6' or [0, 1] as a sorted list of core numbers"""
+    if isinstance(cpus, (list, tuple, set)):
+        return sorted(int(c) for c in cpus)
+    cores = set()
+    for part in str(cpus).split(','):
+        first, _, last = part.strip().partition('-')
+        cores.update(range(int(first), int(last or first) + 1))
+    return sorted(cores)
+
+def planCores(count, strategy="spread", coresPerSwitch=1, switchesPerCore=1, reserve=0):
+    """Core list for each of count switches out of the cores we may run on,
+    leaving the first reserve cores to the controller and traffic generators.
+
+    spread hands out core sets round robin, switches only share a set once
+    every set is used; pack puts switchesPerCore switches on a set before
+    moving to the next one, so a benchmark uses as few cores as possible."""
+    if strategy not in PLACEMENT_STRATEGIES:
+        raise ValueError("unknown placement strategy %s" % strategy)
+    cores = sorted(os.sched_getaffinity(0))[reserve:]
+    if not cores:
+        raise Exception("No cores left after reserving %d" % reserve)
+    coresPerSwitch = min(coresPerSwitch, len(cores))
+    sets = [cores[i:i + coresPerSwitch]
+            for i in range(0, len(cores) - coresPerSwitch + 1, coresPerSwitch)]
+    if strategy == "spread":
+        return [sets[i % len(sets)] for i in range(count)]
+    return [sets[(i // switchesPerCore) % len(sets)] for i in range(count)]
+
+def cgroupLimit(name, pid, cpulimit=None, memlimit=None):
+    """Move pid into its own cgroup v2 group with cpu.max (cpulimit cores)
+    and memory.max; returns the group, None if cgroup v2 is not usable"""
+    controllers = [c for c, limit in (("cpu", cpulimit), ("memory", memlimit)) if limit]
+    parent = os.path.join(CGROUP_ROOT, CGROUP_PARENT)
+    group = os.path.join(parent, name)
+    try:
+        if not os.path.isfile(os.path.join(CGROUP_ROOT, "cgroup.controllers")):
+            raise OSError(errno.ENOENT, "cgroup v2 is not mounted on %s" % CGROUP_ROOT)
+        enable = " ".join("+" + c for c in controllers)
+        writeToFile(os.path.join(CGROUP_ROOT, "cgroup.subtree_control"), enable)
+        if not os.path.isdir(parent):
+            os.mkdir(parent)
+        writeToFile(os.path.join(parent, "cgroup.subtree_control"), enable)
+        if not os.path.isdir(group):
+            os.mkdir(group)
+        if cpulimit:
+            writeToFile(os.path.join(group, "cpu.max"), "%d %d" % (
+                int(float(cpulimit) * CGROUP_PERIOD), CGROUP_PERIOD))
+        if memlimit:
+            writeToFile(os.path.join(group, "memory.max"), memlimit)
+        writeToFile(os.path.join(group, "cgroup.procs"), pid)
+        return group
+    except (IOError, OSError) as e:
+        warn("*** %s runs without cgroup limits: %s\n" % (name, e))
+        return None
+
+def printPlacement(switches):
+    """Cores each switch process really runs on and its cgroup limits"""
+    info("%-8s %8s %-12s %-12s %8s %10s\n" % (
+        "switch", "pid", "cpus", "affinity", "cpu max", "mem max"))
+    used = set()
+    for switch in switches:
+        pid = switch.bmv2popen.pid if switch.bmv2popen else None
+        try:
+            affinity = sorted(os.sched_getaffinity(pid)) if pid else []
+        except OSError:
+            affinity = []
+        used.update(affinity)
+        info("%-8s %8s %-12s %-12s %8s %10s\n" % (
+            switch.name, pid or "-",
+            ",".join(map(str, switch.cpus)) if switch.cpus else "any",
+            ",".join(map(str, affinity)) or "-",
+            switch.cpulimit or "-", switch.memlimit or "-"))
+    info("*** %d switches on %d of %d cores\n" % (
+        len(switches), len(used), os.cpu_count()))
 
-class MeshTopo(Topo):
+def reapProcesses(popens, grace=SHUTDOWN_GRACE):
+    """Wait for all already signalled popens together and SIGKILL the ones
+    still running after grace seconds; returns how many were killed"""
+    deadline = time.time() + grace
+    delay = PROBE_BACKOFF_MIN
+    pending = [p for p in popens if p.poll() is None]
+    while pending and time.time() < deadline:
+        time.sleep(min(delay, max(0, deadline - time.time())))
+        delay = min(delay * 2, PROBE_BACKOFF_MAX)
+        pending = [p for p in pending if p.poll() is None]
+    for popen in pending:
+        popen.kill()
+    for popen in pending:
+        popen.wait()
+    return len(pending)
+
+def deleteIntfs(names):
+    """Delete root namespace interfaces with a single ip -batch"""
+    if not names:
+        return
+    result = subprocess.run(['ip', '-force', '-batch', '-'], input="".join(
+        "link del %s\n" % name for name in names), universal_newlines=True,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if result.returncode:
+        warn("*** Deleting interfaces: %s\n" % result.stdout.strip())
+
+def deleteLinks(links):
+    """Delete the veth pairs of all links with one ip -batch in the root
+    namespace, deleting one end removes its peer too"""
+    names = []
+    for link in links:
+        intfs = (link.intf1, link.intf2)
+        rootIntf = [i for i in intfs if not i.node.inNamespace]
+        if not rootIntf:
+            link.stop()
+            continue
+        names.append(rootIntf[0].name)
+        for intf in intfs:
+            intf.node.delIntf(intf)
+            intf.link = None
+        link.intf1 = link.intf2 = None
+    deleteIntfs(names)
+    return len(names)
+
+def openPidfd(pid):
+    """File descriptor that becomes readable when pid exits, None if the
+    kernel or Python has no pidfd_open"""
+    try:
+        return os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        return None
+
+class StartupWaiter(object):
+    """Waits for the gRPC port of many switches on one selector.
+
+    Every switch gets a non-blocking connect to its port, refused probes are
+    retried with exponential backoff, and a pidfd reports the process dying
+    so a crashed switch fails at once instead of at the timeout."""
+
+    def __init__(self, switches, timeout=SWITCH_START_TIMEOUT):
+        self.sel = selectors.DefaultSelector()
+        self.timeout = timeout
+        self.waiting = set()
+        self.backoff = {}
+        self.retries = []  # heap of (when, seq, switch)
+        self.seq = 0
+        self.pidfds = {}
+        self.failed = []  # (switch, reason)
+        for switch in switches:
+            self.waiting.add(switch)
+            self.backoff[switch] = PROBE_BACKOFF_MIN
+            pidfd = openPidfd(switch.bmv2popen.pid)
+            if pidfd is not None:
+                self.pidfds[switch] = pidfd
+                self.sel.register(pidfd, selectors.EVENT_READ, (switch, None))
+            self.probe(switch)
+
+    def probe(self, switch):
+        port = switch.grpcPortInternal if switch.grpcPortInternal else switch.grpcPort
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        err = sock.connect_ex(('localhost', port))
+        if err == errno.EINPROGRESS:
+            self.sel.register(sock, selectors.EVENT_WRITE, (switch, sock))
+            return
+        sock.close()
+        self.probed(switch, err)
+
+    def probed(self, switch, err):
+        if err == 0:
+            self.finish(switch)
+            switch.bmv2Started()
+            return
+        delay = self.backoff[switch]
+        self.backoff[switch] = min(delay * 2, PROBE_BACKOFF_MAX)
+        self.seq += 1
+        heapq.heappush(self.retries, (time.time() + delay, self.seq, switch))
+
+    def finish(self, switch, reason=None):
+        self.waiting.discard(switch)
+        pidfd = self.pidfds.pop(switch, None)
+        if pidfd is not None:
+            self.sel.unregister(pidfd)
+            os.close(pidfd)
+        if reason is not None:
+            switch.starting = False
+            self.failed.append((switch, reason))
+
+    def checkExited(self, switch):
+        code = switch.bmv2popen.poll()
+        if code is not None:
+            self.finish(switch, "exited with status %d" % code)
+
+    def run(self):
+        while self.waiting:
+            now = time.time()
+            while self.retries and self.retries[0][0] <= now:
+                _, _, switch = heapq.heappop(self.retries)
+                if switch in self.waiting:
+                    self.probe(switch)
+            for switch in list(self.waiting):
+                if switch not in self.pidfds:
+                    self.checkExited(switch)
+                if switch in self.waiting and now - switch.startTime > self.timeout:
+                    self.finish(switch, "timeout after %ds" % self.timeout)
+            if not self.waiting:
+                break
+            wakeup = min(s.startTime for s in self.waiting) + self.timeout
+            if self.retries:
+                wakeup = min(wakeup, self.retries[0][0])
+            if len(self.pidfds) < len(self.waiting):
+                wakeup = min(wakeup, now + PROBE_BACKOFF_MAX)
+            for key, _ in self.sel.select(max(0, wakeup - time.time())):
+                switch, sock = key.data
+                if sock is None:
+                    self.checkExited(switch)
+                    continue
+                self.sel.unregister(sock)
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                sock.close()
+                if switch in self.waiting:
+                    self.probed(switch, err)
+        for key in list(self.sel.get_map().values()):
+            if key.data[1] is not None:
+                key.data[1].close()
+        self.sel.close()
+        return self.failed
+
+def recordStartupLatency(times, failures=0):
+    """Add startup times (seconds) to the histogram kept across runs"""
+    hist = startupLatencyHistogram()
+    for t in times:
+        ms = t * 1000
+        i = 0
+        while i < len(STARTUP_LATENCY_BOUNDS) and ms > STARTUP_LATENCY_BOUNDS[i]:
+            i += 1
+        hist["counts"][i] += 1
+    hist["samples"] += len(times)
+    hist["failures"] += failures
+    tmp = STARTUP_LATENCY_FILE + ".tmp"
+    with open(tmp, 'w') as f:
+        json.dump(hist, f)
+    os.replace(tmp, STARTUP_LATENCY_FILE)
+    return hist
+
+def startupLatencyHistogram():
+    """Switch startup latency histogram of all runs so far; counts[i] holds
+    starts up to bounds_ms[i], the last count is everything slower"""
+    try:
+        with open(STARTUP_LATENCY_FILE) as f:
+            hist = json.load(f)
+        if hist.get("bounds_ms") == STARTUP_LATENCY_BOUNDS:
+            return hist
+    except (OSError, ValueError):
+        pass
+    return {"bounds_ms": STARTUP_LATENCY_BOUNDS,
+            "counts": [0] * (len(STARTUP_LATENCY_BOUNDS) + 1),
+            "samples": 0, "failures": 0}
+
+def printStartupHistogram(hist):
+    info("Switch startup latency (%d starts, %d failed):\n"
+         % (hist["samples"], hist["failures"]))
+    labels = ["<= %d ms" % b for b in hist["bounds_ms"]] + ["> %d ms" % hist["bounds_ms"][-1]]
+    for label, count in zip(labels, hist["counts"]):
+        if count:
+            info("  %-12s %d\n" % (label, count))
+
+class JsonTopo(Topo):
+    """Switches, hosts and links of a topo.json dict, with the switch ports
+    and gRPC ports the controller expects (see topo_builder.py)"""
+    def __init__(self, topology, cores=None, switchOpts=None, **opts):
+        Topo.__init__(self, **opts)
+        hosts = topology["hosts"]
+        subnet = ipaddress.ip_network('10.0.0.0/24')
+        prefix = 24 if all(ipaddress.ip_address(h["ip"]) in subnet for h in hosts) else 8
+
+        for i, switch in enumerate(topology["switches"]):
+            self.addSwitch(switch["name"], grpcport=switch["port"],
+                           cpus=cores[i] if cores else None, **(switchOpts or {}))
+
+        for i, host in enumerate(hosts, 1):
+            name = host.get("name", 'h%d' % i)
+            self.addHost(name, mac=host["mac"], ip='%s/%d' % (host["ip"], prefix))
+            self.addLink(name, host["connected_to"], port2=host["port"])
+
+        for link in topology["links"]:
+            self.addLink(link["source"], link["target"],
+                         port1=link["source_port"], port2=link["target_port"])
+
+class MeshTopo(JsonTopo):
     """Full mesh topology with N switches and N hosts"""
     def __init__(self, n=5, **opts):
-        Topo.__init__(self, **opts)
-        
-        switches = []
-        hosts = []
-        
-        # Create switches and hosts
-        for i in range(1, n+1):
-            # Add switch
-            switch = self.addSwitch('s%d' % i)
-            switches.append(switch)
-            
-            # Add host with incremental MAC and IP
-            host = self.addHost('h%d' % i,
-                              mac='00:00:00:00:00:%02d' % i,
-                              ip='10.0.0.%d/24' % i)
-            hosts.append(host)
-            self.addLink(host, switch)
-        
-        # Create full mesh between switches
-        for i in range(n):
-            for j in range(i+1, n):
-                self.addLink(switches[i], switches[j])
+        JsonTopo.__init__(self, topo_builder.mesh(n), **opts)
 
 class ONOSHost(Host):
     """Custom host with static ARP entries"""
     def __init__(self, name, **params):
+        self.configPending = False
+        self.configStart = None
+        self.configDone = None
         Host.__init__(self, name, **params)
         self.static_arp = {}
 
     def config(self, **params):
         result = super(ONOSHost, self).config(**params)
-        
-        # Disable offloading
-        for off in ["rx", "tx", "sg"]:
-            cmd = "/sbin/ethtool --offload %s %s off" % (self.defaultIntf(), off)
-            self.cmd(cmd)
-        
-        # Disable IPv6
-        self.cmd("sysctl -w net.ipv6.conf.all.disable_ipv6=1")
-        self.cmd("sysctl -w net.ipv6.conf.default.disable_ipv6=1")
-        self.cmd("sysctl -w net.ipv6.conf.lo.disable_ipv6=1")
-        
+        # Disable offloading and IPv6 in one go, without waiting: all hosts
+        # are configured at once and the next command waits for the output
+        self.configStart = time.time()
+        # The shell reports when it is done, so the time is right even if
+        # we only collect the output much later
+        self.sendCmd(self.configScript() + "; echo $EPOCHREALTIME")
+        self.configPending = True
         return result
 
+    def configScript(self):
+        """Host settings as a single shell line, the sysctls are written to
+        /proc directly instead of running sysctl"""
+        script = ["echo 1 > /proc/sys/net/ipv6/conf/%s/disable_ipv6" % conf
+                  for conf in IPV6_DISABLE_CONFS]
+        if self.defaultIntf():
+            script.insert(0, "/sbin/ethtool --offload %s %s" % (
+                self.defaultIntf(), " ".join("%s off" % off for off in OFFLOAD_FEATURES)))
+        return "; ".join(script)
+
+    def legacyConfigCommands(self):
+        """The one-command-per-setting config, kept for benchmarkHostConfig()"""
+        cmds = ["/sbin/ethtool --offload %s %s off" % (self.defaultIntf(), off)
+                for off in OFFLOAD_FEATURES]
+        return cmds + ["sysctl -w net.ipv6.conf.%s.disable_ipv6=1" % conf
+                       for conf in IPV6_DISABLE_CONFS]
+
+    def finishConfig(self):
+        if self.configPending:
+            self.configPending = False
+            lines = super(ONOSHost, self).waitOutput().strip().splitlines() or ['']
+            try:
+                self.configDone = float(lines.pop().replace(',', '.'))
+            except ValueError:
+                self.configDone = time.time()
+            if lines:
+                debug("%s config: %s\n" % (self.name, "\n".join(lines)))
+
+    def configTime(self):
+        if self.configDone is None:
+            return None
+        return self.configDone - self.configStart
+
+    def sendCmd(self, *args, **kwargs):
+        self.finishConfig()
+        return super(ONOSHost, self).sendCmd(*args, **kwargs)
+
     def addStaticArp(self, ip, mac):
         """Add a static ARP entry (to be called after config)"""
         self.cmd("arp -i %s -s %s %s" % (self.defaultIntf(), ip, mac))
         self.static_arp[ip] = mac
 
+    def sendStaticArps(self, entries):
+        """Bring the interface up and add [(ip, mac)] static ARP entries with
+        a single ip -batch call; returns without waiting, use waitOutput()"""
+        intf = self.defaultIntf()
+        batch = '/tmp/mn-%s-neigh.batch' % self.name
+        with open(batch, 'w') as f:
+            for ip, mac in entries:
+                f.write("neigh replace %s lladdr %s dev %s nud permanent\n" % (ip, mac, intf))
+                self.static_arp[ip] = mac
+        self.sendCmd("ip link set %s up; ip -force -batch %s; rm -f %s" % (intf, batch, batch))
+
+class ONOSNetnsHost(ONOSHost, NetnsHost):
+    """ONOSHost in a bare namespace, without a bash shell per host"""
+    pass
+
 class ONOSBmv2Switch(Switch):
     """BMv2 software switch with gRPC server"""
     mininet_exception = multiprocessing.Value('i', 0)
@@ -107,10 +611,14 @@ class ONOSBmv2Switch(Switch):
                  thrift=False, dryrun=False,
                  pipeconf=DEFAULT_PIPECONF, pktdump=False, valgrind=False,
                  gnmi=False, portcfg=True, onosdevid=None, stratum=False,
-                 **kwargs):
+                 parallelstart=True, grpcport=None, cpus=None, cpulimit=None,
+                 memlimit=None, **kwargs):
         Switch.__init__(self, name, **kwargs)
-        self.grpcPort = ONOSBmv2Switch.nextGrpcPort
-        ONOSBmv2Switch.nextGrpcPort += 1
+        if grpcport is not None:
+            self.grpcPort = int(grpcport)
+        else:
+            self.grpcPort = ONOSBmv2Switch.nextGrpcPort
+            ONOSBmv2Switch.nextGrpcPort += 1
         self.grpcPortInternal = None
         if not thrift:
             self.thriftPort = None
@@ -138,7 +646,18 @@ class ONOSBmv2Switch(Switch):
         self.bmv2popen = None
         self.stopped = True
         self.keepaliveFile = '/tmp/bmv2-%s-watchdog.out' % self.name
+        # With parallelstart, start() only launches the process and
+        # batchStartup() waits for all switches at once
+        self.parallelStart = parseBoolean(parallelstart)
+        self.starting = False
+        self.startTime = None
+        self.startupTime = None
         self.targetName = STRATUM_BMV2 if self.useStratum else SIMPLE_SWITCH_GRPC
+        # Placement: cores bmv2 is pinned to and its cgroup limits
+        self.cpus = parseCpuList(cpus) if cpus is not None else None
+        self.cpulimit = cpulimit
+        self.memlimit = memlimit
+        self.cgroup = None
         self.cleanupTmpFiles()
 
     def getDeviceConfig(self):
@@ -172,6 +691,8 @@ class ONOSBmv2Switch(Switch):
             cmdString = self.getStratumCmdString(config_dir)
         else:
             cmdString = self.getBmv2CmdString()
+        if self.cpus:
+            cmdString = "taskset -c %s %s" % (",".join(map(str, self.cpus)), cmdString)
 
         debug("\n%s\n" % cmdString)
 
@@ -181,20 +702,65 @@ class ONOSBmv2Switch(Switch):
                 self.logfd = open(self.logfile, "w")
                 self.logfd.write(cmdString + "\n\n" + "-" * 80 + "\n\n")
                 self.logfd.flush()
+                self.startTime = time.time()
+                self.startupTime = None
                 self.bmv2popen = self.popen(cmdString,
                                             stdout=self.logfd,
                                             stderr=self.logfd)
-                self.waitBmv2Start()
-                threading.Thread(target=watchDog, args=[self]).start()
-
-            with open(self.netcfgfile, 'w') as fp:
-                json.dump(self.getDeviceConfig(), fp, indent=4)
+                if self.cpulimit or self.memlimit:
+                    self.cgroup = cgroupLimit(self.name, self.bmv2popen.pid,
+                                              self.cpulimit, self.memlimit)
+                self.starting = True
+                if not self.parallelStart:
+                    self.waitBmv2Start()
+                return
+            self.bmv2Started()
         except Exception:
-            ONOSBmv2Switch.mininet_exception = 1
+            ONOSBmv2Switch.mininet_exception.value = 1
             self.killBmv2()
             self.printBmv2Log()
             raise
 
+    def bmv2Started(self):
+        """Finish start() once the gRPC port is open"""
+        if not self.dryrun:
+            self.starting = False
+            self.startupTime = time.time() - self.startTime
+            print("⚡️ %s @ %d (%.2fs)" % (self.targetName, self.grpcPort, self.startupTime))
+            Supervisor.get().watch(self)
+        with open(self.netcfgfile, 'w') as fp:
+            json.dump(self.getDeviceConfig(), fp, indent=4)
+
+    @classmethod
+    def batchStartup(cls, switches):
+        """Wait for all switches launched by start() concurrently, so the
+        network is up after the slowest switch instead of the sum of all"""
+        pending = [s for s in switches if s.starting]
+        failed = StartupWaiter(pending).run() if pending else []
+        timed = [s for s in switches if s.startupTime is not None]
+        if pending:
+            recordStartupLatency([s.startupTime for s in pending if s in timed], len(failed))
+        if failed:
+            ONOSBmv2Switch.mininet_exception.value = 1
+            for switch in switches:
+                switch.killBmv2()
+            for switch, _ in failed:
+                switch.printBmv2Log()
+            raise Exception("Switch did not start: %s" % ", ".join(
+                "%s (%s)" % (s.name, reason) for s, reason in failed))
+        if timed:
+            slowest = max(timed, key=lambda s: s.startupTime)
+            info("*** %d switches ready in %.2fs (slowest %s %.2fs)\n" % (
+                len(timed), time.time() - min(s.startTime for s in timed), slowest.name, slowest.startupTime))
+        return switches
+
+    def restartBmv2(self):
+        """Bring a dead switch back with the same ports and gRPC port"""
+        self.killBmv2(log=True)
+        self.start(None)
+        if self.starting:
+            self.waitBmv2Start()
+
     def getBmv2CmdString(self):
         bmv2Args = [SIMPLE_SWITCH_GRPC] + self.bmv2Args()
         if self.valgrind:
@@ -215,33 +781,38 @@ class ONOSBmv2Switch(Switch):
         args.append('--grpc-server-addr 0.0.0.0:%s' % self.grpcPort)
         return args
 
+    def grpcReady(self):
+        port = self.grpcPortInternal if self.grpcPortInternal else self.grpcPort
+        with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as sock:
+            return sock.connect_ex(('localhost', port)) == 0
+
     def waitBmv2Start(self):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        endtime = time.time() + SWITCH_START_TIMEOUT
-        while True:
-            port = self.grpcPortInternal if self.grpcPortInternal else self.grpcPort
-            result = sock.connect_ex(('localhost', port))
-            if result == 0:
-                print("⚡️ %s @ %d" % (self.targetName, self.grpcPort))
-                sock.close()
-                break
-            if endtime > time.time():
-                sys.stdout.write('.')
-                sys.stdout.flush()
-                time.sleep(0.05)
-            else:
-                raise Exception("Switch did not start before timeout")
+        failed = StartupWaiter([self]).run()
+        recordStartupLatency([self.startupTime] if not failed else [], len(failed))
+        if failed:
+            raise Exception("Switch did not start: %s" % failed[0][1])
 
     def printBmv2Log(self):
         if os.path.isfile(self.logfile):
             print("-" * 80)
             print("%s log (from %s):" % (self.name, self.logfile))
-            with open(self.logfile, 'r') as f:
-                lines = f.readlines()
-                if len(lines) > BMV2_LOG_LINES:
-                    print("...")
-                for line in lines[-BMV2_LOG_LINES:]:
-                    print(line.rstrip())
+            lines = self.logTail(BMV2_LOG_LINES + 1)
+            if len(lines) > BMV2_LOG_LINES:
+                print("...")
+            for line in lines[-BMV2_LOG_LINES:]:
+                print(line.rstrip())
+
+    def logTail(self, n, blockSize=65536):
+        """Last n lines of the log, read backwards from the end"""
+        with open(self.logfile, 'rb') as f:
+            pos = f.seek(0, os.SEEK_END)
+            data = b''
+            while pos > 0 and data.count(b'\n') <= n:
+                step = min(blockSize, pos)
+                pos -= step
+                f.seek(pos)
+                data = f.read(step) + data
+        return data.decode('utf-8', 'replace').splitlines()[-n:]
 
     def killBmv2(self, log=False):
         self.stopped = True
@@ -249,63 +820,315 @@ class ONOSBmv2Switch(Switch):
             self.bmv2popen.terminate()
             self.bmv2popen.wait()
             self.bmv2popen = None
+        self.closeLog(log)
+        self.removeCgroup()
+
+    def removeCgroup(self):
+        if self.cgroup is not None:
+            try:
+                os.rmdir(self.cgroup)
+            except OSError as e:
+                warn("*** Could not remove %s: %s\n" % (self.cgroup, e))
+            self.cgroup = None
+
+    def closeLog(self, log=False):
         if self.logfd is not None:
             if log:
                 self.logfd.write("*** PROCESS TERMINATED BY MININET ***\n")
             self.logfd.close()
             self.logfd = None
 
-    def cleanupTmpFiles(self):
-        self.cmd("rm -rf /tmp/bmv2-%s-*" % self.name)
+    @classmethod
+    def batchShutdown(cls, switches, grace=SHUTDOWN_GRACE):
+        """Stop all switches together: SIGTERM to every bmv2 at once, reap
+        them concurrently and SIGKILL whatever is left after grace seconds"""
+        start = time.time()
+        running = []
+        for switch in switches:
+            switch.stopped = True
+            if switch.bmv2popen is not None:
+                switch.bmv2popen.terminate()
+                running.append(switch)
+        killed = reapProcesses([s.bmv2popen for s in running], grace)
+        leftover = []
+        for switch in switches:
+            switch.bmv2popen = None
+            switch.closeLog(log=True)
+            switch.removeCgroup()
+            switch.cleanupTmpFiles(keepLog=True)
+            # Switch.stop() is skipped for us, delete what links did not
+            for intf in list(switch.intfs.values()):
+                if switch.name in intf.name:
+                    link = intf.link
+                    peer = link and (link.intf2 if link.intf1 is intf else link.intf1)
+                    if peer is None or peer.name not in leftover:
+                        leftover.append(intf.name)
+                    switch.delIntf(intf)
+        deleteIntfs(leftover)
+        info("*** %d switches stopped in %.2fs (%d killed after %ds)\n" % (
+            len(running), time.time() - start, killed, grace))
+        return switches
+
+    def cleanupTmpFiles(self, keepLog=False):
+        """Remove /tmp/bmv2-<name>-* without a shell, optionally keeping the log"""
+        for path in glob.glob("/tmp/bmv2-%s-*" % self.name):
+            if keepLog and path == self.logfile:
+                continue
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
 
     def stop(self, deleteIntfs=True):
         self.killBmv2(log=True)
         Switch.stop(self, deleteIntfs)
 
-def configure_network(net):
-    """Configure network settings after startup"""
-    n = len(net.hosts)
-    
+def finishHostConfig(hosts):
+    """Wait for the config of all hosts and report how long it took"""
+    for host in hosts:
+        host.finishConfig()
+    done = [h for h in hosts if h.configDone is not None]
+    if done:
+        times = [h.configTime() for h in done]
+        info("*** %d hosts configured in %.2fs (per host: avg %.1f ms, max %.1f ms)\n" % (
+            len(done), max(h.configDone for h in done) - min(h.configStart for h in done),
+            1000 * sum(times) / len(times), 1000 * max(times)))
+
+def benchmarkHostConfig(hosts):
+    """Time the old per-setting host config against the batched one"""
+    start = time.time()
+    for host in hosts:
+        for cmd in host.legacyConfigCommands():
+            host.cmd(cmd)
+    serial = time.time() - start
+    start = time.time()
+    for host in hosts:
+        host.sendCmd(host.configScript())
+    for host in hosts:
+        host.waitOutput()
+    batched = time.time() - start
+    n = max(len(hosts), 1)
+    info("Host config of %d hosts:\n" % len(hosts))
+    info("  one command per setting: %.2fs (%.1f ms per host)\n" % (serial, 1000 * serial / n))
+    info("  batched, all hosts at once: %.2fs (%.1f ms per host)\n" % (batched, 1000 * batched / n))
+    return serial, batched
+
+def checkNetwork(net, topology=None, timeout=connectivity_check.TIMEOUT):
+    """Probe all host pairs at once and print the matrix; with the topology,
+    unreachable pairs are explained by the routes read from the switches"""
+    info("*** Checking connectivity of %d hosts\n" % len(net.hosts))
+    matrix = connectivity_check.checkConnectivity(net.hosts, timeout=timeout)
+    reasons = None
+    if topology and matrix.failures():
+        try:
+            routes = connectivity_check.readRoutes(topology)
+            reasons = connectivity_check.explainFailures(matrix, topology, routes)
+        except Exception as e:
+            warn("Cannot read the routes of the switches: %s\n" % e)
+    for line in connectivity_check.matrixLines(matrix, reasons):
+        info(line + "\n")
+    return matrix
+
+def measureThroughput(net, pairs, topology=None, duration=throughput_matrix.DURATION):
+    """Run all pairs at once and print per pair, aggregate and per hop count
+    throughput; hop counts come from the installed routes if readable"""
+    info("*** Measuring %d pairs for %.0fs\n" % (len(pairs), duration))
+    result = throughput_matrix.runThroughput(pairs, duration)
+    hops = None
+    if topology:
+        try:
+            routes = connectivity_check.readRoutes(topology)
+        except Exception as e:
+            warn("Cannot read the routes of the switches, assuming shortest paths: %s\n" % e)
+            routes = None
+        hops = throughput_matrix.hopCounts(pairs, topology, routes)
+    for line in throughput_matrix.resultLines(result, hops):
+        info(line + "\n")
+    return result
+
+def verifyRoutes(net, topology, count=path_verify.COUNT):
+    """Send probes along every installed route at once and report the
+    routes that do not reach their destination host"""
+    routes = connectivity_check.readRoutes(topology)
+    paths, missing = path_verify.installedPaths(net.hosts, topology, routes)
+    info("*** Verifying %d routes with %d probes each\n" % (len(paths), count))
+    start = time.time()
+    results = path_verify.verifyPaths(net.hosts, paths, count)
+    for line in path_verify.resultLines(results, missing):
+        info(line + "\n")
+    info("*** Verified in %.2fs\n" % (time.time() - start))
+    return results
+
+class MeshCLI(CLI):
+    def __init__(self, mininet, topology=None, **kwargs):
+        self.topology = topology
+        CLI.__init__(self, mininet, **kwargs)
+
+    def do_liveness(self, _line):
+        "Show the liveness table of all switches."
+        printLivenessTable()
+
+    def do_placement(self, _line):
+        "Show the cores and cgroup limits of all switches."
+        printPlacement(self.mn.switches)
+
+    def do_benchconfig(self, _line):
+        "Compare the serial and the batched host config time."
+        benchmarkHostConfig(self.mn.hosts)
+
+    def do_check(self, line):
+        "check [timeout]: ping all host pairs at once, explain failures by the routes."
+        try:
+            timeout = float(line) if line.strip() else connectivity_check.TIMEOUT
+        except ValueError:
+            warn("usage: check [timeout]\n")
+            return
+        checkNetwork(self.mn, self.topology, timeout)
+
+    def do_throughput(self, line):
+        """throughput [-t seconds] [perm [seed] | src:dst ...]: measure all pairs
+        at once, default a random permutation of all hosts."""
+        args = line.split()
+        duration = throughput_matrix.DURATION
+        try:
+            if args[:1] == ['-t']:
+                duration = float(args[1])
+                args = args[2:]
+            if not args or args[0] == 'perm':
+                seed = int(args[1]) if len(args) > 1 else None
+                pairs = throughput_matrix.permutationPairs(self.mn.hosts, seed)
+            else:
+                pairs = throughput_matrix.parsePairs(self.mn, args)
+        except (IndexError, ValueError, KeyError) as e:
+            warn("usage: throughput [-t seconds] [perm [seed] | src:dst ...] (%s)\n" % e)
+            return
+        measureThroughput(self.mn, pairs, self.topology, duration)
+
+    def do_verify(self, line):
+        "verify [count]: probe every installed route and report where probes end up."
+        if not self.topology:
+            warn("verify needs the topology of the controller\n")
+            return
+        try:
+            count = int(line) if line.strip() else path_verify.COUNT
+        except ValueError:
+            warn("usage: verify [count]\n")
+            return
+        try:
+            verifyRoutes(self.mn, self.topology, count)
+        except Exception as e:
+            warn("verify failed: %s\n" % e)
+
+def configure_network(net, staticArp=True):
+    """Configure network settings after startup; without staticArp the
+    hosts resolve each other through the controller (proxy ARP)"""
+    if not staticArp:
+        info('No static ARP entries, ARP is answered by the controller (--proxy-arp)\n')
+        return
+    start = time.time()
+    neighbors = [(host.IP(), host.MAC()) for host in net.hosts]
+
+    # One batch per host, all hosts working at the same time
     for host in net.hosts:
-        host.cmd('ifconfig %s up' % host.defaultIntf())
-    
-    for i in range(1, n+1):
-        host = net.get('h%d' % i)
-        for j in range(1, n+1):
-            if i != j:
-                ip = '10.0.0.%d' % j
-                mac = '00:00:00:00:00:%02d' % j
-                host.addStaticArp(ip, mac)
-                info('Added static ARP on h%d: %s -> %s\n' % (i, ip, mac))
+        host.sendStaticArps([(ip, mac) for ip, mac in neighbors if ip != host.IP()])
+    for host in net.hosts:
+        output = host.waitOutput()
+        if output.strip():
+            warn('Static ARP on %s: %s\n' % (host.name, output.strip()))
+
+    info('Added %d static ARP entries on %d hosts in %.2fs\n' % (
+        sum(len(h.static_arp) for h in net.hosts), len(net.hosts), time.time() - start))
+
+def stopNetwork(net):
+    """net.stop() with the interfaces of all links deleted in one batch and
+    the switches stopped by batchShutdown(), reporting the teardown time"""
+    start = time.time()
+    links = deleteLinks(net.links)
+    net.links = []
+    info("*** Deleted %d links in %.2fs\n" % (links, time.time() - start))
+    net.stop()
+    info("*** Network torn down in %.2fs\n" % (time.time() - start))
 
 def run():
+    parser = argparse.ArgumentParser(description='BMv2 source routing network')
+    topo_builder.addArguments(parser)
+    parser.add_argument('--topo', default=None,
+                        help='build the network from this topo.json instead of generating it')
+    parser.add_argument('--write-topo', default=None,
+                        help='write the generated topology for the controller to this file')
+    parser.add_argument('--netns-hosts', action='store_true',
+                        help='hosts are bare namespaces without a shell (large topologies)')
+    parser.add_argument('--pin', choices=PLACEMENT_STRATEGIES, default=None,
+                        help='pin switches to cores, spread over all cores or packed on few')
+    parser.add_argument('--cores-per-switch', type=int, default=1)
+    parser.add_argument('--switches-per-core', type=int, default=2,
+                        help='switches sharing a core set with --pin pack')
+    parser.add_argument('--reserve-cores', type=int, default=0,
+                        help='leave the first N cores to the controller and traffic')
+    parser.add_argument('--cpu-limit', type=float, default=None,
+                        help='cgroup v2 CPU limit per switch, in cores')
+    parser.add_argument('--mem-limit', default=None,
+                        help='cgroup v2 memory limit per switch, e.g. 512M')
+    parser.add_argument('--proxy-arp', action='store_true',
+                        help='no static ARP entries, run controller3.py --proxy-arp')
+    parser.add_argument('--check', action='store_true',
+                        help='check the connectivity of all host pairs before the CLI')
+    args = parser.parse_args()
     setLogLevel('info')
-    
-    net = Mininet(topo=MeshTopo(n=4),
-                 host=ONOSHost,
+
+    if args.topo:
+        with open(args.topo) as f:
+            topology = json.load(f)
+    else:
+        topology = topo_builder.generate(args)
+    if args.write_topo:
+        topo_builder.save(topology, args.write_topo)
+        info('Controller topology written to %s\n' % args.write_topo)
+
+    cores = None
+    if args.pin:
+        cores = planCores(len(topology["switches"]), args.pin, args.cores_per_switch,
+                          args.switches_per_core, args.reserve_cores)
+    switchOpts = {'cpulimit': args.cpu_limit, 'memlimit': args.mem_limit}
+
+    if args.netns_hosts:
+        NetnsHost.cleanupAll()
+    net = Mininet(topo=JsonTopo(topology, cores, switchOpts),
+                 host=ONOSNetnsHost if args.netns_hosts else ONOSHost,
                  switch=ONOSBmv2Switch,
                  controller=None,
                  autoSetMacs=True)
     
     info('Starting network...\n')
     net.start()
+    finishHostConfig(net.hosts)
+    info("*** Host processes use %.1f MB\n" % (sum(memoryPerHost(net.hosts).values()) / 1024.0))
     
     for switch in net.switches:
         if not switch.cmd('pgrep -f "simple_switch_grpc.*%s"' % switch.name):
             info('Switch %s failed to start!\n' % switch.name)
             switch.printBmv2Log()
-            net.stop()
+            stopNetwork(net)
             return
     
-    configure_network(net)
+    configure_network(net, staticArp=not args.proxy_arp)
     
     info("\nNetwork ready:\n")
     info("Switch gRPC ports:\n")
     for switch in net.switches:
-        info("%s: gRPC %d\n" % (switch.name, switch.grpcPort))
+        info("%s: gRPC %d, started in %.2fs\n" % (
+            switch.name, switch.grpcPort, switch.startupTime or 0))
+    printStartupHistogram(startupLatencyHistogram())
+    if args.pin or args.cpu_limit or args.mem_limit:
+        printPlacement(net.switches)
+    if args.check:
+        checkNetwork(net, topology)
     
-    CLI(net)
-    net.stop()
+    MeshCLI(net, topology)
+    stopNetwork(net)
 
 if __name__ == '__main__':
     run()
@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+"""Checks that source routes reach the host they were written for, by
+sending probes along them and capturing where the probes come out.
+
+A probe is the frame the ingress switch would build for a route: Ethernet
+with type 0x1234, one tag per hop (bos on the last one), then IPv4/UDP
+with the path id and the send time in the payload. All frames are built
+and serialized up front and written to one file per source host; a sender
+process in every source host only stamps the send time into each frame
+and writes it to a raw socket, paced at RATE frames per second. A capture
+process on every host records which probes arrive, with kernel receive
+timestamps, and how many tags were left on them. The switches pop one
+tag per hop and turn the last one into IPv4, so a probe passes when it
+arrives at its destination host with no tag left.
+
+    routes = connectivity_check.readRoutes(topology)
+    paths, missing = installedPaths(net.hosts, topology, routes)
+    results = verifyPaths(net.hosts, paths)
+    print("\\n".join(resultLines(results, missing)))"""
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import struct
+import argparse
+import tempfile
+import subprocess
+from collections import defaultdict
+
+from throughput_matrix import collectOutputs
+
+TYPE_SRCROUTING = 0x1234
+TYPE_IPV4 = 0x0800
+ETH_P_ALL = 0x0003
+SO_TIMESTAMPNS = 35  # asm-generic/socket.h, not exported by the socket module
+PROBE_PORT = 9
+MAGIC = b'SRPV'
+COUNT = 3            # probes per path, a path passes if one arrives
+RATE = 2000          # frames per second per sender
+TIMEOUT = 1.0        # seconds a probe may take after the last one is sent
+START_LEAD = 1.0     # seconds between launching the processes and sending
+LEAD_PER_PROC = 0.01
+
+ETH = struct.Struct('!6s6sH')
+TAG = struct.Struct('!H')
+IPV4 = struct.Struct('!BBHHHBBH4s4s')
+UDP = struct.Struct('!HHHH')
+PAYLOAD = struct.Struct('!4sId')  # magic, path id, send time
+FRAME_LEN = struct.Struct('!H')
+TIMESPEC = struct.Struct('@qq')
+
+class Path(object):
+    """A route from a source host to a destination host, as hop ports"""
+    def __init__(self, src, dst, ports):
+        self.src = src
+        self.dst = dst
+        self.ports = list(ports)
+
+    def __repr__(self):
+        return '%s -> %s %s' % (self.src.name, self.dst.name, self.ports)
+
+def macBytes(mac):
+    return bytes(int(b, 16) for b in mac.split(':'))
+
+def ipChecksum(header):
+    total = sum(struct.unpack('!%dH' % (len(header) // 2), header))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+def buildFrame(pathId, srcMac, dstMac, srcIp, dstIp, ports):
+    """The probe frame of a path; the send time at its end is zero"""
+    tags = b''.join(TAG.pack((0x8000 if i == len(ports) - 1 else 0) | port)
+                    for i, port in enumerate(ports))
+    payload = PAYLOAD.pack(MAGIC, pathId, 0.0)
+    udp = UDP.pack(PROBE_PORT, PROBE_PORT, UDP.size + len(payload), 0)
+    src, dst = socket.inet_aton(srcIp), socket.inet_aton(dstIp)
+    ip = IPV4.pack(0x45, 0, IPV4.size + len(udp) + len(payload), pathId & 0xFFFF,
+                   0, 64, socket.IPPROTO_UDP, 0, src, dst)
+    ip = ip[:10] + struct.pack('!H', ipChecksum(ip)) + ip[12:]
+    return ETH.pack(macBytes(dstMac), macBytes(srcMac), TYPE_SRCROUTING) + tags + ip + udp + payload
+
+def parseProbe(frame):
+    """(path id, send time, tags left) of a probe frame, or None"""
+    if len(frame) < ETH.size:
+        return None
+    etherType = ETH.unpack_from(frame)[2]
+    offset, tags = ETH.size, 0
+    if etherType == TYPE_SRCROUTING:
+        while True:
+            if len(frame) < offset + TAG.size:
+                return None
+            tag = TAG.unpack_from(frame, offset)[0]
+            offset += TAG.size
+            tags += 1
+            if tag & 0x8000:
+                break
+    elif etherType != TYPE_IPV4:
+        return None
+    if len(frame) < offset + IPV4.size or frame[offset] >> 4 != 4:
+        return None
+    ihl = (frame[offset] & 0x0F) * 4
+    if frame[offset + 9] != socket.IPPROTO_UDP:
+        return None
+    offset += ihl
+    if len(frame) < offset + UDP.size + PAYLOAD.size:
+        return None
+    if UDP.unpack_from(frame, offset)[1] != PROBE_PORT:
+        return None
+    magic, pathId, sent = PAYLOAD.unpack_from(frame, offset + UDP.size)
+    if magic != MAGIC:
+        return None
+    return pathId, sent, tags
+
+def readFrames(path):
+    frames = []
+    with open(path, 'rb') as f:
+        data = f.read()
+    offset = 0
+    while offset < len(data):
+        size = FRAME_LEN.unpack_from(data, offset)[0]
+        offset += FRAME_LEN.size
+        frames.append(bytearray(data[offset:offset + size]))
+        offset += size
+    return frames
+
+def send(intf, framesPath, start, count=COUNT, rate=RATE):
+    """Send every frame count times from start on, rate frames per second,
+    with the send time stamped into each"""
+    frames = readFrames(framesPath)
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW)
+    sock.bind((intf, 0))
+    sent, errors = 0, 0
+    interval = 1.0 / rate
+    time.sleep(max(start - time.time(), 0))
+    nextSend = time.time()
+    for _ in range(count):
+        for frame in frames:
+            now = time.time()
+            if now < nextSend:
+                time.sleep(nextSend - now)
+            nextSend += interval
+            struct.pack_into('!d', frame, len(frame) - 8, time.time())
+            try:
+                sock.send(frame)
+                sent += 1
+            except OSError:
+                errors += 1
+    sock.close()
+    return {'sent': sent, 'errors': errors}
+
+def capture(intf, until):
+    """Probes arriving on intf until the given time, as
+    [path id, send time, receive time, tags left]"""
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+    sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+    sock.bind((intf, 0))
+    ancSize = socket.CMSG_SPACE(TIMESPEC.size)
+    probes = []
+    while True:
+        remaining = until - time.time()
+        if remaining <= 0:
+            break
+        sock.settimeout(remaining)
+        try:
+            frame, ancdata, _flags, addr = sock.recvmsg(2048, ancSize)
+        except socket.timeout:
+            break
+        if addr[2] == socket.PACKET_OUTGOING:
+            continue
+        probe = parseProbe(frame)
+        if probe is None:
+            continue
+        received = time.time()
+        for level, kind, data in ancdata:
+            if level == socket.SOL_SOCKET and kind == SO_TIMESTAMPNS:
+                sec, nsec = TIMESPEC.unpack_from(data)
+                received = sec + nsec / 1e9
+        pathId, sent, tags = probe
+        probes.append([pathId, sent, received, tags])
+    sock.close()
+    return probes
+
+def installedPaths(hosts, topology, routes):
+    """A Path for every ordered pair of hosts that has an ipv4_lpm route on
+    the switch of its source host ({switch: [(network, ports)]}, see
+    controller3.read_routes); pairs without one are returned separately"""
+    from controller3 import lookup_route
+    byIp = dict((h["ip"], h) for h in topology["hosts"])
+    paths, missing = [], []
+    for src in hosts:
+        s = byIp.get(src.IP())
+        for dst in hosts:
+            if dst is src or s is None:
+                continue
+            ports = lookup_route(routes.get(s["connected_to"], []), dst.IP())
+            if ports:
+                paths.append(Path(src, dst, ports))
+            else:
+                missing.append((src, dst))
+    return paths, missing
+
+class PathResult(object):
+    """Outcome of the probes of one path"""
+    def __init__(self, path):
+        self.path = path
+        self.latencies = []   # ms, of probes that arrived at the destination
+        self.arrivals = defaultdict(int)  # (host name, tags left) -> probes
+
+    def passed(self):
+        return bool(self.latencies)
+
+    def reason(self):
+        if self.passed():
+            return None
+        if not self.arrivals:
+            return 'lost'
+        wrong = ['at %s%s' % (host, ' with %d tags left' % tags if tags else '')
+                 for host, tags in sorted(self.arrivals)]
+        return 'arrived ' + ', '.join(wrong)
+
+def verifyPaths(hosts, paths, count=COUNT, rate=RATE, timeout=TIMEOUT):
+    """Probe all paths at once, capturing on every host; returns a
+    PathResult per path"""
+    workdir = tempfile.mkdtemp(prefix='mn-pathverify-')
+    try:
+        bySrc = defaultdict(list)
+        for pathId, path in enumerate(paths):
+            bySrc[path.src].append(buildFrame(
+                pathId, path.src.MAC(), path.dst.MAC(), path.src.IP(), path.dst.IP(),
+                path.ports))
+        files = {}
+        for src, frames in bySrc.items():
+            files[src] = os.path.join(workdir, '%s.frames' % src.name)
+            with open(files[src], 'wb') as f:
+                for frame in frames:
+                    f.write(FRAME_LEN.pack(len(frame)) + frame)
+        start = time.time() + START_LEAD + LEAD_PER_PROC * (len(hosts) + len(bySrc))
+        span = count * max([len(frames) for frames in bySrc.values()] + [0]) / float(rate)
+        until = start + span + timeout
+
+        opts = dict(stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        script = [sys.executable, os.path.abspath(__file__)]
+        procs = []
+        for host in hosts:
+            procs.append((('capture', host.name), host.popen(script + [
+                '--capture', '--intf', host.defaultIntf().name, '--until', repr(until)], **opts)))
+        for src, path in files.items():
+            procs.append((('send', src.name), src.popen(script + [
+                '--send', path, '--intf', src.defaultIntf().name, '--start', repr(start),
+                '--count', str(count), '--rate', str(rate)], **opts)))
+        outputs = collectOutputs(procs)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    results = [PathResult(path) for path in paths]
+    for (role, name), output in outputs.items():
+        if not isinstance(output, (list, dict)):
+            raise Exception('%s on %s failed: %s' % (role, name, output))
+        if role != 'capture':
+            continue
+        for pathId, sent, received, tags in output:
+            if not 0 <= pathId < len(results):
+                continue
+            result = results[pathId]
+            if name == result.path.dst.name and not tags:
+                result.latencies.append(1000 * (received - sent))
+            else:
+                result.arrivals[(name, tags)] += 1
+    return results
+
+def resultLines(results, missing=()):
+    """Failed paths, then a summary with latency percentiles"""
+    lines = []
+    for result in results:
+        if not result.passed():
+            lines.append('  FAIL %r: %s' % (result.path, result.reason()))
+    for src, dst in missing:
+        lines.append('  no route %s -> %s' % (src.name, dst.name))
+    passed = [r for r in results if r.passed()]
+    lines.append('%d/%d paths pass' % (len(passed), len(results)))
+    latencies = sorted(min(r.latencies) for r in passed)
+    if latencies:
+        lines.append('one-way latency ms: min %.3f, median %.3f, p99 %.3f, max %.3f' % (
+            latencies[0], latencies[len(latencies) // 2],
+            latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))], latencies[-1]))
+    byHops = defaultdict(list)
+    for r in passed:
+        byHops[len(r.path.ports)].append(min(r.latencies))
+    for hops in sorted(byHops):
+        values = byHops[hops]
+        lines.append('  %d tags: %d paths, mean %.3f ms' % (hops, len(values), sum(values) / len(values)))
+    return lines
+
+def main():
+    parser = argparse.ArgumentParser(description='Source route probe worker')
+    role = parser.add_mutually_exclusive_group(required=True)
+    role.add_argument('--send', metavar='FRAMES', help='file of serialized frames to send')
+    role.add_argument('--capture', action='store_true')
+    parser.add_argument('--intf', required=True)
+    parser.add_argument('--start', type=float, default=0)
+    parser.add_argument('--until', type=float, default=0)
+    parser.add_argument('--count', type=int, default=COUNT)
+    parser.add_argument('--rate', type=float, default=RATE)
+    args = parser.parse_args()
+    if args.capture:
+        result = capture(args.intf, args.until)
+    else:
+        result = send(args.intf, args.send, args.start, args.count, args.rate)
+    json.dump(result, sys.stdout)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+from pathlib import Path
+import math
+import argparse
+import numpy as np
+
+import pcap_index
+
+# Must match source_routing.p4
+BLOOM_FILTER_ENTRIES = 4096
+TYPE_IPV4 = 0x800
+TYPE_SRCROUTING = 0x1234
+TYPE_TCP = 6
+TCP_SYN = 0x02
+TCP_ACK = 0x10
+
+# Flow key fields hashed by compute_hashes(): ipAddr1, ipAddr2, port1, port2,
+# hdr.ipv4.protocol -> 32 + 32 + 16 + 16 + 8 bits = 13 bytes, byte aligned,
+# so bmv2 hashes the big-endian concatenation of the fields as is.
+FLOW_DTYPE = np.dtype([
+    ("src", ">u4"), ("dst", ">u4"),
+    ("sport", ">u2"), ("dport", ">u2"),
+    ("proto", "u1"),
+])
+
+
+def _crc_table(poly: int) -> np.ndarray:
+    """Byte-wise lookup table for a reflected CRC polynomial."""
+    table = np.arange(256, dtype=np.uint32)
+    for _ in range(8):
+        table = np.where(table & 1, (table >> 1) ^ poly, table >> 1)
+    return table.astype(np.uint32)
+
+
+# bmv2 crc16 is CRC-16/ARC (poly 0x8005, reflected, init 0, no final xor) and
+# crc32 is the IEEE/zlib CRC-32 (poly 0x04C11DB7, reflected, init/xor ~0).
+_CRC16_TABLE = _crc_table(0xA001)
+_CRC32_TABLE = _crc_table(0xEDB88320)
+
+
+def crc16(data: np.ndarray) -> np.ndarray:
+    """bmv2 crc16 of every row of an (N, L) uint8 array."""
+    crc = np.zeros(len(data), dtype=np.uint32)
+    for column in data.T:
+        crc = (crc >> 8) ^ _CRC16_TABLE[(crc ^ column) & 0xFF]
+    return crc
+
+
+def crc32(data: np.ndarray) -> np.ndarray:
+    """bmv2 crc32 of every row of an (N, L) uint8 array."""
+    crc = np.full(len(data), 0xFFFFFFFF, dtype=np.uint32)
+    for column in data.T:
+        crc = (crc >> 8) ^ _CRC32_TABLE[(crc ^ column) & 0xFF]
+    return crc ^ np.uint32(0xFFFFFFFF)
+
+
+def compute_hashes(flows: np.ndarray, entries: int = BLOOM_FILTER_ENTRIES):
+    """Register positions written by compute_hashes() for each flow.
+
+    Mirrors v1model hash(): base + (crc % max) with base 0."""
+    data = np.ascontiguousarray(flows, dtype=FLOW_DTYPE).view(np.uint8)
+    data = data.reshape(len(flows), FLOW_DTYPE.itemsize)
+    return crc16(data) % entries, crc32(data) % entries
+
+
+def make_flows(src, dst, sport, dport, proto=TYPE_TCP) -> np.ndarray:
+    """Build a flow array from column values (scalars are broadcast)."""
+    src, dst, sport, dport, proto = np.broadcast_arrays(
+        *np.atleast_1d(src, dst, sport, dport, proto))
+    flows = np.empty(src.shape[0], dtype=FLOW_DTYPE)
+    flows["src"], flows["dst"] = src, dst
+    flows["sport"], flows["dport"], flows["proto"] = sport, dport, proto
+    return flows
+
+
+def synthetic_flows(count: int, hosts: int = 254, seed: int | None = None) -> np.ndarray:
+    """Random TCP flows between hosts of 10.0.0.0/24 (as in topo.json)."""
+    rng = np.random.default_rng(seed)
+    base = 0x0A000000
+    src = base + rng.integers(1, hosts + 1, count)
+    dst = base + rng.integers(1, hosts + 1, count)
+    sport = rng.integers(32768, 61000, count)
+    dport = rng.choice(np.array([22, 80, 443, 5001, 8080]), count)
+    return make_flows(src, dst, sport, dport)
+
+
+def read_pcap_flows(path: Path) -> np.ndarray:
+    """Extract firewall insert keys (TCP SYN without ACK) from a pcap file.
+
+    pcap_index skips source routing tags (EtherType 0x1234), so captures
+    taken inside the fabric work as well as captures from the hosts."""
+    packets = pcap_index.read(path)
+    syn = packets[(packets["proto"] == TYPE_TCP)
+                  & (packets["tcp_flags"] & (TCP_SYN | TCP_ACK) == TCP_SYN)]
+    return make_flows(syn["ip_src"], syn["ip_dst"], syn["sport"], syn["dport"])
+
+
+def unique_flows(flows: np.ndarray) -> np.ndarray:
+    """Drop repeated 5-tuples (sorting structured arrays directly is slow)."""
+    addrs = (flows["src"].astype(np.uint64) << 32) | flows["dst"]
+    rest = ((flows["sport"].astype(np.uint64) << 24)
+            | (flows["dport"].astype(np.uint64) << 8) | flows["proto"])
+    order = np.lexsort((rest, addrs))
+    addrs, rest = addrs[order], rest[order]
+    keep = np.ones(len(order), dtype=bool)
+    keep[1:] = (addrs[1:] != addrs[:-1]) | (rest[1:] != rest[:-1])
+    return flows[order[keep]]
+
+
+def analyze(flows: np.ndarray, entries: int = BLOOM_FILTER_ENTRIES):
+    """Occupancy, collision and false-accept figures for a set of flows."""
+    flows = unique_flows(flows)
+    n = len(flows)
+    pos_1, pos_2 = compute_hashes(flows, entries)
+    fills = []
+    collided = []
+    for pos in (pos_1, pos_2):
+        counts = np.bincount(pos, minlength=entries)
+        fills.append(np.count_nonzero(counts) / entries)
+        # Flows sharing their cell with at least one other flow
+        collided.append(np.count_nonzero(counts[pos] > 1) / n if n else 0.0)
+    # Flows whose two cells are both shared with the same other flow are
+    # indistinguishable to the firewall.
+    pair = pos_1.astype(np.uint64) * entries + pos_2
+    _, pair_counts = np.unique(pair, return_counts=True)
+    aliased = int(pair_counts[pair_counts > 1].sum())
+    expected_fill = -math.expm1(-n / entries)
+    return {
+        "flows": n,
+        "entries": entries,
+        "fill": fills,
+        "collision_rate": collided,
+        "aliased_flows": aliased,
+        "false_accept_rate": fills[0] * fills[1],
+        "expected_false_accept_rate": expected_fill ** 2,
+    }
+
+
+def entries_for(flows: int, target_fpr: float) -> int:
+    """Smallest power-of-two BLOOM_FILTER_ENTRIES keeping the FPR under target."""
+    per_filter = math.sqrt(target_fpr)
+    needed = max(1.0, -flows / math.log1p(-per_filter))
+    return 1 << max(0, math.ceil(math.log2(needed)))
+
+
+def print_report(report):
+    """Display an analysis report."""
+    print(f"Flows: {report['flows']}  BLOOM_FILTER_ENTRIES: {report['entries']}")
+    for i, name in enumerate(("crc16", "crc32")):
+        print(f"  bloom_filter_{i + 1} ({name}): fill {report['fill'][i]:.2%}, "
+              f"colliding flows {report['collision_rate'][i]:.2%}")
+    print(f"  Flows aliased on both cells: {report['aliased_flows']}")
+    print(f"  False-accept rate: {report['false_accept_rate']:.4%} "
+          f"(expected {report['expected_false_accept_rate']:.4%})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline model of the FW Bloom filter hashing")
+    parser.add_argument("pcap", nargs="*", type=Path, help="pcap files to take flows from")
+    parser.add_argument("--synthetic", type=int, default=0,
+                        help="number of random flows to add")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--entries", type=int, default=BLOOM_FILTER_ENTRIES)
+    parser.add_argument("--target-fpr", type=float, default=0.01,
+                        help="false-accept rate used for the sizing suggestion")
+    args = parser.parse_args()
+
+    parts = [read_pcap_flows(path) for path in args.pcap]
+    if args.synthetic:
+        parts.append(synthetic_flows(args.synthetic, seed=args.seed))
+    if not parts:
+        parser.error("give at least one pcap file or --synthetic N")
+    flows = np.concatenate(parts)
+
+    report = analyze(flows, args.entries)
+    print_report(report)
+    print(f"  Suggested BLOOM_FILTER_ENTRIES for {args.target_fpr:.2%}: "
+          f"{entries_for(report['flows'], args.target_fpr)}")
+
+
+if __name__ == "__main__":
+    main()
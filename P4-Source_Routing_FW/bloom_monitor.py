@@ -0,0 +1,213 @@
+from pathlib import Path
+import json
+import math
+import argparse
+import asyncio
+import contextlib
+import numpy as np
+import finsy as fy
+
+# Define the P4 source directory
+_P4SRC = Path(__file__).parent
+
+BLOOM_FILTERS = ("bloom_filter_1", "bloom_filter_2")
+BLOOM_FILTER_ENTRIES = 4096
+
+# The data plane only ever sets cells, so a cell seen at 1 stays at 1 until the
+# filter is cleared. Every FULL_SCAN_INTERVAL polls all cells are read again to
+# pick up a reset done by the controller or a switch restart.
+FULL_SCAN_INTERVAL = 10
+
+# Monitor connects as a backup client so it never takes mastership away from
+# controller3.py (which uses finsy's default election id of 10).
+MONITOR_ELECTION_ID = 5
+
+
+def false_positive_rate(fill_1: float, fill_2: float) -> float:
+    """False-accept probability of the firewall's two-hash Bloom filter.
+
+    Each hash (crc16, crc32) owns its own register, so an unseen flow is
+    accepted when both of its cells happen to be set."""
+    return fill_1 * fill_2
+
+
+def estimate_flows(fill: float, entries: int) -> float:
+    """Estimate the number of distinct flows inserted from a fill ratio."""
+    if fill >= 1.0:
+        return math.inf
+    return -entries * math.log1p(-fill)
+
+
+def load_topology(json_file: Path):
+    """Load network topology from JSON file."""
+    with open(json_file, "r") as f:
+        return json.load(f)
+
+
+class BloomFilterView:
+    """Cached view of one Bloom filter register on one switch."""
+
+    def __init__(self, register: str, entries: int = BLOOM_FILTER_ENTRIES):
+        self.register = register
+        self.entries = entries
+        self.cells = np.zeros(entries, dtype=np.uint8)
+        self.estimated_set = 0.0
+        self.polls = 0
+
+    @property
+    def fill(self) -> float:
+        """Estimated fraction of cells set to 1."""
+        return self.estimated_set / self.entries
+
+    def pending(self, sample: int = 0, rng=None):
+        """Return the cell indexes that have to be read on the next poll."""
+        if self.polls % FULL_SCAN_INTERVAL == 0:
+            return None  # Full read
+        unset = np.flatnonzero(self.cells == 0)
+        if sample and len(unset) > sample:
+            unset = rng.choice(unset, size=sample, replace=False)
+        return unset
+
+    def update_full(self, indexes, values):
+        """Replace the cached view with a full register read."""
+        self.cells[:] = 0
+        self.cells[indexes] = values
+        self.estimated_set = float(np.count_nonzero(self.cells))
+        self.polls += 1
+
+    def update_partial(self, indexes, values):
+        """Merge an incremental (or sampled) read of previously unset cells."""
+        unset_before = self.entries - np.count_nonzero(self.cells)
+        self.cells[indexes] = values
+        known_set = np.count_nonzero(self.cells)
+        if len(indexes) < unset_before:
+            # Sampled read: extrapolate the hit ratio to the unset cells not read.
+            hit_ratio = np.count_nonzero(values) / len(indexes)
+            self.estimated_set = known_set + hit_ratio * (unset_before - len(indexes))
+        else:
+            self.estimated_set = float(known_set)
+        self.polls += 1
+
+
+class BloomMonitor:
+    def __init__(self, threshold: float, sample: int = 0, seed: int | None = None):
+        self.threshold = threshold
+        self.sample = sample
+        self.rng = np.random.default_rng(seed)
+        self.switches = {}  # Track switch connections
+        self.views = {}  # switch name -> {register: BloomFilterView}
+        self.alerting = set()
+
+    def add_switch(self, switch_name: str, switch: fy.Switch):
+        """Register a connected switch and size its filters from the p4info."""
+        self.switches[switch_name] = switch
+        views = {}
+        for register in BLOOM_FILTERS:
+            entries = switch.p4info.registers[register].size
+            views[register] = BloomFilterView(register, entries)
+        self.views[switch_name] = views
+
+    async def _read_cells(self, switch_name: str, view: BloomFilterView, indexes):
+        """Read the given cells (or the whole register) in a single request."""
+        switch = self.switches[switch_name]
+        if indexes is None:
+            request = fy.P4RegisterEntry(view.register)
+        else:
+            request = [fy.P4RegisterEntry(view.register, index=int(i))
+                       for i in indexes]
+        cells = [(entry.index, 1 if entry.data else 0)
+                 async for entry in switch.read(request)]
+        data = np.array(cells, dtype=np.int64).reshape(-1, 2)
+        return data[:, 0], data[:, 1].astype(np.uint8)
+
+    async def poll_switch(self, switch_name: str):
+        """Refresh every Bloom filter view of a switch."""
+        for view in self.views[switch_name].values():
+            indexes = view.pending(self.sample, self.rng)
+            if indexes is not None and len(indexes) == 0:
+                view.polls += 1
+                continue
+            read_indexes, values = await self._read_cells(switch_name, view, indexes)
+            if indexes is None:
+                view.update_full(read_indexes, values)
+            else:
+                view.update_partial(read_indexes, values)
+
+    async def poll(self):
+        """Poll all switches concurrently and return per-switch statistics."""
+        names = list(self.switches)
+        results = await asyncio.gather(*(self.poll_switch(name) for name in names),
+                                       return_exceptions=True)
+        stats = {}
+        for name, result in zip(names, results):
+            if isinstance(result, Exception):
+                print(f"Read error on {name}: {result}")
+                continue
+            views = self.views[name]
+            fills = [views[register].fill for register in BLOOM_FILTERS]
+            fpr = false_positive_rate(*fills)
+            stats[name] = {
+                "fill": fills,
+                "flows": [estimate_flows(views[r].fill, views[r].entries)
+                          for r in BLOOM_FILTERS],
+                "fpr": fpr,
+            }
+            self._check_threshold(name, fpr)
+        return stats
+
+    def _check_threshold(self, switch_name: str, fpr: float):
+        """Print an alert when a switch crosses the false-positive threshold."""
+        if fpr >= self.threshold and switch_name not in self.alerting:
+            self.alerting.add(switch_name)
+            print(f"ALERT: {switch_name} false-positive estimate {fpr:.4%} "
+                  f">= {self.threshold:.4%}")
+        elif fpr < self.threshold and switch_name in self.alerting:
+            self.alerting.discard(switch_name)
+            print(f"Cleared: {switch_name} false-positive estimate {fpr:.4%}")
+
+
+def print_stats(stats):
+    """Display one line per switch."""
+    for name, s in sorted(stats.items()):
+        fill_1, fill_2 = s["fill"]
+        flows = max(s["flows"])
+        print(f"  {name}: fill {fill_1:6.2%} / {fill_2:6.2%}  "
+              f"~{flows:.0f} flows  fpr {s['fpr']:.4%}")
+
+
+async def main():
+    """Poll the firewall Bloom filters of every switch in topo.json."""
+    parser = argparse.ArgumentParser(description="Firewall Bloom filter monitor")
+    parser.add_argument("--topo", type=Path, default=_P4SRC / "topo.json")
+    parser.add_argument("--interval", type=float, default=5.0,
+                        help="seconds between polls")
+    parser.add_argument("--threshold", type=float, default=0.01,
+                        help="false-positive probability that raises an alert")
+    parser.add_argument("--sample", type=int, default=0,
+                        help="read at most this many unset cells per poll (0 = all)")
+    args = parser.parse_args()
+
+    topology = load_topology(args.topo)
+    monitor = BloomMonitor(args.threshold, args.sample)
+
+    opts = fy.SwitchOptions(
+        p4info=_P4SRC / "source_routing.p4info.txt",
+        initial_election_id=MONITOR_ELECTION_ID,
+    )
+
+    async with contextlib.AsyncExitStack() as stack:
+        for switch in topology["switches"]:
+            name = switch["name"]
+            monitor.add_switch(name, await stack.enter_async_context(
+                fy.Switch(name, f"{switch['ip']}:{switch['port']}", opts)
+            ))
+
+        while True:
+            stats = await monitor.poll()
+            print("\nBloom filter occupancy:")
+            print_stats(stats)
+            await asyncio.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    fy.run(main())
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+"""All-pairs connectivity check of a running network, in about one probe
+timeout instead of one ping per pair.
+
+Every host runs one probe process in its namespace, all hosts at the same
+time (at most CONCURRENCY processes). A probe process sends ICMP echo
+requests to all other hosts from a single raw socket, at most WINDOW in
+flight, and gives every request the same fixed timeout, so a dead pair
+costs TIMEOUT and never more. The result is a reachability and RTT matrix;
+with the routes read from the switches (controller3.read_routes) every
+failure is explained by the ipv4_lpm entry that should have carried it.
+
+    matrix = checkConnectivity(net.hosts)
+    print("\n".join(matrixLines(matrix)))
+    routes = readRoutes(topology)
+    for (src, dst), reason in explainFailures(matrix, topology, routes).items():
+        ...
+
+Run as "connectivity_check.py --probe <ip> ..." it is the probe process
+itself and prints {ip: rtt in ms or null} as JSON."""
+import os
+import sys
+import json
+import time
+import errno
+import select
+import socket
+import struct
+import argparse
+import selectors
+import subprocess
+from collections import deque
+
+TIMEOUT = 0.5        # seconds per echo request
+ATTEMPTS = 2         # requests per pair before it counts as unreachable
+WINDOW = 64          # requests in flight per probe process
+CONCURRENCY = 64     # probe processes at the same time
+MAX_GRID = 16        # larger matrices are summarized, not printed
+
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+ICMP_HEADER = struct.Struct('!BBHHH')
+PAYLOAD = b'mn-connectivity-check'
+
+def checksum(data):
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+def echoRequest(ident, seq):
+    header = ICMP_HEADER.pack(ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+    csum = checksum(header + PAYLOAD)
+    return ICMP_HEADER.pack(ICMP_ECHO_REQUEST, 0, csum, ident, seq) + PAYLOAD
+
+def parseEchoReply(packet, ident):
+    """Sequence number of an echo reply to us in a raw IPv4 packet, or None"""
+    if len(packet) < 20:
+        return None
+    offset = (packet[0] & 0x0F) * 4
+    if len(packet) < offset + ICMP_HEADER.size:
+        return None
+    kind, _code, _csum, rident, seq = ICMP_HEADER.unpack_from(packet, offset)
+    if kind != ICMP_ECHO_REPLY or rident != ident:
+        return None
+    return seq
+
+def probe(targets, timeout=TIMEOUT, window=WINDOW, attempts=ATTEMPTS):
+    """RTT in ms of an ICMP echo to each target IP, None if none of the
+    attempts was answered within timeout"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+    sock.setblocking(False)
+    ident = os.getpid() & 0xFFFF
+    rtts = dict.fromkeys(targets)
+    seq = 0
+    try:
+        for _ in range(attempts):
+            todo = deque(t for t in targets if rtts[t] is None)
+            inflight = {}  # seq -> (target, sent)
+            while todo or inflight:
+                now = time.perf_counter()
+                while todo and len(inflight) < window:
+                    target = todo.popleft()
+                    seq = (seq + 1) & 0xFFFF
+                    try:
+                        sock.sendto(echoRequest(ident, seq), (target, 0))
+                    except OSError:
+                        continue  # no route in the host, stays None
+                    inflight[seq] = (target, now)
+                for s, (target, sent) in list(inflight.items()):
+                    if now - sent >= timeout:
+                        del inflight[s]
+                if not inflight:
+                    continue
+                wait = min(sent for _, sent in inflight.values()) + timeout - now
+                if not select.select([sock], [], [], max(wait, 0))[0]:
+                    continue
+                while True:
+                    try:
+                        packet, addr = sock.recvfrom(2048)
+                    except OSError as e:
+                        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                            break
+                        raise
+                    s = parseEchoReply(packet, ident)
+                    if s in inflight and inflight[s][0] == addr[0]:
+                        target, sent = inflight.pop(s)
+                        rtts[target] = 1000 * (time.perf_counter() - sent)
+            if all(rtt is not None for rtt in rtts.values()):
+                break
+    finally:
+        sock.close()
+    return rtts
+
+class ConnectivityMatrix(object):
+    """RTT in ms (None: unreachable) of every ordered pair of hosts"""
+    def __init__(self, names, ips):
+        self.names = names
+        self.ips = ips
+        self.rtt = dict((src, {}) for src in names)
+        self.errors = {}
+        self.elapsed = 0.0
+
+    def pairs(self):
+        return [(src, dst) for src in self.names for dst in self.names if src != dst]
+
+    def failures(self):
+        return [(src, dst) for src, dst in self.pairs() if self.rtt[src].get(dst) is None]
+
+    def latencies(self):
+        return sorted(rtt for src, dst in self.pairs()
+                      for rtt in [self.rtt[src].get(dst)] if rtt is not None)
+
+def _startProbe(host, targets, timeout, window, attempts):
+    cmd = [sys.executable, os.path.abspath(__file__), '--probe',
+           '--timeout', str(timeout), '--window', str(window),
+           '--attempts', str(attempts)] + targets
+    return host.popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                      stderr=subprocess.STDOUT)
+
+def checkConnectivity(hosts, timeout=TIMEOUT, concurrency=CONCURRENCY,
+                      window=WINDOW, attempts=ATTEMPTS):
+    """Probe all pairs of hosts, from all hosts at once, and return the
+    ConnectivityMatrix"""
+    start = time.time()
+    ips = dict((h.name, h.IP()) for h in hosts)
+    byIp = dict((ip, name) for name, ip in ips.items())
+    matrix = ConnectivityMatrix([h.name for h in hosts], ips)
+    pending = deque(hosts)
+    running = {}  # fd -> (host, popen, output chunks)
+    sel = selectors.DefaultSelector()
+    while pending or running:
+        while pending and len(running) < concurrency:
+            host = pending.popleft()
+            targets = [ip for name, ip in ips.items() if name != host.name]
+            popen = _startProbe(host, targets, timeout, window, attempts)
+            fd = popen.stdout.fileno()
+            running[fd] = (host, popen, [])
+            sel.register(fd, selectors.EVENT_READ)
+        for key, _ in sel.select():
+            host, popen, chunks = running[key.fd]
+            data = os.read(key.fd, 65536)
+            if data:
+                chunks.append(data)
+                continue
+            sel.unregister(key.fd)
+            del running[key.fd]
+            popen.stdout.close()
+            popen.wait()
+            output = b''.join(chunks).decode('utf-8', 'replace')
+            try:
+                rtts = json.loads(output)
+            except ValueError:
+                matrix.errors[host.name] = output.strip() or 'exit status %d' % popen.returncode
+                rtts = {}
+            for ip, rtt in rtts.items():
+                matrix.rtt[host.name][byIp[ip]] = rtt
+    sel.close()
+    matrix.elapsed = time.time() - start
+    return matrix
+
+def explainFailures(matrix, topology, routes):
+    """{(src, dst): reason} for every unreachable pair, from the topology
+    and the ipv4_lpm routes of every switch ({switch: [(network, ports)]},
+    see controller3.read_routes). A pair needs a route both ways, the echo
+    reply takes the route installed for the other direction."""
+    from controller3 import lookup_route, trace_route
+    hostByIp = dict((h["ip"], h) for h in topology["hosts"])
+
+    def checkRoute(src, dst):
+        switch = src["connected_to"]
+        ports = lookup_route(routes.get(switch, []), dst["ip"])
+        if ports is None:
+            return "no ipv4_lpm entry for %s on %s" % (dst["ip"], switch)
+        try:
+            last, port = trace_route(topology, switch, ports)[-1]
+        except ValueError as e:
+            return "route %s %s on %s: %s" % (dst["ip"], ports, switch, e)
+        if (last, port) != (dst["connected_to"], dst["port"]):
+            return "route %s %s on %s ends at %s port %d, host is at %s port %d" % (
+                dst["ip"], ports, switch, last, port, dst["connected_to"], dst["port"])
+        return None
+
+    reasons = {}
+    for src, dst in matrix.failures():
+        if src in matrix.errors:
+            reasons[(src, dst)] = "probe failed: %s" % matrix.errors[src]
+            continue
+        s = hostByIp.get(matrix.ips[src])
+        d = hostByIp.get(matrix.ips[dst])
+        if s is None or d is None:
+            reasons[(src, dst)] = "host not in the topology"
+            continue
+        forward = checkRoute(s, d)
+        reverse = None if forward else checkRoute(d, s)
+        if forward:
+            reasons[(src, dst)] = forward
+        elif reverse:
+            reasons[(src, dst)] = "reply: " + reverse
+        else:
+            reasons[(src, dst)] = "routes are correct, packets lost on the path"
+    return reasons
+
+def readRoutes(topology):
+    """controller3.read_routes() for callers without an event loop"""
+    import asyncio
+    from controller3 import read_routes
+    return asyncio.run(read_routes(topology))
+
+def matrixLines(matrix, reasons=None):
+    """The matrix as text: a grid of RTTs for small networks, a summary
+    and the unreachable pairs otherwise"""
+    lines = []
+    names = matrix.names
+    if len(names) <= MAX_GRID:
+        width = max([len(n) for n in names] + [6])
+        lines.append(' ' * width + ''.join('%*s' % (width + 1, n) for n in names))
+        for src in names:
+            cells = []
+            for dst in names:
+                rtt = matrix.rtt[src].get(dst)
+                cells.append('-' if src == dst else 'X' if rtt is None else '%.2f' % rtt)
+            lines.append('%-*s' % (width, src) + ''.join('%*s' % (width + 1, c) for c in cells))
+    pairs = len(matrix.pairs())
+    failures = matrix.failures()
+    lines.append('%d/%d pairs reachable in %.2fs' % (pairs - len(failures), pairs, matrix.elapsed))
+    latencies = matrix.latencies()
+    if latencies:
+        lines.append('RTT ms: min %.2f, median %.2f, p99 %.2f, max %.2f' % (
+            latencies[0], latencies[len(latencies) // 2],
+            latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))], latencies[-1]))
+    for host, error in sorted(matrix.errors.items()):
+        lines.append('probe on %s failed: %s' % (host, error))
+    for src, dst in failures:
+        reason = (reasons or {}).get((src, dst))
+        lines.append('  %s -> %s unreachable%s' % (src, dst, ': ' + reason if reason else ''))
+    return lines
+
+def main():
+    parser = argparse.ArgumentParser(description='ICMP probe of many hosts at once')
+    parser.add_argument('--probe', action='store_true', required=True)
+    parser.add_argument('--timeout', type=float, default=TIMEOUT)
+    parser.add_argument('--window', type=int, default=WINDOW)
+    parser.add_argument('--attempts', type=int, default=ATTEMPTS)
+    parser.add_argument('targets', nargs='*')
+    args = parser.parse_args()
+    json.dump(probe(args.targets, args.timeout, args.window, args.attempts), sys.stdout)
+
+if __name__ == '__main__':
+    main()
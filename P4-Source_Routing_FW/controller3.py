@@ -1,14 +1,40 @@
 from pathlib import Path
 import json
+import re
+import time
+import argparse
 import asyncio
 import contextlib
+import ipaddress
 import finsy as fy
 import networkx as nx
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 # Define the P4 source directory
 _P4SRC = Path(__file__).parent
 
+# Election id of read-only clients, below the controller's so it stays primary
+READER_ELECTION_ID = 1
+
+# Reactive mode: packet-ins are queued per (switch, destination) and handled
+# by a fixed number of workers, each writing up to REACTIVE_BATCH routes at once
+REACTIVE_WORKERS = 4
+REACTIVE_BATCH = 64
+REACTIVE_QUEUE = 4096       # pending routes, further packet-ins are dropped
+REACTIVE_BUFFER = 8         # packets per pending route sent on once it is installed
+REACTIVE_RETRY = 5.0        # seconds before an unroutable destination is tried again
+REACTIVE_REPORT = 5.0       # seconds between statistics
+PACKET_OUT_PIPELINE = 0     # packet-out egress_port: run the packet through ipv4_lpm
+PACKET_OUT_NO_PORT = 0      # packet-out ingress_port of packets not re-injected
+
+# Proxy ARP: answers from topo.json and learned bindings, replies cached as
+# frames and limited per requester and target and per switch
+ETH_TYPE_ARP = 0x0806
+ARP_REPLY_INTERVAL = 0.1    # seconds between replies to one requester for one target
+ARP_RATE = 2000             # replies per second and switch
+ARP_BURST = 500
+ARP_CACHE_SIZE = 65536      # cached reply frames
+
 def ipv4_lpm_append_tags_and_forward(dstAddr: str, ports: list):
     """Create a table entry for IPv4 LPM with 2-9 source routing hops."""
     num_hops = len(ports)
@@ -33,6 +59,13 @@ def ipv4_lpm_append_tags_and_forward(dstAddr: str, ports: list):
 
 
 
+def decode_route(action: str, route_data: int):
+    """Return the hop ports of an append_N_tags action (inverse of the above)."""
+    match = re.search(r"append_(\d)_tags$", action)
+    if not match:
+        raise ValueError(f"{action} is not a source routing action")
+    return [(route_data >> (i * 16)) & 0x7FFF for i in range(int(match.group(1)))]
+
 def ipv4_lpm_drop_default():
     """Create default drop action for IPv4 LPM table."""
     return ~fy.P4TableEntry(
@@ -41,6 +74,39 @@ def ipv4_lpm_drop_default():
         is_default_action=True,
     )
 
+def ipv4_lpm_punt_default():
+    """Create default action sending IPv4 LPM misses to the controller."""
+    return ~fy.P4TableEntry(
+        "ipv4_lpm",
+        action=fy.Action("send_to_cpu"),
+        is_default_action=True,
+    )
+
+def packet_dst_ip(payload: bytes):
+    """Destination of an IPv4 Ethernet frame, None for anything else."""
+    if len(payload) < 34 or payload[12:14] != b"\x08\x00":
+        return None
+    return str(ipaddress.IPv4Address(payload[30:34]))
+
+def mac_bytes(mac: str):
+    return bytes(int(b, 16) for b in mac.split(":"))
+
+def parse_arp_request(payload: bytes):
+    """(sender MAC, sender IP, target IP) of an Ethernet ARP request, or None."""
+    if len(payload) < 42 or payload[12:14] != b"\x08\x06":
+        return None
+    # htype 1, ptype IPv4, hlen 6, plen 4, oper 1 (request)
+    if payload[14:22] != b"\x00\x01\x08\x00\x06\x04\x00\x01":
+        return None
+    return payload[22:28], str(ipaddress.IPv4Address(payload[28:32])), str(ipaddress.IPv4Address(payload[38:42]))
+
+def arp_reply(target_mac: bytes, target_ip: str, requester_mac: bytes, requester_ip: str):
+    """Ethernet ARP reply telling requester that target_ip is at target_mac."""
+    return (requester_mac + target_mac + b"\x08\x06"
+            + b"\x00\x01\x08\x00\x06\x04\x00\x02"
+            + target_mac + ipaddress.IPv4Address(target_ip).packed
+            + requester_mac + ipaddress.IPv4Address(requester_ip).packed)
+
 def load_topology(json_file: Path):
     """Load network topology from JSON file."""
     with open(json_file, "r") as f:
@@ -58,14 +124,86 @@ def build_graph(topology):
         )
     return graph
 
+def trace_route(topology, switch: str, ports: list):
+    """Follow a source route from its ingress switch.
+
+    Returns [(switch, out_port)] per hop. Raises ValueError when a port other
+    than the last one is not a link to another switch.
+    """
+    peers = {}
+    for link in topology["links"]:
+        peers[(link["source"], link["source_port"])] = link["target"]
+        peers[(link["target"], link["target_port"])] = link["source"]
+    hops = []
+    for i, port in enumerate(ports):
+        hops.append((switch, port))
+        if i < len(ports) - 1:
+            if (switch, port) not in peers:
+                raise ValueError(f"hop {i + 1}: port {port} of {switch} is not a switch link")
+            switch = peers[(switch, port)]
+    return hops
+
+def _lpm_network(value):
+    """IPv4Network of a dstAddr match value as finsy decodes it."""
+    if isinstance(value, tuple):
+        return ipaddress.ip_network(value, strict=False)
+    return ipaddress.ip_network(str(value), strict=False)
+
+async def read_routes(topology, p4info=_P4SRC / "source_routing.p4info.txt"):
+    """Read the installed ipv4_lpm routes of all switches.
+
+    Returns {switch: [(IPv4Network, ports)]}. Connects as a backup client, so
+    a running controller keeps its primary connection and its entries.
+    """
+    opts = fy.SwitchOptions(p4info=p4info, initial_election_id=READER_ELECTION_ID)
+
+    async def read(switch):
+        routes = []
+        async for entry in switch.read(fy.P4TableEntry("ipv4_lpm")):
+            if not entry.match or entry.action is None:
+                continue
+            try:
+                ports = decode_route(entry.action.name, entry.action.args["route_data"])
+            except (KeyError, ValueError):
+                continue
+            routes.append((_lpm_network(entry.match["dstAddr"]), ports))
+        return routes
+
+    async with contextlib.AsyncExitStack() as stack:
+        switches = {}
+        for switch in topology["switches"]:
+            name = switch["name"]
+            switches[name] = await stack.enter_async_context(
+                fy.Switch(name, f"{switch['ip']}:{switch['port']}", opts)
+            )
+        tables = await asyncio.gather(*(read(sw) for sw in switches.values()))
+    return dict(zip(switches, tables))
+
+def lookup_route(routes, dst_ip: str):
+    """Longest prefix match of dst_ip in [(IPv4Network, ports)], None on a miss."""
+    addr = ipaddress.ip_address(dst_ip)
+    best = None
+    for network, ports in routes:
+        if addr in network and (best is None or network.prefixlen > best[0].prefixlen):
+            best = (network, ports)
+    return best[1] if best else None
+
 class NetworkController:
-    def __init__(self, topology):
+    def __init__(self, topology, reactive=False):
         self.topology = topology
         self.graph = build_graph(topology)
         self.switches = {}  # Track switch connections
+        self.hosts_by_ip = {host["ip"]: host for host in topology["hosts"]}
+        # Port of a switch towards a neighbor switch
+        self.link_ports = {}
+        for link in topology["links"]:
+            self.link_ports[(link["source"], link["target"])] = link["source_port"]
+            self.link_ports[(link["target"], link["source"])] = link["target_port"]
         
-        # Initialize with default drop action for each switch
-        self.default_entries = {switch["name"]: [ipv4_lpm_drop_default()] 
+        # Initialize with default drop action for each switch, or punt
+        # misses to the controller in reactive mode
+        default = ipv4_lpm_punt_default if reactive else ipv4_lpm_drop_default
+        self.default_entries = {switch["name"]: [default()] 
                               for switch in topology["switches"]}
 
     def get_topology(self):
@@ -85,6 +223,23 @@ class NetworkController:
             print(f"Error writing to {switch_name}: {e}")
             return False
 
+    async def _write_entries(self, switch_name, entries):
+        """Write entries to a switch in one request."""
+        try:
+            await self.switches[switch_name].write(entries)
+            return None
+        except Exception as e:
+            return e
+
+    def compute_route(self, switch_name: str, dst_ip: str):
+        """Hop ports of a shortest path from a switch to the host with dst_ip."""
+        dst_host = self.hosts_by_ip.get(dst_ip)
+        if dst_host is None:
+            raise ValueError(f"unknown host {dst_ip}")
+        path = nx.shortest_path(self.graph, switch_name, dst_host["connected_to"])
+        ports = [self.link_ports[(u, v)] for u, v in zip(path, path[1:])]
+        return ports + [dst_host["port"]]
+
     async def initialize_switches(self):
         """Initialize all switches with default entries."""
         for switch_name, entries in self.default_entries.items():
@@ -163,10 +318,273 @@ class NetworkController:
         except Exception as e:
             print(f"Counter read error: {e}")
             
+async def ainput(prompt: str):
+    """input() in a thread, so packet-ins are served while waiting."""
+    return await asyncio.to_thread(input, prompt)
+
+class PacketOutBatcher:
+    """Collect packet-outs per switch and write them in one request per loop turn."""
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.queued = defaultdict(list)
+
+    def send(self, switch_name, payload, egress_port, ingress_port=PACKET_OUT_NO_PORT):
+        """ingress_port: port the packet arrived on, for packets re-injected
+        into the pipeline (egress_port PACKET_OUT_PIPELINE)."""
+        if not self.queued[switch_name]:
+            asyncio.ensure_future(self._flush(switch_name))
+        self.queued[switch_name].append(
+            fy.P4PacketOut(payload, egress_port=egress_port, ingress_port=ingress_port))
+
+    async def _flush(self, switch_name):
+        await asyncio.sleep(0)
+        packets = self.queued.pop(switch_name, [])
+        if packets:
+            error = await self.controller._write_entries(switch_name, packets)
+            if error is not None:
+                print(f"Error sending {len(packets)} packets on {switch_name}: {error}")
+
+class ReactiveStats:
+    """Packet-in and route install counters of the reactive mode."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.packet_ins = 0
+        self.duplicates = 0
+        self.ignored = 0
+        self.dropped = 0
+        self.routes = 0
+        self.failures = 0
+        self.batches = 0
+        self.first_packet = []  # seconds from first packet-in to its packet-out
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start
+        line = (f"{self.packet_ins} packet-ins ({self.packet_ins / elapsed:.0f}/s), "
+                f"{self.duplicates} for pending routes, {self.ignored} ignored, "
+                f"{self.dropped} dropped; {self.routes} routes in {self.batches} batches, "
+                f"{self.failures} failed")
+        if self.first_packet:
+            times = sorted(self.first_packet)
+            line += (f"; time to first packet ms: median {1000 * times[len(times) // 2]:.1f}, "
+                     f"p99 {1000 * times[min(len(times) - 1, int(len(times) * 0.99))]:.1f}, "
+                     f"max {1000 * times[-1]:.1f}")
+        return line
+
+class ReactiveRouter:
+    """Install a shortest source route for every destination that misses ipv4_lpm.
+
+    A packet-in for a (switch, destination) whose route is already being
+    installed is only buffered, so a burst towards one host costs one route
+    computation and one write. Routes are installed by a fixed pool of
+    workers; each takes whatever is queued, up to a batch, and writes the
+    routes of one switch in a single request. Buffered packets are sent back
+    through the pipeline once their route exists.
+    """
+
+    def __init__(self, controller, workers=REACTIVE_WORKERS, batch=REACTIVE_BATCH):
+        self.controller = controller
+        self.workers = workers
+        self.batch = batch
+        self.queue = asyncio.Queue(REACTIVE_QUEUE)
+        self.pending = {}   # (switch, dst_ip) -> (first packet-in time, [(payload, ingress port)])
+        self.installed = set()
+        self.failed = {}    # (switch, dst_ip) -> time of the failure
+        self.packet_outs = PacketOutBatcher(controller)
+        self.stats = ReactiveStats()
+
+    def packet_in(self, switch_name, packet):
+        """Queue the route for a punted packet, called for every packet-in."""
+        self.stats.packet_ins += 1
+        dst_ip = packet_dst_ip(packet.payload)
+        if dst_ip is None:
+            self.stats.ignored += 1
+            return
+        key = (switch_name, dst_ip)
+        if key in self.installed:
+            # Punted before the route was written, send it on
+            self.packet_outs.send(switch_name, packet.payload, PACKET_OUT_PIPELINE,
+                                  packet.metadata["ingress_port"])
+            return
+        if key in self.pending:
+            self.stats.duplicates += 1
+            buffered = self.pending[key][1]
+            if len(buffered) < REACTIVE_BUFFER:
+                buffered.append((packet.payload, packet.metadata["ingress_port"]))
+            return
+        if time.perf_counter() - self.failed.get(key, -REACTIVE_RETRY) < REACTIVE_RETRY:
+            self.stats.ignored += 1
+            return
+        try:
+            self.queue.put_nowait(key)
+        except asyncio.QueueFull:
+            self.stats.dropped += 1
+            return
+        self.pending[key] = (time.perf_counter(), [(packet.payload, packet.metadata["ingress_port"])])
+
+    async def _send_on(self, switch_name, buffered):
+        # The original ingress port goes along, so the pipeline (e.g. the
+        # firewall's check_ports) sees the packet as coming from its host
+        packets = [fy.P4PacketOut(payload, egress_port=PACKET_OUT_PIPELINE, ingress_port=in_port)
+                   for payload, in_port in buffered]
+        return await self.controller._write_entries(switch_name, packets)
+
+    async def _install(self, keys):
+        """Compute and write the routes of a batch of keys, per switch."""
+        entries = defaultdict(list)
+        for key in keys:
+            switch_name, dst_ip = key
+            try:
+                ports = self.controller.compute_route(switch_name, dst_ip)
+                entries[switch_name].append((key, ipv4_lpm_append_tags_and_forward(dst_ip, ports)))
+            except (ValueError, nx.NetworkXException) as e:
+                print(f"No route {switch_name} -> {dst_ip}: {e}")
+                self._fail(key)
+        for switch_name, items in entries.items():
+            error = await self.controller._write_entries(switch_name, [entry for _, entry in items])
+            self.stats.batches += 1
+            if error is not None:
+                print(f"Error writing {len(items)} routes to {switch_name}: {error}")
+                for key, _ in items:
+                    self._fail(key)
+                continue
+            for key, _ in items:
+                first_seen, buffered = self.pending.pop(key)
+                self.installed.add(key)
+                self.stats.routes += 1
+                if await self._send_on(switch_name, buffered) is None:
+                    self.stats.first_packet.append(time.perf_counter() - first_seen)
+
+    def _fail(self, key):
+        self.pending.pop(key, None)
+        self.failed[key] = time.perf_counter()
+        self.stats.failures += 1
+
+    async def _worker(self):
+        while True:
+            keys = [await self.queue.get()]
+            while len(keys) < self.batch and not self.queue.empty():
+                keys.append(self.queue.get_nowait())
+            try:
+                await self._install(keys)
+            finally:
+                for _ in keys:
+                    self.queue.task_done()
+
+    async def _read_packets(self, switch_name, switch):
+        async for packet in switch.read_packets(queue_size=REACTIVE_QUEUE, eth_types={0x0800}):
+            self.packet_in(switch_name, packet)
+
+    async def _report(self, interval):
+        last = None
+        while True:
+            await asyncio.sleep(interval)
+            if self.stats.packet_ins != last:
+                last = self.stats.packet_ins
+                print(self.stats.summary())
+
+    async def run(self, interval=REACTIVE_REPORT):
+        """Serve packet-ins of all switches until cancelled."""
+        tasks = [self._read_packets(name, switch) for name, switch in self.controller.switches.items()]
+        tasks += [self._worker() for _ in range(self.workers)]
+        tasks.append(self._report(interval))
+        await asyncio.gather(*tasks)
+
+class ProxyArp:
+    """Answer the ARP requests of all hosts from the controller.
+
+    Bindings come from topo.json and from the sender of every request, so
+    hosts need no static ARP entries. Reply frames are cached per requester
+    and target, a requester gets at most one reply per target every
+    ARP_REPLY_INTERVAL, and each switch at most ARP_RATE replies per second.
+    """
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.bindings = {host["ip"]: mac_bytes(host["mac"]) for host in controller.topology["hosts"]}
+        self.replies = OrderedDict()  # (target IP, target MAC, requester MAC, requester IP) -> frame
+        self.last_reply = {}          # (switch, requester IP, target IP) -> time
+        self.tokens = {}              # switch -> (tokens, time)
+        self.packet_outs = PacketOutBatcher(controller)
+        self.counts = defaultdict(int)
+
+    def _allowed(self, switch_name, requester_ip, target_ip, now):
+        key = (switch_name, requester_ip, target_ip)
+        if now - self.last_reply.get(key, -ARP_REPLY_INTERVAL) < ARP_REPLY_INTERVAL:
+            return False
+        tokens, last = self.tokens.get(switch_name, (ARP_BURST, now))
+        tokens = min(ARP_BURST, tokens + (now - last) * ARP_RATE)
+        if tokens < 1:
+            self.tokens[switch_name] = (tokens, now)
+            return False
+        self.tokens[switch_name] = (tokens - 1, now)
+        self.last_reply[key] = now
+        return True
+
+    def packet_in(self, switch_name, packet):
+        """Answer one punted ARP request out of the port it came in on."""
+        request = parse_arp_request(packet.payload)
+        if request is None:
+            self.counts["ignored"] += 1
+            return
+        self.counts["requests"] += 1
+        requester_mac, requester_ip, target_ip = request
+        if requester_ip != "0.0.0.0" and self.bindings.get(requester_ip) != requester_mac:
+            self.bindings[requester_ip] = requester_mac
+            self.counts["learned"] += 1
+        target_mac = self.bindings.get(target_ip)
+        if target_mac is None:
+            self.counts["unknown"] += 1
+            return
+        if not self._allowed(switch_name, requester_ip, target_ip, time.perf_counter()):
+            self.counts["limited"] += 1
+            return
+        key = (target_ip, target_mac, requester_mac, requester_ip)
+        frame = self.replies.get(key)
+        if frame is None:
+            frame = self.replies[key] = arp_reply(target_mac, target_ip, requester_mac, requester_ip)
+            if len(self.replies) > ARP_CACHE_SIZE:
+                self.replies.popitem(last=False)
+        else:
+            self.replies.move_to_end(key)
+            self.counts["cached"] += 1
+        self.packet_outs.send(switch_name, frame, packet.metadata["ingress_port"])
+        self.counts["replies"] += 1
+
+    def summary(self):
+        c = self.counts
+        return (f"ARP: {c['requests']} requests, {c['replies']} replies ({c['cached']} cached), "
+                f"{c['unknown']} unknown targets, {c['limited']} rate limited, "
+                f"{c['learned']} bindings learned, {len(self.bindings)} known")
+
+    async def _read_packets(self, switch_name, switch):
+        async for packet in switch.read_packets(queue_size=REACTIVE_QUEUE, eth_types={ETH_TYPE_ARP}):
+            self.packet_in(switch_name, packet)
+
+    async def run(self):
+        """Answer ARP requests of all switches until cancelled."""
+        await asyncio.gather(*(self._read_packets(name, switch)
+                               for name, switch in self.controller.switches.items()))
+
+async def _cancel(task):
+    task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await task
+
 async def main():
     """Main control plane program."""
+    parser = argparse.ArgumentParser(description="Source routing controller")
+    parser.add_argument("--reactive", action="store_true",
+                        help="install shortest routes for packets that miss ipv4_lpm")
+    parser.add_argument("--workers", type=int, default=REACTIVE_WORKERS)
+    parser.add_argument("--batch", type=int, default=REACTIVE_BATCH)
+    parser.add_argument("--proxy-arp", action="store_true",
+                        help="answer ARP requests, hosts need no static ARP entries")
+    args = parser.parse_args()
+
     topology = load_topology(_P4SRC / "topo.json")
-    controller = NetworkController(topology)
+    controller = NetworkController(topology, reactive=args.reactive)
 
     # Configure switch options
     opts = fy.SwitchOptions(
@@ -186,36 +604,54 @@ async def main():
         # Initialize switch tables
         await controller.initialize_switches()
 
+        proxy_arp = None
+        if args.proxy_arp:
+            proxy_arp = ProxyArp(controller)
+            stack.push_async_callback(_cancel, asyncio.ensure_future(proxy_arp.run()))
+            stack.callback(lambda: print(proxy_arp.summary()))
+
+        if args.reactive:
+            router = ReactiveRouter(controller, args.workers, args.batch)
+            print(f"Reactive mode, {args.workers} workers, batches of up to {args.batch}")
+            try:
+                await router.run()
+            finally:
+                print(router.stats.summary())
+            return
+
         # Interactive CLI
         while True:
             try:
-                cmd = input("\nCommand (add/query/exit): ").strip().lower()
+                cmd = (await ainput("\nCommand (add/query/exit): ")).strip().lower()
                 
                 # In the main loop's "add" command case:
                 if cmd == "add":
-                    src_ip = input("Source IP: ")
-                    dst_ip = input("Destination IP: ")
-                    ports_input = input("Hop ports (comma-separated, 2-9 hops): ")
+                    src_ip = await ainput("Source IP: ")
+                    dst_ip = await ainput("Destination IP: ")
+                    ports_input = await ainput("Hop ports (comma-separated, 2-9 hops): ")
                     try:
                         ports = [int(p.strip()) for p in ports_input.split(",")]
                         await controller.add_communication_path(src_ip, dst_ip, ports)
                     except ValueError:
                         print("Invalid port numbers - must be integers")
                 elif cmd == "portcheck":  # New command
-                    switch = input("Switch name: ")
-                    in_port = int(input("Ingress port: "))
-                    out_port = int(input("Egress port: "))
-                    direction = int(input("Direction (0 or 1): "))
+                    switch = await ainput("Switch name: ")
+                    in_port = int(await ainput("Ingress port: "))
+                    out_port = int(await ainput("Egress port: "))
+                    direction = int(await ainput("Direction (0 or 1): "))
                     await controller.update_port_check(switch, in_port, out_port, direction)
                     
                 elif cmd == "query":
-                    switch = input("Switch name: ")
+                    switch = await ainput("Switch name: ")
                     await controller.query_table_entries(switch)
 
                 elif cmd == "counter":
-                    switch = input("Switch name: ")
+                    switch = await ainput("Switch name: ")
                     await controller.check_table_matches(switch)
                     
+                elif cmd == "arp":
+                    print(proxy_arp.summary() if proxy_arp else "Proxy ARP is off (--proxy-arp)")
+
                 elif cmd == "exit":
                     break
                 else:
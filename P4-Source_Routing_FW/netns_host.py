@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""Mininet host without a resident shell, for emulations with many hosts.
+
+A NetnsHost is a named network namespace (ip netns) and nothing else.
+Every command forks /bin/sh, which enters the namespace with setns() before
+exec, so an idle host costs no process, pty or bash memory. Mininet moves
+and creates interfaces with "ip link ... netns <pid>", and ip accepts the
+namespace name there, so pid is the namespace name and links to
+ONOSBmv2Switch ports are wired as usual."""
+import os
+import select
+import signal
+import ctypes
+from subprocess import PIPE, STDOUT
+
+from mininet.node import Host
+from mininet.log import debug, info, warn
+from mininet.util import quietRun, encode
+
+NETNS_DIR = '/var/run/netns'
+NETNS_PREFIX = 'mn-'
+CLONE_NEWNET = 0x40000000
+SHELL = '/bin/sh'
+
+_libc = ctypes.CDLL(None, use_errno=True)
+
+def setns(fd, nstype=CLONE_NEWNET):
+    """Move the calling thread into the namespace behind fd"""
+    if _libc.setns(fd, nstype) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+class NetnsHost(Host):
+    """Host that is a bare network namespace, commands run on demand"""
+
+    def startShell(self, mnopts=None):
+        self.netns = NETNS_PREFIX + self.name
+        path = os.path.join(NETNS_DIR, self.netns)
+        if os.path.exists(path):
+            quietRun('ip netns del %s' % self.netns)
+        output = quietRun('ip netns add %s' % self.netns)
+        if output:
+            raise Exception("Error creating namespace %s: %s" % (self.netns, output))
+        self.nsfd = os.open(path, os.O_RDONLY)
+        self.pid = self.netns
+        self.proc = None
+        self.stdin = self.stdout = None
+        self.execed = False
+        self.lastCmd = None
+        self.lastPid = None
+        self.readbuf = ''
+        self.waiting = False
+
+    def nsPopen(self, cmd, **params):
+        fd = self.nsfd
+        params.setdefault('start_new_session', True)
+        return self._popen(cmd, preexec_fn=lambda: setns(fd), **params)
+
+    def sendCmd(self, *args, **kwargs):
+        assert self.nsfd is not None and not self.waiting
+        if len(args) == 1 and isinstance(args[0], list):
+            args = args[0]
+        cmd = ' '.join(str(c) for c in args) or 'true'
+        self.lastCmd = cmd
+        self.proc = self.nsPopen([SHELL, '-c', cmd], stdin=PIPE, stdout=PIPE, stderr=STDOUT)
+        self.stdin, self.stdout = self.proc.stdin, self.proc.stdout
+        self.lastPid = self.proc.pid
+        self.waiting = True
+
+    def monitor(self, timeoutms=None, findPid=True):
+        if not self.waiting:
+            return ''
+        timeout = None if timeoutms is None else timeoutms / 1000.0
+        if not select.select([self.stdout], [], [], timeout)[0]:
+            return ''
+        data = os.read(self.stdout.fileno(), 4096)
+        if data:
+            return self.decoder.decode(data)
+        # EOF: the command is done
+        self.proc.wait()
+        self.stdin.close()
+        self.stdout.close()
+        self.proc = None
+        self.waiting = False
+        return ''
+
+    def cmd(self, *args, **kwargs):
+        verbose = kwargs.get('verbose', False)
+        log = info if verbose else debug
+        log('*** %s : %s\n' % (self.name, args))
+        if self.nsfd is None:
+            warn('(%s exited - ignoring cmd%s)\n' % (self, args))
+            return None
+        self.sendCmd(*args, **kwargs)
+        return self.waitOutput(verbose)
+
+    def write(self, data):
+        if self.proc is not None:
+            os.write(self.stdin.fileno(), encode(data))
+
+    def sendInt(self, intr=chr(3)):
+        if self.proc is not None:
+            os.killpg(self.proc.pid, signal.SIGINT)
+
+    def popen(self, *args, **kwargs):
+        """Popen() in our namespace, same arguments as Node.popen()"""
+        defaults = {'stdout': PIPE, 'stderr': PIPE}
+        defaults.update(kwargs)
+        defaults.pop('mncmd', None)
+        shell = defaults.pop('shell', False)
+        if len(args) == 1 and isinstance(args[0], list):
+            cmd = args[0]
+        elif len(args) == 1:
+            cmd = [args[0]] if shell else args[0].split()
+        else:
+            cmd = list(args)
+        if shell:
+            cmd = [SHELL, '-c', ' '.join(cmd)]
+        return self.nsPopen(cmd, **defaults)
+
+    def terminate(self):
+        if self.proc is not None and self.proc.poll() is None:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+            self.proc.wait()
+        self.proc = None
+        self.waiting = False
+        if self.nsfd is not None:
+            os.close(self.nsfd)
+            self.nsfd = None
+            quietRun('ip netns del %s' % self.netns)
+        self.cleanup()
+
+    @classmethod
+    def cleanupAll(cls):
+        """Remove namespaces left behind by an earlier run"""
+        if not os.path.isdir(NETNS_DIR):
+            return
+        for name in os.listdir(NETNS_DIR):
+            if name.startswith(NETNS_PREFIX):
+                quietRun('ip netns del %s' % name)
+
+def memoryPerHost(hosts):
+    """Resident memory (kB) of processes backing each host: the shell for a
+    Mininet Host, nothing for an idle NetnsHost"""
+    usage = {}
+    for host in hosts:
+        if isinstance(host, NetnsHost) or not host.shell:
+            usage[host.name] = 0
+            continue
+        try:
+            with open('/proc/%d/status' % host.shell.pid) as f:
+                rss = [l for l in f if l.startswith('VmRSS:')]
+            usage[host.name] = int(rss[0].split()[1]) if rss else 0
+        except (IOError, OSError, ValueError):
+            usage[host.name] = 0
+    return usage
@@ -0,0 +1,297 @@
+"""Fast analysis of bmv2 --pcap captures (and any Ethernet pcap).
+
+The capture is memory-mapped and walked once to build an index of record
+offsets. Headers are then decoded for all packets at once with numpy: the
+first SNAP_LEN bytes of every packet are gathered into a matrix and Ethernet,
+the source routing stack, IPv4 and TCP/UDP ports become columns of a
+structured array. Searching, per-flow aggregation and matching the same
+packet in the captures of two switches work on those columns, fast enough
+for millions of packets.
+
+    python pcap_index.py 1_out.pcap --flows 10
+    python pcap_index.py s1/2_out.pcap s2/1_in.pcap --latency
+"""
+from pathlib import Path
+import mmap
+import struct
+import argparse
+import time
+import numpy as np
+
+# Must match source_routing.p4
+TYPE_IPV4 = 0x800
+TYPE_SRCROUTING = 0x1234
+TYPE_TCP = 6
+TYPE_UDP = 17
+
+# Source routing tags decoded per packet. Deliberately more than MAX_HOPS (9)
+# of source_routing.p4, so that a capture of a longer, e.g. host-injected,
+# stack shows all of its tags instead of cutting it off
+MAX_HOPS = 16
+
+LINKTYPE_ETHERNET = 1
+PCAP_HEADER_LEN = 24
+RECORD = {"<": struct.Struct("<IIII"), ">": struct.Struct(">IIII")}
+# magic -> (byte order, timestamp units per second)
+MAGICS = {
+    b"\xd4\xc3\xb2\xa1": ("<", 10**6), b"\xa1\xb2\xc3\xd4": (">", 10**6),
+    b"\x4d\x3c\xb2\xa1": ("<", 10**9), b"\xa1\xb2\x3c\x4d": (">", 10**9),
+}
+ETH_LEN = 14
+# Ethernet, a full tag stack, IPv4 with options and the first 16 TCP bytes
+SNAP_LEN = ETH_LEN + 2 * MAX_HOPS + 60 + 16
+CHUNK = 1 << 15  # packets decoded per gather, bounds the gather matrices
+
+PACKET_DTYPE = np.dtype([
+    ("ts", "i8"),  # ns since the epoch
+    ("caplen", "u4"), ("wirelen", "u4"),
+    ("eth_dst", "u8"), ("eth_src", "u8"), ("eth_type", "u2"),
+    ("hops", "u1"), ("route", "u2", (MAX_HOPS,)),
+    ("ip_src", "u4"), ("ip_dst", "u4"), ("ip_id", "u2"),
+    ("ttl", "u1"), ("proto", "u1"), ("ip_len", "u2"),
+    ("sport", "u2"), ("dport", "u2"), ("tcp_seq", "u4"), ("tcp_flags", "u1"),
+])
+
+FLOW_DTYPE = np.dtype([
+    ("ip_src", "u4"), ("ip_dst", "u4"), ("sport", "u2"), ("dport", "u2"),
+    ("proto", "u1"), ("packets", "u8"), ("bytes", "u8"),
+    ("first", "i8"), ("last", "i8"),
+])
+
+
+class PcapIndex:
+    """Memory-mapped pcap file with the offset of every packet record."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic = self.map[:4]
+        if magic not in MAGICS or len(self.map) < PCAP_HEADER_LEN:
+            raise ValueError(f"{path}: not a pcap file (pcapng is not supported)")
+        self.endian, self.units = MAGICS[magic]
+        linktype = struct.unpack_from(self.endian + "I", self.map, 20)[0]
+        if linktype & 0xFFFF != LINKTYPE_ETHERNET:
+            raise ValueError(f"{path}: link type {linktype} is not Ethernet")
+        self.offsets, self.caplen, self.wirelen, self.ts = self._index()
+
+    def _index(self):
+        """Walk the record headers once; the packet data is never copied."""
+        record = RECORD[self.endian]
+        size = len(self.map)
+        offsets, caplens, wirelens, secs, fracs = [], [], [], [], []
+        offset = PCAP_HEADER_LEN
+        while offset + record.size <= size:
+            sec, frac, caplen, wirelen = record.unpack_from(self.map, offset)
+            offset += record.size
+            if offset + caplen > size:
+                break  # truncated last record
+            offsets.append(offset)
+            caplens.append(caplen)
+            wirelens.append(wirelen)
+            secs.append(sec)
+            fracs.append(frac)
+            offset += caplen
+        ts = (np.array(secs, dtype=np.int64) * 10**9
+              + np.array(fracs, dtype=np.int64) * (10**9 // self.units))
+        return (np.array(offsets, dtype=np.int64), np.array(caplens, dtype=np.uint32),
+                np.array(wirelens, dtype=np.uint32), ts)
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def packet(self, i: int) -> bytes:
+        """Raw bytes of packet i, e.g. for a closer look with scapy."""
+        start = int(self.offsets[i])
+        return self.map[start:start + int(self.caplen[i])]
+
+    def snap(self, start: int, stop: int) -> np.ndarray:
+        """(n, SNAP_LEN) matrix of the first bytes of packets start..stop,
+        zero padded past the end of each packet."""
+        data = np.frombuffer(self.map, dtype=np.uint8)
+        cols = np.arange(SNAP_LEN, dtype=np.int64)
+        pos = self.offsets[start:stop, None] + cols
+        valid = cols < self.caplen[start:stop, None]
+        return np.where(valid, data[np.minimum(pos, len(data) - 1)], 0).astype(np.uint8)
+
+    def decode(self) -> np.ndarray:
+        """All packets as a PACKET_DTYPE array."""
+        packets = np.zeros(len(self), dtype=PACKET_DTYPE)
+        packets["ts"] = self.ts
+        packets["caplen"] = self.caplen
+        packets["wirelen"] = self.wirelen
+        for start in range(0, len(self), CHUNK):
+            stop = min(start + CHUNK, len(self))
+            decode_headers(self.snap(start, stop), packets[start:stop])
+        return packets
+
+    def close(self):
+        self.map.close()
+
+
+def _be(snap: np.ndarray, pos, width: int) -> np.ndarray:
+    """Big-endian field of width bytes at per-row byte offset pos."""
+    rows = np.arange(len(snap))
+    pos = np.minimum(pos, SNAP_LEN - width)
+    value = np.zeros(len(snap), dtype=np.uint64)
+    for i in range(width):
+        value = (value << np.uint64(8)) | snap[rows, pos + i]
+    return value
+
+
+def decode_headers(snap: np.ndarray, out: np.ndarray):
+    """Fill the header columns of out from the snap matrix, one numpy
+    operation per field for all packets."""
+    n = len(snap)
+    zero = np.zeros(n, dtype=np.int64)
+    out["eth_dst"] = _be(snap, zero, 6)
+    out["eth_src"] = _be(snap, zero + 6, 6)
+    eth_type = _be(snap, zero + 12, 2)
+    out["eth_type"] = eth_type
+
+    # Pop the tag stack: a packet stays active until its bottom of stack tag
+    hops = np.zeros(n, dtype=np.int64)
+    active = eth_type == TYPE_SRCROUTING
+    for hop in range(MAX_HOPS):
+        if not active.any():
+            break
+        pos = ETH_LEN + 2 * hop
+        tag = (snap[:, pos].astype(np.uint16) << 8) | snap[:, pos + 1]
+        out["route"][:, hop] = np.where(active, tag & 0x7FFF, 0)
+        hops += active
+        active &= (tag >> 15) == 0
+    out["hops"] = hops
+    l3 = ETH_LEN + 2 * hops
+    first = snap[np.arange(n), np.minimum(l3, SNAP_LEN - 1)]
+    # The last tag leaves IPv4 behind it (parse_srcRouting in source_routing.p4)
+    ipv4 = ((eth_type == TYPE_IPV4) | ((eth_type == TYPE_SRCROUTING) & ~active)) \
+        & ((first >> 4) == 4)
+
+    ihl = (first & 0x0F).astype(np.int64) * 4
+    out["ip_len"] = np.where(ipv4, _be(snap, l3 + 2, 2), 0)
+    out["ip_id"] = np.where(ipv4, _be(snap, l3 + 4, 2), 0)
+    out["ttl"] = np.where(ipv4, _be(snap, l3 + 8, 1), 0)
+    proto = np.where(ipv4, _be(snap, l3 + 9, 1), 0)
+    out["proto"] = proto
+    out["ip_src"] = np.where(ipv4, _be(snap, l3 + 12, 4), 0)
+    out["ip_dst"] = np.where(ipv4, _be(snap, l3 + 16, 4), 0)
+
+    l4 = l3 + ihl
+    ports = ipv4 & ((proto == TYPE_TCP) | (proto == TYPE_UDP))
+    tcp = ipv4 & (proto == TYPE_TCP)
+    out["sport"] = np.where(ports, _be(snap, l4, 2), 0)
+    out["dport"] = np.where(ports, _be(snap, l4 + 2, 2), 0)
+    out["tcp_seq"] = np.where(tcp, _be(snap, l4 + 4, 4), 0)
+    out["tcp_flags"] = np.where(tcp, _be(snap, l4 + 13, 1), 0)
+
+
+def read(path: Path) -> np.ndarray:
+    """Index and decode a capture in one go."""
+    index = PcapIndex(path)
+    try:
+        return index.decode()
+    finally:
+        index.close()
+
+
+def ip(address: str) -> int:
+    """Dotted quad as the integer stored in the ip_src/ip_dst columns."""
+    return int.from_bytes(bytes(int(b) for b in address.split(".")), "big")
+
+
+def select(packets: np.ndarray, **conditions) -> np.ndarray:
+    """Packets whose columns equal all given values, e.g.
+    select(p, ip_src=ip("10.0.0.1"), dport=80)."""
+    mask = np.ones(len(packets), dtype=bool)
+    for column, value in conditions.items():
+        mask &= packets[column] == value
+    return packets[mask]
+
+
+def flows(packets: np.ndarray) -> np.ndarray:
+    """Packets, bytes, first and last timestamp per 5-tuple, biggest first."""
+    packets = packets[packets["ip_len"] != 0]
+    addrs = (packets["ip_src"].astype(np.uint64) << 32) | packets["ip_dst"]
+    rest = ((packets["sport"].astype(np.uint64) << 24)
+            | (packets["dport"].astype(np.uint64) << 8) | packets["proto"])
+    order = np.lexsort((packets["ts"], rest, addrs))
+    addrs, rest, sorted_packets = addrs[order], rest[order], packets[order]
+    if not len(order):
+        return np.zeros(0, dtype=FLOW_DTYPE)
+    start = np.flatnonzero(np.r_[True, (addrs[1:] != addrs[:-1]) | (rest[1:] != rest[:-1])])
+    end = np.r_[start[1:], len(order)] - 1
+    first = sorted_packets[start]
+    result = np.zeros(len(start), dtype=FLOW_DTYPE)
+    for column in ("ip_src", "ip_dst", "sport", "dport", "proto"):
+        result[column] = first[column]
+    result["packets"] = end - start + 1
+    result["bytes"] = np.add.reduceat(sorted_packets["wirelen"].astype(np.uint64), start)
+    result["first"] = first["ts"]
+    result["last"] = sorted_packets["ts"][end]
+    return result[np.argsort(-result["bytes"].astype(np.int64), kind="stable")]
+
+
+def packet_keys(packets: np.ndarray) -> np.ndarray:
+    """64-bit hash of the fields a switch does not change (addresses, IP id,
+    protocol, ports, TCP sequence), to find one packet in several captures."""
+    mul = [np.uint64(0x9E3779B97F4A7C15), np.uint64(0xC2B2AE3D27D4EB4F),
+           np.uint64(0x165667B19E3779F9)]
+    a = (packets["ip_src"].astype(np.uint64) << 32) | packets["ip_dst"]
+    b = ((packets["ip_id"].astype(np.uint64) << 48) | (packets["proto"].astype(np.uint64) << 32)
+         | (packets["sport"].astype(np.uint64) << 16) | packets["dport"])
+    c = packets["tcp_seq"].astype(np.uint64)
+    with np.errstate(over="ignore"):
+        key = a * mul[0] ^ b * mul[1] ^ c * mul[2]
+        return key ^ (key >> np.uint64(29))
+
+
+def hop_latency(upstream: np.ndarray, downstream: np.ndarray) -> np.ndarray:
+    """ns from a packet's first appearance in upstream to its first
+    appearance in downstream, for every IPv4 packet found in both."""
+    up = upstream[upstream["ip_len"] != 0]
+    down = downstream[downstream["ip_len"] != 0]
+    up_keys, up_first = np.unique(packet_keys(up), return_index=True)
+    down_keys, down_first = np.unique(packet_keys(down), return_index=True)
+    _, i, j = np.intersect1d(up_keys, down_keys, assume_unique=True, return_indices=True)
+    return down["ts"][down_first[j]] - up["ts"][up_first[i]]
+
+
+def _ip_str(value: int) -> str:
+    return ".".join(str(b) for b in int(value).to_bytes(4, "big"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index and decode pcap captures")
+    parser.add_argument("pcap", nargs="+", type=Path)
+    parser.add_argument("--flows", type=int, default=10, help="biggest flows to show")
+    parser.add_argument("--latency", action="store_true",
+                        help="latency between consecutive captures (same packets)")
+    args = parser.parse_args()
+
+    captures = []
+    for path in args.pcap:
+        start = time.perf_counter()
+        packets = read(path)
+        elapsed = time.perf_counter() - start
+        captures.append(packets)
+        routed = int((packets["hops"] > 0).sum())
+        print(f"{path}: {len(packets)} packets ({routed} source routed) "
+              f"decoded in {elapsed:.2f}s")
+        for flow in flows(packets)[:args.flows]:
+            print(f"  {_ip_str(flow['ip_src'])}:{flow['sport']} -> "
+                  f"{_ip_str(flow['ip_dst'])}:{flow['dport']} proto {flow['proto']}: "
+                  f"{flow['packets']} packets, {flow['bytes']} bytes")
+
+    if args.latency:
+        for (a, up), (b, down) in zip(zip(args.pcap, captures), zip(args.pcap[1:], captures[1:])):
+            delta = hop_latency(up, down) / 1000.0
+            if not len(delta):
+                print(f"{a} -> {b}: no packets in common")
+                continue
+            p50, p99 = np.percentile(delta, [50, 99])
+            print(f"{a} -> {b}: {len(delta)} packets, latency us "
+                  f"p50 {p50:.1f} p99 {p99:.1f} max {delta.max():.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+"""Throughput of many host pairs at the same time, broken down by the
+number of source routing tags on their path.
+
+One receiver process runs in every destination host and one sender process
+in every source host, all started at once. They agree on a wall-clock
+start time a little in the future (all namespaces share the clock):
+senders connect before it, then send for DURATION seconds, and receivers
+only count the bytes that arrive inside that window, so every pair is
+measured over the same interval no matter when its process came up.
+
+    pairs = permutationPairs(net.hosts, seed=1)
+    result = runThroughput(pairs)
+    hops = hopCounts(pairs, topology, connectivity_check.readRoutes(topology))
+    print("\\n".join(resultLines(result, hops)))
+
+The hop count of a pair is the number of tags (append_N_tags) of the route
+installed on its ingress switch, i.e. the srcRoutes headers the packet
+carries into the network."""
+import os
+import sys
+import json
+import time
+import errno
+import random
+import socket
+import argparse
+import selectors
+import subprocess
+from collections import deque, defaultdict
+
+PORT = 5201
+DURATION = 5.0       # seconds of traffic
+START_LEAD = 1.0     # seconds between launching the processes and the start
+LEAD_PER_PROC = 0.01 # more lead for more processes to launch
+GRACE = 0.5          # receivers stay up this long after the window
+CONNECT_RETRY = 0.05 # seconds between connect attempts before the start
+LATE_WARNING = 0.01  # of the window, a later sender start is reported
+BUFFER = 1 << 17
+
+def receive(port, start, duration, grace=GRACE):
+    """Count the bytes every sender IP delivers in [start, start + duration)"""
+    lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    lsock.bind(('', port))
+    lsock.listen(1024)
+    lsock.setblocking(False)
+    sel = selectors.DefaultSelector()
+    sel.register(lsock, selectors.EVENT_READ)
+    received = {}
+    buf = bytearray(BUFFER)
+    end = start + duration
+    stop = end + grace
+    while True:
+        now = time.time()
+        if now >= stop:
+            break
+        for key, _ in sel.select(stop - now):
+            if key.fileobj is lsock:
+                conn, addr = lsock.accept()
+                conn.setblocking(False)
+                sel.register(conn, selectors.EVENT_READ, addr[0])
+                received.setdefault(addr[0], 0)
+                continue
+            try:
+                n = key.fileobj.recv_into(buf)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    continue
+                n = 0
+            if not n:
+                sel.unregister(key.fileobj)
+                key.fileobj.close()
+            elif start <= time.time() < end:
+                received[key.data] += n
+    for key in list(sel.get_map().values()):
+        key.fileobj.close()
+    sel.close()
+    return received
+
+def connectAll(targets, port, deadline):
+    """Connect to all targets at once, retrying refused connections (the
+    receiver is not up yet) until deadline; returns {target: socket} and
+    {target: error}"""
+    sel = selectors.DefaultSelector()
+    conns, errors, retry = {}, {}, {}
+
+    def attempt(target):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        err = sock.connect_ex((target, port))
+        if err in (0, errno.EINPROGRESS):
+            sel.register(sock, selectors.EVENT_WRITE, target)
+        else:
+            sock.close()
+            errors[target] = os.strerror(err)
+            retry[target] = time.time() + CONNECT_RETRY
+
+    for target in targets:
+        attempt(target)
+    while (sel.get_map() or retry) and time.time() < deadline:
+        now = time.time()
+        timeout = min([deadline - now] + [at - now for at in retry.values()])
+        for key, _ in sel.select(max(timeout, 0)):
+            sel.unregister(key.fileobj)
+            err = key.fileobj.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                key.fileobj.close()
+                errors[key.data] = os.strerror(err)
+                retry[key.data] = time.time() + CONNECT_RETRY
+            else:
+                conns[key.data] = key.fileobj
+                errors.pop(key.data, None)
+        for target, at in list(retry.items()):
+            if at <= time.time():
+                del retry[target]
+                attempt(target)
+    for key in list(sel.get_map().values()):
+        key.fileobj.close()
+        errors[key.data] = 'connect timed out'
+    sel.close()
+    return conns, errors
+
+def send(targets, port, start, duration):
+    """Send to all targets at once from start to start + duration; returns
+    the bytes sent per target, connect errors and how late sending began"""
+    conns, errors = connectAll(targets, port, start)
+    sent = dict.fromkeys(conns, 0)
+    sel = selectors.DefaultSelector()
+    for target, conn in conns.items():
+        sel.register(conn, selectors.EVENT_WRITE, target)
+    data = memoryview(bytes(BUFFER))
+    time.sleep(max(start - time.time(), 0))
+    late = time.time() - start
+    end = start + duration
+    while sent:
+        now = time.time()
+        if now >= end:
+            break
+        for key, _ in sel.select(end - now):
+            try:
+                sent[key.data] += key.fileobj.send(data)
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    errors[key.data] = str(e)
+                    sel.unregister(key.fileobj)
+    for key in list(sel.get_map().values()):
+        key.fileobj.close()
+    sel.close()
+    return {'sent': sent, 'errors': errors, 'late': late}
+
+def permutationPairs(hosts, seed=None):
+    """Every host sends to exactly one other host and receives from exactly
+    one, in a random order (a derangement)"""
+    hosts = list(hosts)
+    if len(hosts) < 2:
+        return []
+    rng = random.Random(seed)
+    while True:
+        targets = hosts[:]
+        rng.shuffle(targets)
+        if all(src is not dst for src, dst in zip(hosts, targets)):
+            return list(zip(hosts, targets))
+
+def parsePairs(net, specs):
+    """[(src, dst)] hosts from "h1:h2" strings"""
+    pairs = []
+    for spec in specs:
+        src, _, dst = spec.partition(':')
+        if not dst or src == dst:
+            raise ValueError("bad pair %r, expected src:dst" % spec)
+        pairs.append((net.get(src), net.get(dst)))
+    return pairs
+
+class ThroughputResult(object):
+    """Received bits per second of each (src, dst) pair of host names"""
+    def __init__(self, pairs, duration):
+        self.pairs = pairs
+        self.duration = duration
+        self.bps = {}
+        self.errors = {}
+        self.late = 0.0
+        self.elapsed = 0.0
+
+    def aggregate(self):
+        return sum(self.bps.values())
+
+def _workerCmd(*args):
+    return [sys.executable, os.path.abspath(__file__)] + [str(a) for a in args]
+
+def collectOutputs(procs):
+    """Wait for all (key, popen) and return {key: parsed JSON or error text}"""
+    sel = selectors.DefaultSelector()
+    chunks = {}
+    for key, popen in procs:
+        chunks[key] = []
+        sel.register(popen.stdout, selectors.EVENT_READ, (key, popen))
+    results = {}
+    while sel.get_map():
+        for skey, _ in sel.select():
+            key, popen = skey.data
+            data = os.read(skey.fd, 65536)
+            if data:
+                chunks[key].append(data)
+                continue
+            sel.unregister(skey.fileobj)
+            popen.stdout.close()
+            popen.wait()
+            output = b''.join(chunks[key]).decode('utf-8', 'replace')
+            try:
+                results[key] = json.loads(output)
+            except ValueError:
+                results[key] = output.strip() or 'exit status %d' % popen.returncode
+    sel.close()
+    return results
+
+def runThroughput(pairs, duration=DURATION, port=PORT):
+    """Run all (src, dst) host pairs at the same time, return the
+    ThroughputResult"""
+    began = time.time()
+    receivers = list(dict((dst.name, dst) for _, dst in pairs).values())
+    senders = defaultdict(list)
+    for src, dst in pairs:
+        senders[src].append(dst.IP())
+    start = began + START_LEAD + LEAD_PER_PROC * (len(receivers) + len(senders))
+    opts = dict(stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    procs = []
+    for host in receivers:
+        procs.append((('rx', host.name), host.popen(_workerCmd(
+            '--receive', '--port', port, '--start', repr(start), '--duration', duration), **opts)))
+    for host, targets in senders.items():
+        procs.append((('tx', host.name), host.popen(_workerCmd(
+            '--send', '--port', port, '--start', repr(start), '--duration', duration,
+            *targets), **opts)))
+    outputs = collectOutputs(procs)
+
+    result = ThroughputResult([(src.name, dst.name) for src, dst in pairs], duration)
+    for src, dst in pairs:
+        received = outputs[('rx', dst.name)]
+        sender = outputs[('tx', src.name)]
+        if not isinstance(received, dict):
+            result.errors[(src.name, dst.name)] = 'receiver: %s' % received
+        elif not isinstance(sender, dict):
+            result.errors[(src.name, dst.name)] = 'sender: %s' % sender
+        elif dst.IP() in sender['errors']:
+            result.errors[(src.name, dst.name)] = sender['errors'][dst.IP()]
+        if isinstance(received, dict):
+            result.bps[(src.name, dst.name)] = 8.0 * received.get(src.IP(), 0) / duration
+        if isinstance(sender, dict):
+            result.late = max(result.late, sender['late'])
+    result.elapsed = time.time() - began
+    return result
+
+def shortestHops(topology, src, dst):
+    """Switches on a shortest path between two switches, by breadth first
+    search over the topology links"""
+    neighbors = defaultdict(set)
+    for link in topology["links"]:
+        neighbors[link["source"]].add(link["target"])
+        neighbors[link["target"]].add(link["source"])
+    depth = {src: 1}
+    queue = deque([src])
+    while queue:
+        switch = queue.popleft()
+        if switch == dst:
+            return depth[switch]
+        for peer in neighbors[switch]:
+            if peer not in depth:
+                depth[peer] = depth[switch] + 1
+                queue.append(peer)
+    return None
+
+def hopCounts(pairs, topology, routes=None):
+    """{(src, dst): tags} of host pairs: the tags of the installed route when
+    routes ({switch: [(network, ports)]}) are given, else the switches on a
+    shortest path, which is the tag count a shortest route would have"""
+    hostByIp = dict((h["ip"], h) for h in topology["hosts"])
+    hops = {}
+    for src, dst in pairs:
+        s, d = hostByIp.get(src.IP()), hostByIp.get(dst.IP())
+        if s is None or d is None:
+            hops[(src.name, dst.name)] = None
+        elif routes is not None:
+            from controller3 import lookup_route
+            ports = lookup_route(routes.get(s["connected_to"], []), d["ip"])
+            hops[(src.name, dst.name)] = len(ports) if ports else None
+        else:
+            hops[(src.name, dst.name)] = shortestHops(
+                topology, s["connected_to"], d["connected_to"])
+    return hops
+
+def _mbps(bps):
+    return '%.1f Mbit/s' % (bps / 1e6)
+
+def resultLines(result, hops=None):
+    """Per pair, aggregate and per hop count throughput as text"""
+    hops = hops or {}
+    lines = []
+    for pair in result.pairs:
+        tags = hops.get(pair)
+        line = '%s -> %s  %s  %s' % (pair[0], pair[1],
+                                     '%d tags' % tags if tags else '? tags',
+                                     _mbps(result.bps.get(pair, 0)))
+        if pair in result.errors:
+            line += '  (%s)' % result.errors[pair]
+        lines.append(line)
+    n = max(len(result.pairs), 1)
+    lines.append('aggregate: %d pairs, %s total, %s per pair, %.0fs window' % (
+        len(result.pairs), _mbps(result.aggregate()), _mbps(result.aggregate() / n),
+        result.duration))
+    if result.late > LATE_WARNING * result.duration:
+        lines.append('warning: a sender started %.2fs late, raise the start lead' % result.late)
+
+    byHops = defaultdict(list)
+    for pair in result.pairs:
+        if hops.get(pair) and pair not in result.errors:
+            byHops[hops[pair]].append(result.bps.get(pair, 0))
+    if byHops:
+        lines.append('by hop count:')
+        for tags in sorted(byHops):
+            rates = byHops[tags]
+            lines.append('  %d tags: %d pairs, mean %s, min %s, max %s' % (
+                tags, len(rates), _mbps(sum(rates) / len(rates)),
+                _mbps(min(rates)), _mbps(max(rates))))
+    if len(byHops) > 1:
+        # Least squares slope of the mean throughput over the tag count
+        xs = sorted(byHops)
+        ys = [sum(byHops[x]) / len(byHops[x]) for x in xs]
+        mx, my = sum(xs) / float(len(xs)), sum(ys) / len(ys)
+        slope = (sum((x - mx) * (y - my) for x, y in zip(xs, ys)) /
+                 sum((x - mx) ** 2 for x in xs))
+        lines.append('per extra tag: %+.1f Mbit/s (%+.1f%% of the mean)' % (
+            slope / 1e6, 100.0 * slope / my if my else 0.0))
+    return lines
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput matrix worker')
+    role = parser.add_mutually_exclusive_group(required=True)
+    role.add_argument('--send', action='store_true')
+    role.add_argument('--receive', action='store_true')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--start', type=float, required=True,
+                        help='wall-clock start time of the window')
+    parser.add_argument('--duration', type=float, default=DURATION)
+    parser.add_argument('targets', nargs='*')
+    args = parser.parse_args()
+    if args.receive:
+        result = receive(args.port, args.start, args.duration)
+    else:
+        result = send(args.targets, args.port, args.start, args.duration)
+    json.dump(result, sys.stdout)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+"""Generates topologies in the topo.json format read by controller3.py.
+
+mesh_topo2.py builds the Mininet network from the same dict, so the port
+numbers the controller uses for source routes are the ones the switches
+really have. Port numbers are handed out per switch in the order hosts and
+links are added, hosts first, exactly like Mininet numbers interfaces."""
+import sys
+import json
+import random
+import argparse
+import ipaddress
+
+HOST_NETWORK = ipaddress.ip_network("10.0.0.0/8")
+GRPC_BASE_PORT = 50000  # switch i listens on GRPC_BASE_PORT + i
+GRPC_ADDR = "127.0.0.1"
+
+
+class TopologyBuilder(object):
+    """Accumulates switches, hosts and links with their port numbers"""
+
+    def __init__(self):
+        self.switches = []
+        self.hosts = []
+        self.links = []
+        self.nextPort = {}
+
+    def addSwitch(self):
+        i = len(self.switches) + 1
+        name = "s%d" % i
+        self.switches.append({"name": name, "device_id": i, "ip": GRPC_ADDR,
+                              "port": GRPC_BASE_PORT + i})
+        self.nextPort[name] = 1
+        return name
+
+    def port(self, switch):
+        port = self.nextPort[switch]
+        self.nextPort[switch] = port + 1
+        return port
+
+    def addHost(self, switch):
+        i = len(self.hosts) + 1
+        self.hosts.append({
+            "name": "h%d" % i,
+            "ip": str(HOST_NETWORK[i]),
+            "mac": ":".join("%02x" % b for b in i.to_bytes(6, "big")),
+            "connected_to": switch,
+            "port": self.port(switch),
+        })
+
+    def addLink(self, source, target):
+        self.links.append({"source": source, "source_port": self.port(source),
+                           "target": target, "target_port": self.port(target)})
+
+    def topology(self):
+        return {"switches": self.switches, "hosts": self.hosts, "links": self.links}
+
+
+def build(edges, n, hostsPerSwitch=1):
+    """Topology of n switches with hosts on every switch and the given
+    (i, j) switch index pairs as links"""
+    builder = TopologyBuilder()
+    switches = [builder.addSwitch() for _ in range(n)]
+    for switch in switches:
+        for _ in range(hostsPerSwitch):
+            builder.addHost(switch)
+    for i, j in edges:
+        builder.addLink(switches[i], switches[j])
+    return builder.topology()
+
+
+def mesh(n, hostsPerSwitch=1):
+    """Full mesh, the topology MeshTopo always built"""
+    return build([(i, j) for i in range(n) for j in range(i + 1, n)], n, hostsPerSwitch)
+
+
+def ring(n, hostsPerSwitch=1):
+    edges = [(i, i + 1) for i in range(n - 1)]
+    if n > 2:
+        edges.append((n - 1, 0))
+    return build(edges, n, hostsPerSwitch)
+
+
+def torus(rows, cols=None, hostsPerSwitch=1):
+    """2D torus, rows x cols grid with wrap-around links"""
+    cols = cols or rows
+    edges = []
+    seen = set()
+    for r in range(rows):
+        for c in range(cols):
+            i = r * cols + c
+            for j in (r * cols + (c + 1) % cols, ((r + 1) % rows) * cols + c):
+                key = (min(i, j), max(i, j))
+                if i != j and key not in seen:
+                    seen.add(key)
+                    edges.append((i, j))
+    return build(edges, rows * cols, hostsPerSwitch)
+
+
+def random_graph(n, degree=3, seed=None, hostsPerSwitch=1):
+    """Connected random graph with an average degree of about degree"""
+    rng = random.Random(seed)
+    edges = set()
+    # A random spanning tree keeps the graph connected
+    for i in range(1, n):
+        edges.add((rng.randrange(i), i))
+    target = min(n * degree // 2, n * (n - 1) // 2)
+    while len(edges) < target:
+        i, j = rng.sample(range(n), 2)
+        edges.add((min(i, j), max(i, j)))
+    return build(sorted(edges), n, hostsPerSwitch)
+
+
+def fat_tree(k=4):
+    """k-ary fat tree: (k/2)^2 core switches, k pods of k/2 aggregation and
+    k/2 edge switches, k/2 hosts on every edge switch"""
+    if k % 2:
+        raise ValueError("fat tree k must be even")
+    half = k // 2
+    builder = TopologyBuilder()
+    core = [builder.addSwitch() for _ in range(half * half)]
+    for _ in range(k):
+        agg = [builder.addSwitch() for _ in range(half)]
+        edge = [builder.addSwitch() for _ in range(half)]
+        for switch in edge:
+            for _ in range(half):
+                builder.addHost(switch)
+        for switch in edge:
+            for a in agg:
+                builder.addLink(switch, a)
+        for a, aggSwitch in enumerate(agg):
+            for c in range(half):
+                builder.addLink(aggSwitch, core[a * half + c])
+    return builder.topology()
+
+
+GENERATORS = {
+    "mesh": lambda args: mesh(args.size, args.hosts),
+    "ring": lambda args: ring(args.size, args.hosts),
+    "torus": lambda args: torus(args.size, args.cols, args.hosts),
+    "random": lambda args: random_graph(args.size, args.degree, args.seed, args.hosts),
+    "fat-tree": lambda args: fat_tree(args.size),
+}
+
+
+def addArguments(parser):
+    parser.add_argument("kind", choices=sorted(GENERATORS), nargs="?", default="mesh")
+    parser.add_argument("size", type=int, nargs="?", default=4,
+                        help="switches (mesh, ring, random), rows (torus) or k (fat-tree)")
+    parser.add_argument("--cols", type=int, default=None, help="torus columns")
+    parser.add_argument("--hosts", type=int, default=1, help="hosts per switch")
+    parser.add_argument("--degree", type=int, default=3, help="random graph degree")
+    parser.add_argument("--seed", type=int, default=None, help="random graph seed")
+
+
+def generate(args):
+    return GENERATORS[args.kind](args)
+
+
+def save(topology, path):
+    """Write a topology the way topo.json is laid out, one entry per line"""
+    with open(path, "w") as f:
+        f.write("{\n")
+        sections = ["switches", "hosts", "links"]
+        for n, key in enumerate(sections):
+            f.write('  "%s": [\n' % key)
+            f.write(",\n".join("    " + json.dumps(e) for e in topology[key]))
+            f.write("\n  ]%s\n" % ("," if n < len(sections) - 1 else ""))
+        f.write("}\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a topo.json topology")
+    addArguments(parser)
+    parser.add_argument("-o", "--output", default=None, help="file to write, default stdout")
+    args = parser.parse_args()
+    topology = generate(args)
+    if args.output:
+        save(topology, args.output)
+        print("%d switches, %d hosts, %d links written to %s" % (
+            len(topology["switches"]), len(topology["hosts"]), len(topology["links"]),
+            args.output))
+    else:
+        json.dump(topology, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,219 @@
 #!/usr/bin/env python
-from scapy.all import sendp, get_if_list, get_if_hwaddr, get_if_raw_hwaddr
-from scapy.all import Ether, IP, UDP, DHCP, BOOTP
-
-def get_iface():
-	iface = None
-	for i in get_if_list(): # returns a list of connected hardware interfaces
-		if "eth0" in i:
-			iface = i
-			break
-	if not iface:
-		print ("Cannot find eth0 interface")
-		exit(1)
-	return iface
+import os
+import sys
+import time
+import array
+import asyncio
+import argparse
+from collections import deque
+
+from dhcp_proto import (
+	BOOTP_BROADCAST, BOOTREPLY, BOOTREQUEST, BPF_UDP_DST_68, BROADCAST_IP,
+	BROADCAST_MAC, DHCPACK, DHCPDISCOVER, DHCPNAK, DHCPOFFER, DHCPREQUEST,
+	DHCP_CLIENT_PORT, DHCP_SERVER_PORT, HEADERS_LEN, OPTIONS_OFFSET,
+	OPT_MESSAGE_TYPE, OPT_REQUESTED_IP, OPT_SERVER_ID, PACKET_OUTGOING,
+	ZERO_IP, build_frame, iface_addresses, message_type, open_raw_socket,
+	parse_frame)
+
+# Field offsets inside the frames built by dhcp_proto.build_frame()
+BOOTP_OFFSET = HEADERS_LEN
+ETH_SRC = slice(6, 12)
+XID = slice(BOOTP_OFFSET + 4, BOOTP_OFFSET + 8)
+CHADDR = slice(BOOTP_OFFSET + 28, BOOTP_OFFSET + 34)
+# REQUEST options: message type (3 bytes), requested ip (6), server id (6)
+REQUESTED_IP = slice(OPTIONS_OFFSET + 5, OPTIONS_OFFSET + 9)
+SERVER_ID = slice(OPTIONS_OFFSET + 11, OPTIONS_OFFSET + 15)
+
+TICK = 0.001  # pacing granularity, seconds
+
+
+def percentile(values, p):
+	if not values:
+		return float('nan')
+	values = sorted(values)
+	return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+
+class LoadGenerator:
+	"""Simulates many DHCP clients from precomputed frame templates.
+
+	mode "dora" runs DISCOVER/OFFER/REQUEST/ACK for every client, "request"
+	sends a bare REQUEST (what the original single client did) and
+	"discover" only sends DISCOVERs, which is the pool starvation attack."""
+
+	def __init__(self, iface, clients, rate, mode='dora', random_macs=False, timeout=2.0):
+		self.sock, self._bpf = open_raw_socket(iface, BPF_UDP_DST_68)
+		self.clients = clients
+		self.rate = rate
+		self.mode = mode
+		self.timeout = timeout
+		self.xid_base = int.from_bytes(os.urandom(4), 'big') & 0x7fffffff
+		if random_macs:
+			# Locally administered unicast addresses
+			self.macs = [bytes([0x02]) + os.urandom(5) for _ in range(clients)]
+		else:
+			base = int.from_bytes(iface_addresses(iface)[0], 'big')
+			self.macs = [((base + i) & 0xffffffffffff).to_bytes(6, 'big')
+				for i in range(clients)]
+		self.first = array.array('d', [0.0]) * clients  # DISCOVER (or REQUEST) sent
+		self.offered = array.array('d', [0.0]) * clients
+		self.requested = array.array('d', [0.0]) * clients
+		self.acked = array.array('d', [0.0]) * clients
+		self.offers = 0
+		self.acks = 0
+		self.naks = 0
+		self.sent = 0
+		self.next_client = 0
+		self.ready = deque()  # clients with an OFFER waiting to send their REQUEST
+		self.discover, self.request = self.build_templates()
+		self.done = None
+
+	def template(self, msg_type, options=()):
+		return build_frame(b'\x00' * 6, BROADCAST_MAC, ZERO_IP, BROADCAST_IP,
+			DHCP_CLIENT_PORT, DHCP_SERVER_PORT, BOOTREQUEST, 0, b'\x00' * 16,
+			[(OPT_MESSAGE_TYPE, bytes((msg_type,)))] + list(options),
+			flags=BOOTP_BROADCAST)
+
+	def build_templates(self):
+		"""One ready-to-send frame per client and message, patched in place."""
+		discover = self.template(DHCPDISCOVER)
+		if self.mode == 'request':
+			request = self.template(DHCPREQUEST)
+		else:
+			request = self.template(DHCPREQUEST,
+				[(OPT_REQUESTED_IP, ZERO_IP), (OPT_SERVER_ID, ZERO_IP)])
+		frames = ([], [])
+		for i, mac in enumerate(self.macs):
+			xid = (self.xid_base + i).to_bytes(4, 'big')
+			for frame, tmpl in zip(frames, (discover, request)):
+				buf = bytearray(tmpl)
+				buf[ETH_SRC] = mac
+				buf[CHADDR] = mac
+				buf[XID] = xid
+				frame.append(buf)
+		return frames
+
+	def on_readable(self):
+		now = time.monotonic()
+		while True:
+			try:
+				buf, addr = self.sock.recvfrom(2048)
+			except BlockingIOError:
+				return
+			if addr[2] == PACKET_OUTGOING:
+				continue
+			msg = parse_frame(buf)
+			if msg is None or msg.op != BOOTREPLY:
+				continue
+			i = msg.xid - self.xid_base
+			if not 0 <= i < self.clients:
+				continue
+			msg_type = message_type(msg)
+			if msg_type == DHCPOFFER and not self.offered[i]:
+				self.offered[i] = now
+				self.offers += 1
+				if self.mode == 'dora':
+					frame = self.request[i]
+					frame[REQUESTED_IP] = msg.yiaddr
+					frame[SERVER_ID] = msg.options.get(OPT_SERVER_ID, msg.siaddr)
+					self.ready.append(i)
+			elif msg_type == DHCPACK and not self.acked[i]:
+				self.acked[i] = now
+				self.acks += 1
+			elif msg_type == DHCPNAK:
+				self.naks += 1
+
+	async def run(self):
+		loop = asyncio.get_running_loop()
+		loop.add_reader(self.sock, self.on_readable)
+		start = time.monotonic()
+		last_send = start
+		try:
+			while not self.complete():
+				now = time.monotonic()
+				budget = int((now - start) * self.rate) - self.sent
+				while budget > 0 and (self.ready or self.next_client < self.clients):
+					# Clients already in a transaction go first
+					if self.ready:
+						self.send_request(self.ready.popleft(), now)
+					else:
+						self.send_first(self.next_client, now)
+						self.next_client += 1
+					budget -= 1
+					last_send = now
+				idle = not self.ready and self.next_client == self.clients
+				if idle and now - last_send > self.timeout:
+					break
+				await asyncio.sleep(TICK)
+		finally:
+			loop.remove_reader(self.sock)
+			self.sock.close()
+		self.done = time.monotonic()
+		return start
+
+	def send_first(self, i, now):
+		self.first[i] = now
+		self.send(self.request[i] if self.mode == 'request' else self.discover[i])
+
+	def send_request(self, i, now):
+		self.requested[i] = now
+		self.send(self.request[i])
+
+	def send(self, frame):
+		try:
+			self.sock.send(frame)
+		except BlockingIOError:
+			pass  # shows up as loss
+		self.sent += 1
+
+	def complete(self):
+		if self.mode == 'discover':
+			return self.offers == self.clients
+		return self.acks == self.clients
+
+	def report(self, start):
+		elapsed = self.done - start
+		n = self.clients
+		print("clients %d, sent %d frames in %.2f s (%.0f pps)" % (
+			n, self.sent, elapsed, self.sent / elapsed if elapsed else 0))
+		if self.mode != 'request':
+			offers = [self.offered[i] - self.first[i] for i in range(n) if self.offered[i]]
+			print("offers %d/%d (loss %.1f%%)" % (len(offers), n, 100.0 * (n - len(offers)) / n))
+			self.print_latency("DISCOVER->OFFER", offers)
+		if self.mode != 'discover':
+			sent_at = self.first if self.mode == 'request' else self.requested
+			asked = sum(1 for t in sent_at if t)
+			acks = [self.acked[i] - sent_at[i] for i in range(n) if self.acked[i]]
+			print("acks %d/%d (loss %.1f%%, naks %d)" % (len(acks), asked,
+				100.0 * (asked - len(acks)) / asked if asked else 0, self.naks))
+			self.print_latency("REQUEST->ACK", acks)
+			print("throughput %.1f leases/s" % (len(acks) / elapsed if elapsed else 0))
+
+	def print_latency(self, name, values):
+		ms = [v * 1000 for v in values]
+		print("%s latency ms: p50 %.2f  p90 %.2f  p99 %.2f  max %.2f" % (
+			name, percentile(ms, 50), percentile(ms, 90), percentile(ms, 99),
+			max(ms) if ms else float('nan')))
+
 
 def main():
-	iface = get_iface()
-	fam, hw = get_if_raw_hwaddr(iface) # returns family and hardware address of the interface
-
-	print ("sending on interface %s" % (iface))
-	pkt = Ether(src = get_if_hwaddr(iface), dst = 'ff:ff:ff:ff:ff:ff')
-	# Assembling a DHCP discover message
-	pkt = pkt / IP(dst='255.255.255.255') / UDP(dport=67, sport=68) / BOOTP(op = 1, chaddr = hw) / DHCP(options = [('message-type','request'), ('end')])
-	pkt.show2() # for a developed view of the assembled packet
-	sendp(pkt, iface = iface, verbose = False) # sendp works at layer 2
+	parser = argparse.ArgumentParser(description='DHCP client load generator')
+	parser.add_argument('--iface', default='eth0')
+	parser.add_argument('--clients', type=int, default=1)
+	parser.add_argument('--rate', type=float, default=1000, help='packets per second')
+	parser.add_argument('--mode', choices=['dora', 'request', 'discover'], default='dora')
+	parser.add_argument('--random-macs', action='store_true',
+		help='random client MACs (starvation), default is interface MAC + i')
+	parser.add_argument('--timeout', type=float, default=2.0,
+		help='seconds to wait for replies after the last frame')
+	args = parser.parse_args()
+
+	gen = LoadGenerator(args.iface, args.clients, args.rate, args.mode,
+		args.random_macs, args.timeout)
+	print("sending on interface %s" % args.iface)
+	sys.stdout.flush()
+	start = asyncio.run(gen.run())
+	gen.report(start)
 
 if __name__ == '__main__':
 	main()
@@ -1,41 +1,221 @@
 #!/usr/bin/env python
 import sys
-import os
+import time
+import socket
+import struct
+import asyncio
+import argparse
+import ipaddress
+from collections import Counter, deque
 
-from scapy.all import sniff, sendp, get_if_list, get_if_hwaddr, get_if_raw_hwaddr
-from scapy.all import Ether, IP, UDP, DHCP, BOOTP
+from dhcp_proto import (
+	BOOTP_BROADCAST, BOOTREPLY, BOOTREQUEST, BROADCAST_IP, BROADCAST_MAC,
+	DHCPACK, DHCPDISCOVER, DHCPNAK, DHCPOFFER, DHCPRELEASE, DHCPREQUEST,
+	DHCP_CLIENT_PORT, DHCP_SERVER_PORT, OPT_LEASE_TIME, OPT_MESSAGE_TYPE,
+	OPT_REQUESTED_IP, OPT_ROUTER, OPT_SERVER_ID, OPT_SUBNET_MASK,
+	PACKET_OUTGOING, ZERO_IP, build_frame, iface_addresses, message_type,
+	open_raw_socket, parse_frame)
+from dhcp_leases import LeaseManager
 
-def send_response(pkt):
-	client_hw_addr = pkt[Ether].src
-	client_ip_addr = pkt[IP].src
-	print ("request detected from client with MAC: %s and IP: %s" % (client_hw_addr, client_ip_addr))
+DEFAULT_LEASE_TIME = 3600  # seconds
+OFFER_HOLD_TIME = 60  # an offered address is kept this long for the REQUEST
+REPLY_TYPES = {DHCPDISCOVER: DHCPOFFER, DHCPREQUEST: DHCPACK}
 
-	#ifaces = filter(lambda i: 'eth' in i, os.listdir('/sys/class/net/'))
-	#iface = ifaces[0]
-	iface = "eth0"
 
-	print ("sending response packet from interface %s" % iface)
-	rpkt = Ether(src = get_if_hwaddr(iface), dst = client_hw_addr)
-	rpkt = rpkt / IP(dst = client_ip_addr) / UDP(dport = 68, sport = 67) / BOOTP(op = 2, chaddr = get_if_hwaddr(iface)) / DHCP(options = [('message-type', 'ack'), ('end')])
-	sendp(rpkt, iface = iface, verbose = False)
-	rpkt.show2()
-	exit(1)
+class DhcpServer:
+	"""DHCP server on an AF_PACKET socket, the kernel only hands us UDP/67."""
+
+	def __init__(self, iface, server_ip=None, lease_time=DEFAULT_LEASE_TIME,
+			leases=None, router=None):
+		self.iface = iface
+		self.sock, self._bpf = open_raw_socket(iface)
+		self.mac, ip = iface_addresses(iface)
+		self.ip = socket.inet_aton(server_ip) if server_ip else ip
+		self.lease_time = lease_time
+		self.leases = leases
+		self.router = socket.inet_aton(router) if router else None
+		self.counts = Counter()
+		self.requests = 0
+		self.pending = deque()
+		self.loop = None
+
+	def select_address(self, msg, msg_type):
+		"""Address to hand out in yiaddr, None if the client gets nothing."""
+		if self.leases is None:
+			return ZERO_IP
+		mac = msg.chaddr[:6]
+		requested = msg.options.get(OPT_REQUESTED_IP)
+		if requested is not None and len(requested) != 4:
+			requested = None
+		if msg.ciaddr != ZERO_IP:
+			requested = msg.ciaddr
+		if msg_type == DHCPREQUEST and requested is not None:
+			lease = self.leases.renew(mac, requested, self.lease_time)
+		else:
+			# DISCOVER, or a bare REQUEST as sent by the lab client
+			subnet_ip = msg.giaddr if msg.giaddr != ZERO_IP else self.ip
+			hold = OFFER_HOLD_TIME if msg_type == DHCPDISCOVER else self.lease_time
+			lease = self.leases.allocate(mac, subnet_ip, hold, requested)
+		return lease.ip.packed if lease is not None else None
+
+	def reply_options(self, reply_type, yiaddr):
+		options = [
+			(OPT_MESSAGE_TYPE, bytes((reply_type,))),
+			(OPT_SERVER_ID, self.ip),
+		]
+		if reply_type == DHCPNAK:
+			return options
+		options.append((OPT_LEASE_TIME, struct.pack('!I', self.lease_time)))
+		if self.leases is not None and yiaddr != ZERO_IP:
+			pool = self.leases.pool_for(yiaddr)
+			options.append((OPT_SUBNET_MASK, pool.network.netmask.packed))
+		if self.router is not None:
+			options.append((OPT_ROUTER, self.router))
+		return options
+
+	def reply_destination(self, msg, reply_type, yiaddr):
+		"""(MAC, IP) of a reply as in RFC 2131 4.1: unicast to a configured
+		client, broadcast a NAK or when the client asks for it with the
+		BOOTP broadcast flag (it cannot receive unicast before it has an
+		address), else unicast to the offered address (without a pool
+		nothing is offered and the IP stays broadcast)."""
+		if reply_type == DHCPNAK or (msg.ciaddr == ZERO_IP and msg.flags & BOOTP_BROADCAST):
+			return BROADCAST_MAC, BROADCAST_IP
+		if msg.ciaddr != ZERO_IP:
+			return msg.chaddr[:6], msg.ciaddr
+		return msg.chaddr[:6], yiaddr if yiaddr != ZERO_IP else BROADCAST_IP
+
+	def handle(self, msg):
+		"""Build the reply frame for a client message, or None."""
+		msg_type = message_type(msg)
+		reply_type = REPLY_TYPES.get(msg_type)
+		self.counts[msg_type] += 1
+		if msg_type == DHCPRELEASE and self.leases is not None:
+			self.leases.release(msg.chaddr[:6])
+		if reply_type is None:
+			return None
+		yiaddr = self.select_address(msg, msg_type)
+		if yiaddr is None:
+			if msg_type == DHCPDISCOVER:
+				return None  # pool exhausted, stay silent
+			reply_type, yiaddr = DHCPNAK, ZERO_IP
+		dst_mac, dst_ip = self.reply_destination(msg, reply_type, yiaddr)
+		return build_frame(self.mac, dst_mac, self.ip, dst_ip,
+			DHCP_SERVER_PORT, DHCP_CLIENT_PORT, BOOTREPLY, msg.xid,
+			msg.chaddr.ljust(16, b'\x00'), self.reply_options(reply_type, yiaddr),
+			flags=msg.flags, ciaddr=msg.ciaddr, yiaddr=yiaddr, siaddr=self.ip,
+			giaddr=msg.giaddr)
+
+	def on_readable(self):
+		# Drain everything queued on the socket before yielding to the loop
+		while True:
+			try:
+				buf, addr = self.sock.recvfrom(2048)
+			except BlockingIOError:
+				return
+			if addr[2] == PACKET_OUTGOING:
+				continue
+			msg = parse_frame(buf)
+			if msg is None or msg.op != BOOTREQUEST:
+				continue
+			self.requests += 1
+			reply = self.handle(msg)
+			if reply is not None:
+				self.send(reply)
+
+	def send(self, frame):
+		if not self.pending:
+			try:
+				self.sock.send(frame)
+				return
+			except BlockingIOError:
+				self.loop.add_writer(self.sock, self.on_writable)
+		self.pending.append(frame)
+
+	def on_writable(self):
+		while self.pending:
+			try:
+				self.sock.send(self.pending[0])
+			except BlockingIOError:
+				return
+			self.pending.popleft()
+		self.loop.remove_writer(self.sock)
+
+	async def report(self, interval):
+		last, last_time = 0, time.monotonic()
+		while True:
+			await asyncio.sleep(interval)
+			now = time.monotonic()
+			rate = (self.requests - last) / (now - last_time)
+			last, last_time = self.requests, now
+			print("requests/s: %.1f (total %d, discover %d, request %d, release %d)%s" % (
+				rate, self.requests, self.counts[DHCPDISCOVER],
+				self.counts[DHCPREQUEST], self.counts[DHCPRELEASE],
+				", leases %d" % len(self.leases) if self.leases is not None else ""))
+			sys.stdout.flush()
+
+	async def expire_leases(self):
+		while True:
+			await asyncio.sleep(1)
+			for lease in self.leases.expire():
+				print("lease expired: %s" % (lease,))
+
+	async def serve(self, report_interval=1.0):
+		self.loop = asyncio.get_running_loop()
+		self.loop.add_reader(self.sock, self.on_readable)
+		if self.leases is not None:
+			expiry = asyncio.create_task(self.expire_leases())
+		try:
+			await self.report(report_interval)
+		finally:
+			if self.leases is not None:
+				expiry.cancel()
+				self.leases.close()
+			self.loop.remove_reader(self.sock)
+			self.sock.close()
+
+
+def parse_pool(value):
+	"""NETWORK[:FIRST-LAST], the range defaults to all hosts of the network."""
+	network, _, span = value.partition(':')
+	network = ipaddress.ip_network(network)
+	if span:
+		first, last = span.split('-')
+	else:
+		first, last = network.network_address + 1, network.broadcast_address - 1
+	return network, first, last
 
-def handle_pkt(pkt):
-	if UDP in pkt and pkt[UDP].dport == 67:
-		print ("got a DHCP packet from known client")
-		pkt.show2()
-		send_response(pkt)
 
 def main():
-	#ifaces = filter(lambda i: 'eth' in i, os.listdir('/sys/class/net/'))
-	#iface = ifaces[0]
-	iface = "eth0"
-	print ("sniffing on %s" % iface)
+	parser = argparse.ArgumentParser(description='DHCP server for the dhcpsnooping lab')
+	parser.add_argument('--iface', default='eth0')
+	parser.add_argument('--server-ip', default=None,
+		help='server identifier, defaults to the interface address')
+	parser.add_argument('--lease-time', type=int, default=DEFAULT_LEASE_TIME)
+	parser.add_argument('--report', type=float, default=1.0,
+		help='seconds between requests/s reports')
+	parser.add_argument('--pool', action='append', type=parse_pool, default=[],
+		help='address pool NETWORK[:FIRST-LAST], may be repeated')
+	parser.add_argument('--router', default=None, help='default gateway option')
+	parser.add_argument('--journal', default='dhcp-leases.journal',
+		help='append-only lease journal kept across restarts')
+	args = parser.parse_args()
+
+	leases = None
+	if args.pool:
+		leases = LeaseManager(args.journal)
+		for network, first, last in args.pool:
+			leases.add_subnet(network, first, last)
+		leases.open_journal()
+		print("%d leases restored from %s" % (len(leases), args.journal))
+
+	server = DhcpServer(args.iface, args.server_ip, args.lease_time, leases, args.router)
+	print("serving DHCP on %s (%s)" % (args.iface, socket.inet_ntoa(server.ip)))
 	sys.stdout.flush()
-	sniff(iface = iface,
-		prn = lambda x: handle_pkt(x))
-	# sniff function passes the packet object as the one arg into prn: func
+	try:
+		asyncio.run(server.serve(args.report))
+	except KeyboardInterrupt:
+		print("served %d requests" % server.requests)
 
 if __name__ == '__main__':
 	main()
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# Learns DHCP bindings from the dhcp_binding_t digest of dhcp-snoop.p4 and
+# keeps IngressProcess.trusted_dhcp_client in sync with them.
+import sys
+import json
+import time
+import asyncio
+import argparse
+import ipaddress
+from pathlib import Path
+
+import finsy as fy
+
+from dhcp_leases import TimerWheel
+
+_SRC = Path(__file__).parent
+
+DIGEST = "dhcp_binding_t"
+CLIENT_TABLE = "IngressProcess.trusted_dhcp_client"
+FWD_ACTION = "IngressProcess.pkt_fwd"
+DHCP_ACK = 5
+DHCP_RELEASE = 7
+PORT_UNKNOWN = 511  # clientPort of an ACK whose request port was overwritten
+
+DIGEST_LIST_SIZE = 256  # bindings per digest message
+DIGEST_TIMEOUT_NS = 10 * 1000 * 1000  # flush partial digest lists after 10 ms
+FLUSH_INTERVAL = 0.05  # seconds between table writes
+FLUSH_SIZE = 1024  # write earlier when this many clients changed
+DEFAULT_BINDING_TTL = 3600  # seconds, refreshed by every ACK (renewal)
+
+
+def mac_str(mac):
+	return ':'.join('%02x' % b for b in mac.to_bytes(6, 'big'))
+
+
+class Binding:
+	__slots__ = ('mac', 'ip', 'port', 'server_mac', 'server_port')
+
+	def __init__(self, mac, ip, port, server_mac, server_port):
+		self.mac = mac
+		self.ip = ip
+		self.port = port
+		self.server_mac = server_mac
+		self.server_port = server_port
+
+	def action(self):
+		return (self.server_mac, self.server_port)
+
+	def __repr__(self):
+		return '%s %s port %d' % (mac_str(self.mac), ipaddress.IPv4Address(self.ip), self.port)
+
+
+class BindingTable:
+	"""Snooped bindings indexed by client MAC, IP and switch port."""
+
+	def __init__(self):
+		self.by_mac = {}
+		self.by_ip = {}
+		self.by_port = {}
+
+	def add(self, binding):
+		"""Insert or replace a binding, returns the MACs whose entry changed."""
+		changed = {binding.mac}
+		old = self.by_mac.get(binding.mac)
+		if old is not None:
+			self._unlink(old)
+		holder = self.by_ip.get(binding.ip)
+		if holder is not None and holder.mac != binding.mac:
+			# Address moved to another client, the old one loses it
+			self.remove(holder.mac)
+			changed.add(holder.mac)
+		self.by_mac[binding.mac] = binding
+		self.by_ip[binding.ip] = binding
+		self.by_port.setdefault(binding.port, set()).add(binding.mac)
+		return changed
+
+	def remove(self, mac):
+		binding = self.by_mac.pop(mac, None)
+		if binding is not None:
+			self._unlink(binding)
+		return binding
+
+	def _unlink(self, binding):
+		if self.by_ip.get(binding.ip) is binding:
+			del self.by_ip[binding.ip]
+		macs = self.by_port.get(binding.port)
+		if macs is not None:
+			macs.discard(binding.mac)
+			if not macs:
+				del self.by_port[binding.port]
+
+	def on_port(self, port):
+		return [self.by_mac[mac] for mac in self.by_port.get(port, ())]
+
+	def __len__(self):
+		return len(self.by_mac)
+
+
+class SnoopingController:
+	def __init__(self, switch, ttl=DEFAULT_BINDING_TTL):
+		self.switch = switch
+		self.bindings = BindingTable()
+		self.installed = {}  # client MAC -> (server MAC, server port) in the table
+		self.static = set()  # entries present before we started, never removed
+		self.dirty = set()
+		self.expiry = TimerWheel()
+		self.ttl = ttl
+		self.flush_needed = asyncio.Event()
+		self.writes = 0
+		self.updates = 0
+
+	def learn(self, digest):
+		"""Apply one dhcp_binding_t digest to the binding table."""
+		mac = digest["clientMac"]
+		if digest["msgType"] == DHCP_ACK:
+			port = digest["clientPort"]
+			current = self.bindings.by_mac.get(mac)
+			if port == PORT_UNKNOWN and current is not None:
+				port = current.port  # renewal, the client has not moved
+			binding = Binding(mac, digest["clientIp"], port,
+				digest["serverMac"], digest["serverPort"])
+			self.dirty |= self.bindings.add(binding)
+			self.expiry.schedule(mac, time.time() + self.ttl)
+		elif digest["msgType"] == DHCP_RELEASE:
+			current = self.bindings.by_mac.get(mac)
+			# Only the port that holds the binding may release it
+			if current is not None and current.port == digest["clientPort"]:
+				self.bindings.remove(mac)
+				self.expiry.cancel(mac)
+				self.dirty.add(mac)
+		if len(self.dirty) >= FLUSH_SIZE:
+			self.flush_needed.set()
+
+	def expire(self):
+		for mac in self.expiry.advance(time.time()):
+			if self.bindings.remove(mac) is not None:
+				self.dirty.add(mac)
+
+	def pending_updates(self):
+		"""Coalesce all changes since the last flush into table updates."""
+		updates = []
+		for mac in self.dirty:
+			binding = self.bindings.by_mac.get(mac)
+			current = self.installed.get(mac)
+			if binding is None:
+				if current is not None and mac not in self.static:
+					updates.append(-self.client_entry(mac, *current))
+					del self.installed[mac]
+			elif current != binding.action():
+				entry = self.client_entry(mac, *binding.action())
+				updates.append(+entry if current is None else ~entry)
+				self.installed[mac] = binding.action()
+		self.dirty.clear()
+		return updates
+
+	def client_entry(self, mac, server_mac, server_port):
+		return fy.P4TableEntry(
+			CLIENT_TABLE,
+			match=fy.Match(**{"hdr.ethernet.srcAddr": mac}),
+			action=fy.Action(FWD_ACTION, dstAddr=server_mac, port=server_port),
+		)
+
+	async def flush(self):
+		"""Write all coalesced changes in a single request."""
+		self.expire()
+		updates = self.pending_updates()
+		if not updates:
+			return
+		try:
+			await self.switch.write(updates)
+		except Exception as e:
+			print(f"Error writing {len(updates)} updates to {self.switch.name}: {e}")
+			# Part of the batch may have been applied, start over from the switch
+			await self.sync_installed()
+			self.dirty.update(self.bindings.by_mac)
+			self.dirty.update(self.installed)
+			return
+		self.writes += 1
+		self.updates += len(updates)
+
+	async def sync_installed(self):
+		"""Read back what trusted_dhcp_client holds right now."""
+		self.installed.clear()
+		async for entry in self.switch.read(fy.P4TableEntry(CLIENT_TABLE)):
+			mac, _ = entry.match["hdr.ethernet.srcAddr"]
+			args = entry.action.args
+			self.installed[mac] = (args["dstAddr"], args["port"])
+
+	async def writer(self):
+		while True:
+			try:
+				await asyncio.wait_for(self.flush_needed.wait(), FLUSH_INTERVAL)
+			except asyncio.TimeoutError:
+				pass
+			self.flush_needed.clear()
+			await self.flush()
+
+	async def reader(self):
+		async for digest_list in self.switch.read_digests(DIGEST):
+			await self.switch.write([digest_list.ack()])
+			for digest in digest_list:
+				self.learn(digest)
+
+	async def report(self, interval):
+		while True:
+			await asyncio.sleep(interval)
+			print(f"{self.switch.name}: {len(self.bindings)} bindings, "
+				f"{len(self.installed)} entries, {self.updates} updates in {self.writes} writes")
+			sys.stdout.flush()
+
+	async def run(self, report_interval):
+		# Entries from the runtime file (s1-runtime.json) are kept as they are
+		await self.sync_installed()
+		self.static = set(self.installed)
+		await self.switch.write([+fy.P4DigestEntry(
+			DIGEST,
+			max_list_size=DIGEST_LIST_SIZE,
+			max_timeout_ns=DIGEST_TIMEOUT_NS,
+			ack_timeout_ns=DIGEST_TIMEOUT_NS,
+		)], warn_only=True)
+		await asyncio.gather(self.reader(), self.writer(), self.report(report_interval))
+
+
+def main():
+	parser = argparse.ArgumentParser(description='DHCP snooping controller')
+	parser.add_argument('--runtime', type=Path, default=_SRC / 's1-runtime.json',
+		help='runtime file naming the p4info of the switch')
+	parser.add_argument('--switch', default='s1')
+	parser.add_argument('--grpc-addr', default='127.0.0.1:50051')
+	parser.add_argument('--ttl', type=int, default=DEFAULT_BINDING_TTL,
+		help='seconds a binding lives without a renewal ACK')
+	parser.add_argument('--report', type=float, default=5.0)
+	args = parser.parse_args()
+
+	with open(args.runtime) as f:
+		runtime = json.load(f)
+
+	async def ready_handler(switch):
+		await SnoopingController(switch, args.ttl).run(args.report)
+
+	opts = fy.SwitchOptions(
+		p4info=args.runtime.parent / runtime['p4info'],
+		ready_handler=ready_handler,
+	)
+	fy.run(fy.Switch(args.switch, args.grpc_addr, opts).run())
+
+if __name__ == '__main__':
+	main()
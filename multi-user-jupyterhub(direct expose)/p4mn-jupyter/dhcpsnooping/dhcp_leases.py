@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# DHCP lease bookkeeping for dhcp-server.py: bitmap address pools, lease
+# indexes, a timer wheel for expiry and an append-only lease journal.
+import os
+import time
+import struct
+import ipaddress
+
+WORD_BITS = 64
+FULL_WORD = (1 << WORD_BITS) - 1
+
+# Journal records: op, client MAC, address, expiry (unix seconds)
+JOURNAL_RECORD = struct.Struct('!c6s4sI')
+OP_BIND = b'B'
+OP_RELEASE = b'R'
+COMPACT_RATIO = 4  # rewrite the journal when it holds 4x more records than leases
+
+
+class AddressPool:
+	"""Free addresses of one subnet range kept in a bitmap.
+
+	Words that still have a free bit sit on a stack, so allocate() and
+	release() never scan the bitmap."""
+
+	def __init__(self, network, first, last):
+		self.network = ipaddress.ip_network(network)
+		self.first = int(ipaddress.ip_address(first))
+		self.size = int(ipaddress.ip_address(last)) - self.first + 1
+		nwords = (self.size + WORD_BITS - 1) // WORD_BITS
+		self.words = [0] * nwords
+		# Bits past the end of the range are marked as used
+		tail = self.size % WORD_BITS
+		if tail:
+			self.words[-1] = FULL_WORD & ~((1 << tail) - 1)
+		self.free_words = list(range(nwords - 1, -1, -1))
+		self.stacked = bytearray(b'\x01' * nwords)
+		self.used = 0
+
+	def __contains__(self, ip):
+		return 0 <= int(ip) - self.first < self.size
+
+	def is_free(self, ip):
+		offset = int(ip) - self.first
+		return not (self.words[offset // WORD_BITS] >> (offset % WORD_BITS)) & 1
+
+	def allocate(self):
+		"""Take any free address, None when the pool is exhausted."""
+		while self.free_words:
+			index = self.free_words[-1]
+			word = self.words[index]
+			if word == FULL_WORD:
+				self.free_words.pop()
+				self.stacked[index] = 0
+				continue
+			bit = (~word & (word + 1)).bit_length() - 1
+			self.words[index] = word | (1 << bit)
+			self.used += 1
+			return ipaddress.IPv4Address(self.first + index * WORD_BITS + bit)
+		return None
+
+	def claim(self, ip):
+		"""Take a specific address (requested or replayed), False if in use."""
+		offset = int(ip) - self.first
+		index, bit = divmod(offset, WORD_BITS)
+		if (self.words[index] >> bit) & 1:
+			return False
+		self.words[index] |= 1 << bit
+		self.used += 1
+		return True
+
+	def release(self, ip):
+		offset = int(ip) - self.first
+		index, bit = divmod(offset, WORD_BITS)
+		if not (self.words[index] >> bit) & 1:
+			return
+		self.words[index] &= ~(1 << bit)
+		self.used -= 1
+		if not self.stacked[index]:
+			self.stacked[index] = 1
+			self.free_words.append(index)
+
+
+class TimerWheel:
+	"""Hashed timer wheel with one second ticks.
+
+	Timers further out than the wheel span wait for extra rounds in their
+	slot, so scheduling and cancelling are O(1)."""
+
+	def __init__(self, slots=4096, now=None):
+		self.slots = [dict() for _ in range(slots)]
+		self.tick = int(now if now is not None else time.time())
+		self.where = {}
+
+	def schedule(self, key, when):
+		self.cancel(key)
+		when = max(int(when), self.tick + 1)
+		slot = when % len(self.slots)
+		self.slots[slot][key] = when
+		self.where[key] = slot
+
+	def cancel(self, key):
+		slot = self.where.pop(key, None)
+		if slot is not None:
+			del self.slots[slot][key]
+
+	def advance(self, now):
+		"""Move the wheel to now and return the keys that fired."""
+		fired = []
+		now = int(now)
+		# Never turn more than one full round, every slot is visited once
+		start = max(self.tick + 1, now - len(self.slots) + 1)
+		for t in range(start, now + 1):
+			slot = self.slots[t % len(self.slots)]
+			if not slot:
+				continue
+			due = [key for key, when in slot.items() if when <= now]
+			for key in due:
+				del slot[key]
+				del self.where[key]
+			fired.extend(due)
+		self.tick = max(self.tick, now)
+		return fired
+
+	def __len__(self):
+		return len(self.where)
+
+
+class Lease:
+	__slots__ = ('mac', 'ip', 'expires', 'pool')
+
+	def __init__(self, mac, ip, expires, pool):
+		self.mac = mac
+		self.ip = ip
+		self.expires = expires
+		self.pool = pool
+
+	def __repr__(self):
+		return 'Lease(%s, %s, expires=%d)' % (
+			':'.join('%02x' % b for b in self.mac), self.ip, self.expires)
+
+
+class LeaseManager:
+	"""Leases of all subnets, indexed by client MAC and by address."""
+
+	def __init__(self, journal=None, sync=False):
+		self.pools = []
+		self.by_mac = {}
+		self.by_ip = {}
+		self.wheel = TimerWheel()
+		self.journal_path = journal
+		self.journal = None
+		self.journal_records = 0
+		self.sync = sync
+
+	def add_subnet(self, network, first, last):
+		pool = AddressPool(network, first, last)
+		self.pools.append(pool)
+		return pool
+
+	def pool_for(self, ip):
+		"""Pool whose subnet contains ip (the relay or server address)."""
+		ip = ipaddress.IPv4Address(ip)
+		for pool in self.pools:
+			if ip in pool.network:
+				return pool
+		return self.pools[0] if len(self.pools) == 1 else None
+
+	def lookup(self, mac):
+		return self.by_mac.get(mac)
+
+	def allocate(self, mac, subnet_ip, lease_time, requested=None, now=None):
+		"""Lease an address to mac: keep its current one, else try the
+		requested address, else take any free one. None if none is left.
+		A lease is only ever extended here, so a short offer hold does not
+		cut the lease of a client that discovers again while bound."""
+		now = int(now if now is not None else time.time())
+		lease = self.by_mac.get(mac)
+		if lease is not None:
+			if lease.expires < now + lease_time:
+				self._bind(lease, now + lease_time)
+			return lease
+		pool = self.pool_for(subnet_ip)
+		if pool is None:
+			return None
+		ip = None
+		if requested is not None:
+			requested = ipaddress.IPv4Address(requested)
+			if requested in pool and pool.claim(requested):
+				ip = requested
+		if ip is None:
+			ip = pool.allocate()
+			if ip is None:
+				return None
+		lease = Lease(mac, ip, 0, pool)
+		self.by_mac[mac] = lease
+		self.by_ip[ip] = lease
+		self._bind(lease, now + lease_time)
+		return lease
+
+	def renew(self, mac, ip, lease_time, now=None):
+		"""Confirm a REQUEST for ip, None if mac does not hold it."""
+		lease = self.by_mac.get(mac)
+		if lease is None or lease.ip != ipaddress.IPv4Address(ip):
+			return None
+		now = int(now if now is not None else time.time())
+		self._bind(lease, now + lease_time)
+		return lease
+
+	def release(self, mac):
+		lease = self.by_mac.pop(mac, None)
+		if lease is None:
+			return None
+		del self.by_ip[lease.ip]
+		lease.pool.release(lease.ip)
+		self.wheel.cancel(mac)
+		self._log(OP_RELEASE, lease.mac, lease.ip, 0)
+		return lease
+
+	def expire(self, now=None):
+		"""Release every lease whose time is up, returns the expired leases."""
+		now = now if now is not None else time.time()
+		return [lease for lease in map(self.release, self.wheel.advance(now))
+			if lease is not None]
+
+	def _bind(self, lease, expires):
+		lease.expires = expires
+		self.wheel.schedule(lease.mac, expires)
+		self._log(OP_BIND, lease.mac, lease.ip, expires)
+
+	def __len__(self):
+		return len(self.by_mac)
+
+	# Journal
+
+	def _log(self, op, mac, ip, expires):
+		if self.journal is None:
+			return
+		self.journal.write(JOURNAL_RECORD.pack(op, mac, ip.packed, expires))
+		self.journal.flush()
+		if self.sync:
+			os.fsync(self.journal.fileno())
+		self.journal_records += 1
+		if self.journal_records > COMPACT_RATIO * max(len(self.by_mac), 1024):
+			self.compact()
+
+	def open_journal(self, now=None):
+		"""Replay the journal, drop leases that expired meanwhile and keep
+		appending to it."""
+		now = int(now if now is not None else time.time())
+		self.wheel = TimerWheel(now=now)
+		if os.path.exists(self.journal_path):
+			with open(self.journal_path, 'rb') as f:
+				data = f.read()
+			usable = len(data) - len(data) % JOURNAL_RECORD.size  # torn tail
+			state = {}
+			for op, mac, ip, expires in JOURNAL_RECORD.iter_unpack(data[:usable]):
+				if op == OP_BIND:
+					state[mac] = (ipaddress.IPv4Address(ip), expires)
+				else:
+					state.pop(mac, None)
+			for mac, (ip, expires) in state.items():
+				pool = self.pool_for(ip)
+				if expires <= now or pool is None or ip not in pool or not pool.claim(ip):
+					continue
+				lease = Lease(mac, ip, expires, pool)
+				self.by_mac[mac] = lease
+				self.by_ip[ip] = lease
+				self.wheel.schedule(mac, expires)
+		self.compact()
+
+	def compact(self):
+		"""Rewrite the journal with one record per live lease."""
+		tmp = self.journal_path + '.tmp'
+		with open(tmp, 'wb') as f:
+			f.write(b''.join(JOURNAL_RECORD.pack(OP_BIND, l.mac, l.ip.packed, l.expires)
+				for l in self.by_mac.values()))
+			f.flush()
+			os.fsync(f.fileno())
+		if self.journal is not None:
+			self.journal.close()
+		os.replace(tmp, self.journal_path)
+		self.journal = open(self.journal_path, 'ab')
+		self.journal_records = len(self.by_mac)
+
+	def close(self):
+		if self.journal is not None:
+			self.journal.close()
+			self.journal = None
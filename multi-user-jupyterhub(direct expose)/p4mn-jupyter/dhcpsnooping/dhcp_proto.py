@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# Plain struct based BOOTP/DHCP encoding shared by the dhcpsnooping scripts.
+import ctypes
+import fcntl
+import socket
+import struct
+from collections import namedtuple
+
+ETH_P_ALL = 0x0003
+ETH_P_IP = 0x0800
+IPPROTO_UDP = 17
+DHCP_SERVER_PORT = 67
+DHCP_CLIENT_PORT = 68
+BROADCAST_MAC = b'\xff' * 6
+BROADCAST_IP = b'\xff' * 4
+ZERO_IP = b'\x00' * 4
+MAGIC_COOKIE = b'\x63\x82\x53\x63'
+
+BOOTREQUEST = 1
+BOOTREPLY = 2
+BOOTP_BROADCAST = 0x8000
+
+# DHCP message types (option 53)
+DHCPDISCOVER = 1
+DHCPOFFER = 2
+DHCPREQUEST = 3
+DHCPDECLINE = 4
+DHCPACK = 5
+DHCPNAK = 6
+DHCPRELEASE = 7
+DHCPINFORM = 8
+
+# DHCP options
+OPT_PAD = 0
+OPT_SUBNET_MASK = 1
+OPT_ROUTER = 3
+OPT_REQUESTED_IP = 50
+OPT_LEASE_TIME = 51
+OPT_MESSAGE_TYPE = 53
+OPT_SERVER_ID = 54
+OPT_END = 255
+
+# Precompiled layouts
+ETHERNET = struct.Struct('!6s6sH')
+IPV4 = struct.Struct('!BBHHHBBH4s4s')
+UDP = struct.Struct('!HHHH')
+BOOTP = struct.Struct('!BBBBIHH4s4s4s4s16s64s128s4s')  # ends with the magic cookie
+HEADERS_LEN = ETHERNET.size + IPV4.size + UDP.size
+OPTIONS_OFFSET = HEADERS_LEN + BOOTP.size
+MIN_FRAME_LEN = OPTIONS_OFFSET + 3  # message type option
+
+# Linux socket and ioctl numbers
+SO_ATTACH_FILTER = 26
+SIOCGIFADDR = 0x8915
+SIOCGIFHWADDR = 0x8927
+PACKET_OUTGOING = 4
+SOCKET_BUFFER = 4 * 1024 * 1024  # absorb bursts of requests
+
+
+def bpf_udp_dst_port(port):
+	"""Classic BPF for "udp dst port <port>" over Ethernet (tcpdump -dd, IPv4 only)."""
+	return [
+		(0x28, 0, 0, 0x0000000c),
+		(0x15, 0, 8, 0x00000800),
+		(0x30, 0, 0, 0x00000017),
+		(0x15, 0, 6, 0x00000011),
+		(0x28, 0, 0, 0x00000014),
+		(0x45, 4, 0, 0x00001fff),
+		(0xb1, 0, 0, 0x0000000e),
+		(0x48, 0, 0, 0x00000010),
+		(0x15, 0, 1, port),
+		(0x06, 0, 0, 0x00040000),
+		(0x06, 0, 0, 0x00000000),
+	]
+
+
+BPF_UDP_DST_67 = bpf_udp_dst_port(DHCP_SERVER_PORT)
+BPF_UDP_DST_68 = bpf_udp_dst_port(DHCP_CLIENT_PORT)
+
+DhcpMessage = namedtuple('DhcpMessage', [
+	'eth_src', 'eth_dst', 'ip_src', 'ip_dst', 'op', 'xid', 'flags',
+	'ciaddr', 'yiaddr', 'siaddr', 'giaddr', 'chaddr', 'options'])
+
+
+def mac_str(mac):
+	return ':'.join('%02x' % b for b in mac)
+
+
+def mac_bytes(mac):
+	return bytes.fromhex(mac.replace(':', ''))
+
+
+def attach_filter(sock, program=BPF_UDP_DST_67):
+	"""Attach a classic BPF program so the kernel drops everything else."""
+	insns = b''.join(struct.pack('HBBI', *insn) for insn in program)
+	buf = ctypes.create_string_buffer(insns)
+	fprog = struct.pack('HL', len(program), ctypes.addressof(buf))
+	sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+	return buf  # keep the program alive as long as the socket
+
+
+def open_raw_socket(iface, program=BPF_UDP_DST_67):
+	"""Non-blocking AF_PACKET socket on iface, filtered in the kernel."""
+	sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+	keep = attach_filter(sock, program) if program else None
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER)
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER)
+	sock.bind((iface, ETH_P_ALL))
+	sock.setblocking(False)
+	return sock, keep
+
+
+def iface_addresses(iface):
+	"""Return (mac, ipv4) of an interface as bytes, ipv4 is zero if unset."""
+	with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+		req = struct.pack('256s', iface.encode()[:15])
+		mac = fcntl.ioctl(s.fileno(), SIOCGIFHWADDR, req)[18:24]
+		try:
+			ip = fcntl.ioctl(s.fileno(), SIOCGIFADDR, req)[20:24]
+		except OSError:
+			ip = ZERO_IP
+	return mac, ip
+
+
+def parse_options(buf, offset):
+	"""Decode DHCP options into a {code: bytes} dict."""
+	options = {}
+	end = len(buf)
+	while offset < end:
+		code = buf[offset]
+		if code == OPT_END:
+			break
+		if code == OPT_PAD:
+			offset += 1
+			continue
+		if offset + 1 >= end:
+			break
+		length = buf[offset + 1]
+		options[code] = bytes(buf[offset + 2:offset + 2 + length])
+		offset += 2 + length
+	return options
+
+
+def encode_options(options):
+	"""Encode a list of (code, bytes) options followed by the end option."""
+	out = bytearray()
+	for code, value in options:
+		out += bytes((code, len(value))) + value
+	out.append(OPT_END)
+	return bytes(out)
+
+
+def message_type(msg):
+	value = msg.options.get(OPT_MESSAGE_TYPE)
+	return value[0] if value else None
+
+
+def parse_frame(buf):
+	"""Parse an Ethernet/IPv4/UDP BOOTP frame, None if it is not DHCP."""
+	if len(buf) < MIN_FRAME_LEN:
+		return None
+	eth_dst, eth_src, eth_type = ETHERNET.unpack_from(buf, 0)
+	if eth_type != ETH_P_IP:
+		return None
+	ver_ihl = buf[ETHERNET.size]
+	ihl = (ver_ihl & 0x0f) * 4
+	ip = IPV4.unpack_from(buf, ETHERNET.size)
+	if ip[6] != IPPROTO_UDP:
+		return None
+	udp_off = ETHERNET.size + ihl
+	sport, dport, _, _ = UDP.unpack_from(buf, udp_off)
+	if dport not in (DHCP_SERVER_PORT, DHCP_CLIENT_PORT):
+		return None
+	bootp_off = udp_off + UDP.size
+	if len(buf) < bootp_off + BOOTP.size:
+		return None
+	(op, _, hlen, _, xid, _, flags, ciaddr, yiaddr, siaddr, giaddr,
+	 chaddr, _, _, cookie) = BOOTP.unpack_from(buf, bootp_off)
+	if cookie != MAGIC_COOKIE:
+		return None
+	options = parse_options(buf, bootp_off + BOOTP.size)
+	return DhcpMessage(eth_src, eth_dst, ip[8], ip[9], op, xid, flags,
+		ciaddr, yiaddr, siaddr, giaddr, chaddr[:min(hlen, 16)], options)
+
+
+def ip_checksum(header):
+	total = sum(struct.unpack('!10H', header))
+	total = (total & 0xffff) + (total >> 16)
+	total = (total & 0xffff) + (total >> 16)
+	return ~total & 0xffff
+
+
+def build_frame(eth_src, eth_dst, ip_src, ip_dst, sport, dport, op, xid, chaddr,
+		options, flags=0, ciaddr=ZERO_IP, yiaddr=ZERO_IP, siaddr=ZERO_IP,
+		giaddr=ZERO_IP):
+	"""Build a complete Ethernet/IPv4/UDP/BOOTP frame (UDP checksum unset)."""
+	bootp = BOOTP.pack(op, 1, 6, 0, xid, 0, flags, ciaddr, yiaddr, siaddr, giaddr,
+		chaddr, b'', b'', MAGIC_COOKIE) + encode_options(options)
+	udp_len = UDP.size + len(bootp)
+	ip_len = IPV4.size + udp_len
+	ip_header = IPV4.pack(0x45, 0, ip_len, 0, 0, 64, IPPROTO_UDP, 0, ip_src, ip_dst)
+	ip_header = ip_header[:10] + struct.pack('!H', ip_checksum(ip_header)) + ip_header[12:]
+	return (ETHERNET.pack(eth_dst, eth_src, ETH_P_IP) + ip_header
+		+ UDP.pack(sport, dport, udp_len, 0) + bootp)
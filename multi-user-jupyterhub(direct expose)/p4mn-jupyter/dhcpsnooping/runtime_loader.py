@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# Programs switches from runtime JSON files (the table_entries format of
+# s1-runtime.json): names are resolved against the p4info before connecting,
+# the tables are read back once, and only the difference is written, in a
+# single request per switch, all switches at the same time.
+import sys
+import json
+import time
+import asyncio
+import argparse
+from pathlib import Path
+
+import finsy as fy
+
+DEFAULT_GRPC_PORT = 50051  # first switch, the next ones count up
+DEFAULT_DEVICE_ID = 0
+# Above finsy's default (10) used by dhcp-snoop-controller.py: the loader is
+# primary while it writes, the controller is backup until it disconnects
+LOADER_ELECTION_ID = 20
+
+
+class RuntimeFile:
+	"""Desired table entries of one switch, encoded against its p4info."""
+
+	def __init__(self, path):
+		self.path = Path(path)
+		with open(self.path) as f:
+			runtime = json.load(f)
+		base = self.path.parent
+		self.p4info = base / runtime['p4info']
+		self.bmv2_json = base / runtime['bmv2_json'] if runtime.get('bmv2_json') else None
+		self.schema = fy.P4Schema(self.p4info)
+		# Encoding resolves every table, field, action and parameter name.
+		# Specs are kept, not entries: an entry takes only one update type.
+		self.desired = {}
+		for spec in runtime.get('table_entries', []):
+			try:
+				self.desired[entry_key(table_entry(spec).encode_entry(self.schema))] = spec
+			except Exception as e:
+				raise ValueError(f"{self.path}: {spec}: {e}") from None
+		self.tables = sorted({spec['table'] for spec in self.desired.values()})
+
+
+def match_value(value):
+	# [value, prefix_len], [value, mask] and [low, high] are lists in JSON
+	return tuple(value) if isinstance(value, list) else value
+
+
+def table_entry(spec):
+	"""P4TableEntry of one table_entries item."""
+	action = None
+	if 'action_name' in spec:
+		action = fy.Action(spec['action_name'], **spec.get('action_params', {}))
+	if spec.get('default_action'):
+		return fy.P4TableEntry(spec['table'], action=action, is_default_action=True)
+	match = fy.Match(**{name: match_value(v) for name, v in spec.get('match', {}).items()})
+	return fy.P4TableEntry(spec['table'], match=match, action=action,
+		priority=spec.get('priority', 0))
+
+
+def entry_key(msg):
+	"""Identity of an encoded TableEntry: table, match and priority."""
+	if msg.is_default_action:
+		return (msg.table_id, 'default')
+	match = tuple(sorted(m.SerializeToString(deterministic=True) for m in msg.match))
+	return (msg.table_id, match, msg.priority)
+
+
+def entry_action(msg):
+	return msg.action.SerializeToString(deterministic=True)
+
+
+async def plan(switch, runtime, prune=False):
+	"""Updates that turn the tables of the switch into the runtime file."""
+	schema = switch.p4info
+	filters = [fy.P4TableEntry(table) for table in runtime.tables]
+	filters += [fy.P4TableEntry(table, is_default_action=True) for table in runtime.tables]
+	current = {}
+	async for entry in switch.read(filters):
+		msg = entry.encode_entry(schema)
+		current[entry_key(msg)] = (entry, entry_action(msg))
+
+	updates = []
+	counts = {'inserted': 0, 'modified': 0, 'unchanged': 0, 'deleted': 0}
+	for key, spec in runtime.desired.items():
+		entry = table_entry(spec)
+		action = entry_action(entry.encode_entry(schema))
+		installed = current.get(key)
+		if installed is not None and installed[1] == action:
+			counts['unchanged'] += 1
+		elif installed is not None or entry.is_default_action:
+			updates.append(~entry)
+			counts['modified'] += 1
+		else:
+			updates.append(+entry)
+			counts['inserted'] += 1
+	if prune:
+		for key, (entry, _) in current.items():
+			if key not in runtime.desired and not entry.is_default_action:
+				updates.append(-entry)
+				counts['deleted'] += 1
+	return updates, counts
+
+
+async def load(name, address, device_id, runtime, prune=False, set_pipeline=False):
+	"""Connect, diff and write one switch; returns a report line. Only with
+	set_pipeline is the bmv2 JSON given to finsy, which then installs the
+	pipeline (clearing every table) unless the switch has its cookie."""
+	p4blob = runtime.bmv2_json if set_pipeline else None
+	opts = fy.SwitchOptions(p4info=runtime.p4info, p4blob=p4blob, device_id=device_id,
+		initial_election_id=LOADER_ELECTION_ID)
+	start = time.perf_counter()
+	async with fy.Switch(name, address, opts) as switch:
+		connected = time.perf_counter()
+		updates, counts = await plan(switch, runtime, prune)
+		if updates:
+			await switch.write(updates)
+	done = time.perf_counter()
+	return (f"{name}: " + ', '.join(f"{n} {what}" for what, n in counts.items())
+		+ f" in {1 if updates else 0} write ({1000 * (done - connected):.1f} ms,"
+		f" {1000 * (connected - start):.1f} ms to connect)")
+
+
+def switch_files(args):
+	"""[(switch name, runtime file)] from --topo and the file arguments."""
+	files = []
+	if args.topo:
+		with open(args.topo) as f:
+			topo = json.load(f)
+		for name, switch in topo['switches'].items():
+			if 'runtime_json' in switch:
+				files.append((name, args.topo.parent / switch['runtime_json']))
+	for path in args.files:
+		name = path.stem.split('-runtime')[0]
+		files.append((name, path))
+	return files
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Install runtime JSON table entries')
+	parser.add_argument('files', nargs='*', type=Path,
+		help='runtime files, the switch name is the part before -runtime.json')
+	parser.add_argument('--topo', type=Path, default=None,
+		help='topology.json, loads the runtime_json of every switch')
+	parser.add_argument('--grpc-host', default='127.0.0.1')
+	parser.add_argument('--grpc-port', type=int, default=DEFAULT_GRPC_PORT,
+		help='port of the first switch, the next switches count up')
+	parser.add_argument('--device-id', type=int, default=DEFAULT_DEVICE_ID,
+		help='device id of the first switch, the next switches count up')
+	parser.add_argument('--prune', action='store_true',
+		help='delete entries of the listed tables that are not in the file')
+	parser.add_argument('--set-pipeline', action='store_true',
+		help='install bmv2_json first if the switch runs another pipeline (clears all tables)')
+	args = parser.parse_args()
+
+	switches = switch_files(args)
+	if not switches:
+		parser.error('no runtime files, give files or --topo')
+	try:
+		runtimes = [RuntimeFile(path) for _, path in switches]
+	except (OSError, ValueError) as e:
+		sys.exit(str(e))
+	if args.set_pipeline:
+		for (_, path), runtime in zip(switches, runtimes):
+			if runtime.bmv2_json is None:
+				sys.exit(f"{path}: --set-pipeline needs bmv2_json")
+
+	async def load_all():
+		start = time.perf_counter()
+		results = await asyncio.gather(*(
+			load(name, f"{args.grpc_host}:{args.grpc_port + i}", args.device_id + i,
+				runtime, args.prune, args.set_pipeline)
+			for i, ((name, _), runtime) in enumerate(zip(switches, runtimes))),
+			return_exceptions=True)
+		for (name, _), result in zip(switches, results):
+			print(f"{name}: {result}" if isinstance(result, Exception) else result)
+		print(f"{len(switches)} switches in {time.perf_counter() - start:.2f}s")
+
+	fy.run(load_all())
+
+if __name__ == '__main__':
+	main()
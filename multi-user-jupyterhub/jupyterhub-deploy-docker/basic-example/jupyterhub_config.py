@@ -40,7 +40,20 @@ c.DockerSpawner.default_url = '/lab/tree/Home_page.ipynb'
 
 # Mount the real user's Docker volume on the host to the notebook user's
 # notebook directory in the container
-c.DockerSpawner.volumes = {"jupyterhub-user-{username}": notebook_dir}
+c.DockerSpawner.volumes = {
+    "jupyterhub-user-{username}": notebook_dir,
+    # p4c compile cache shared by all users (p4c_cache.py). Users are root
+    # in their privileged containers and can remount it, what protects the
+    # others is that p4c_cache.py checks every file against the catalog
+    # with the digest below
+    "p4c-cache": {"bind": "/var/cache/p4c", "mode": "ro"},
+}
+
+# Digest printed by p4c_cache.py --cache-seal when the admin filled p4c-cache;
+# unset, the shared cache is not used
+c.DockerSpawner.environment = {
+    "P4C_CACHE_SHARED_DIGEST": os.environ.get("P4C_CACHE_SHARED_DIGEST", ""),
+}
 
 c.Spawner.http_timeout = 120
 
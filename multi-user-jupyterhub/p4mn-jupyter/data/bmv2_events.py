@@ -0,0 +1,258 @@
+# coding=utf-8
+"""
+Reads the event logger stream of BMv2 switches started with elogger=true
+(--nanolog ipc:///tmp/bmv2-<name>-nanolog.ipc) and keeps live per-table,
+per-action and per-port counters.
+
+Every event is a packed binary message (bmv2 src/bm_sim/event_logger.cpp):
+a header of type, switch id, context id, packet signature, packet id and
+copy id, followed by type specific fields. Only the fields the counters need
+are unpacked, straight into arrays indexed by table, action or port id, so a
+packet costs a few struct.unpack_from calls instead of formatting and parsing
+debug log lines.
+
+    sudo mn --custom new_bmv2.py --switch simple_switch_grpc,elogger=true ...
+    python3 bmv2_events.py --json basic.json
+"""
+import argparse
+import glob
+import json
+import selectors
+import struct
+import time
+from array import array
+
+import nnpy
+
+NANOLOG_PATTERN = 'ipc:///tmp/bmv2-%s-nanolog.ipc'
+REPORT_INTERVAL = 5  # seconds
+
+# Message types of the bmv2 event logger, in its order
+(PACKET_IN, PACKET_OUT,
+ PARSER_START, PARSER_DONE, PARSER_EXTRACT,
+ DEPARSER_START, DEPARSER_DONE, DEPARSER_EMIT,
+ CHECKSUM_UPDATE,
+ PIPELINE_START, PIPELINE_DONE,
+ CONDITION_EVAL, TABLE_HIT, TABLE_MISS,
+ ACTION_EXECUTE) = range(15)
+CONFIG_CHANGE = 999
+CONFIG_CHANGE_SLOT = ACTION_EXECUTE + 1  # index of CONFIG_CHANGE in the counts
+TYPE_NAMES = {
+    PACKET_IN: 'packet in', PACKET_OUT: 'packet out',
+    PARSER_START: 'parser start', PARSER_DONE: 'parser done',
+    PARSER_EXTRACT: 'parser extract', DEPARSER_START: 'deparser start',
+    DEPARSER_DONE: 'deparser done', DEPARSER_EMIT: 'deparser emit',
+    CHECKSUM_UPDATE: 'checksum update', PIPELINE_START: 'pipeline start',
+    PIPELINE_DONE: 'pipeline done', CONDITION_EVAL: 'condition eval',
+    TABLE_HIT: 'table hit', TABLE_MISS: 'table miss',
+    ACTION_EXECUTE: 'action execute', CONFIG_CHANGE: 'config change',
+}
+
+# type, switch_id, cxt_id, sig, id, copy_id
+HEADER = struct.Struct('<iiiQQQ')
+# First int after the header: port for packet in/out, table id for hit/miss,
+# action id for action execute
+FIRST_FIELD = struct.Struct('<i')
+
+
+class P4Names(object):
+    """
+    Table and action names by id, from the bmv2 JSON of the P4 program.
+    """
+
+    def __init__(self, path=None):
+        self.tables = {}
+        self.actions = {}
+        if path is not None:
+            with open(path) as f:
+                config = json.load(f)
+            for pipeline in config.get('pipelines', []):
+                for table in pipeline.get('tables', []):
+                    self.tables[table['id']] = table['name']
+            for action in config.get('actions', []):
+                self.actions[action['id']] = action['name']
+
+    def table(self, id_):
+        return self.tables.get(id_, 'table %d' % id_)
+
+    def action(self, id_):
+        return self.actions.get(id_, 'action %d' % id_)
+
+
+class EventCounters(object):
+    """
+    Per-table, per-action and per-port counters of one switch in arrays of
+    unsigned 64-bit ints, grown on demand to the highest id seen.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.types = array('Q', [0] * (CONFIG_CHANGE_SLOT + 1))
+        self.hits = array('Q')
+        self.misses = array('Q')
+        self.actions = array('Q')
+        self.portIn = array('Q')
+        self.portOut = array('Q')
+        self.malformed = 0
+        self.byType = {PACKET_IN: self.portIn, PACKET_OUT: self.portOut,
+                       TABLE_HIT: self.hits, TABLE_MISS: self.misses,
+                       ACTION_EXECUTE: self.actions}
+
+    @staticmethod
+    def bump(counters, index):
+        if index >= len(counters):
+            counters.extend([0] * (index + 1 - len(counters)))
+        counters[index] += 1
+
+    def feed(self, msg):
+        """
+        Counts one event logger message.
+        """
+        if len(msg) < HEADER.size:
+            self.malformed += 1
+            return
+        msgType = HEADER.unpack_from(msg)[0]
+        if msgType == CONFIG_CHANGE:
+            self.types[CONFIG_CHANGE_SLOT] += 1
+            return
+        if not 0 <= msgType < CONFIG_CHANGE_SLOT:
+            self.malformed += 1
+            return
+        self.types[msgType] += 1
+        counters = self.byType.get(msgType)
+        if counters is not None:
+            if len(msg) < HEADER.size + FIRST_FIELD.size:
+                self.malformed += 1
+                return
+            index = FIRST_FIELD.unpack_from(msg, HEADER.size)[0]
+            if index >= 0:
+                self.bump(counters, index)
+
+    def packets(self):
+        return sum(self.portIn)
+
+    def summary(self, names):
+        lines = ['%s: %d packets in, %d out' % (
+            self.name, self.packets(), sum(self.portOut))]
+        for port in range(max(len(self.portIn), len(self.portOut))):
+            rx = self.portIn[port] if port < len(self.portIn) else 0
+            tx = self.portOut[port] if port < len(self.portOut) else 0
+            if rx or tx:
+                lines.append('  port %d: in %d, out %d' % (port, rx, tx))
+        for table in range(max(len(self.hits), len(self.misses))):
+            hits = self.hits[table] if table < len(self.hits) else 0
+            misses = self.misses[table] if table < len(self.misses) else 0
+            if hits or misses:
+                lines.append('  %s: %d hit, %d miss (%.1f%% hit)' % (
+                    names.table(table), hits, misses,
+                    100.0 * hits / (hits + misses)))
+        for action, count in enumerate(self.actions):
+            if count:
+                lines.append('  %s: %d' % (names.action(action), count))
+        others = []
+        for t, count in enumerate(self.types):
+            if count and t not in self.byType:
+                name = TYPE_NAMES[CONFIG_CHANGE if t == CONFIG_CHANGE_SLOT else t]
+                others.append('%s %d' % (name, count))
+        if others:
+            lines.append('  other events: ' + ', '.join(others))
+        if self.malformed:
+            lines.append('  %d malformed messages' % self.malformed)
+        return '\n'.join(lines)
+
+
+class EventConsumer(object):
+    """
+    Subscribes to the nanolog socket of any number of switches and reads all
+    of them from one selector, draining each socket when it is readable.
+    """
+
+    def __init__(self, names=None):
+        self.names = names or P4Names()
+        self.sel = selectors.DefaultSelector()
+        self.sockets = {}
+        self.counters = {}
+
+    def add(self, switch, address=None):
+        sock = nnpy.Socket(nnpy.AF_SP, nnpy.SUB)
+        sock.setsockopt(nnpy.SUB, nnpy.SUB_SUBSCRIBE, '')
+        sock.connect(address or NANOLOG_PATTERN % switch)
+        fd = sock.getsockopt(nnpy.SOL_SOCKET, nnpy.RCVFD)
+        self.sockets[switch] = sock
+        self.counters[switch] = EventCounters(switch)
+        self.sel.register(fd, selectors.EVENT_READ, switch)
+
+    def addAll(self):
+        """
+        Subscribes to every /tmp/bmv2-<name>-nanolog.ipc.
+        """
+        prefix, suffix = '/tmp/bmv2-', '-nanolog.ipc'
+        for path in sorted(glob.glob(prefix + '*' + suffix)):
+            name = path[len(prefix):-len(suffix)]
+            if name not in self.sockets:
+                self.add(name)
+
+    def drain(self, switch):
+        sock = self.sockets[switch]
+        counters = self.counters[switch]
+        while True:
+            try:
+                msg = sock.recv(flags=nnpy.DONTWAIT)
+            except nnpy.NNError:
+                return
+            counters.feed(msg)
+
+    def poll(self, timeout=None):
+        for key, _ in self.sel.select(timeout):
+            self.drain(key.data)
+
+    def run(self, interval=REPORT_INTERVAL, callback=print):
+        """
+        Consumes events forever, passing the summary of every switch that
+        saw packets to callback once per interval.
+        """
+        seen = {}
+        nextReport = time.time() + interval
+        while True:
+            self.poll(max(0, nextReport - time.time()))
+            if time.time() >= nextReport:
+                nextReport += interval
+                for switch, counters in self.counters.items():
+                    packets = counters.packets()
+                    if packets != seen.get(switch):
+                        seen[switch] = packets
+                        callback(counters.summary(self.names))
+
+    def close(self):
+        self.sel.close()
+        for sock in self.sockets.values():
+            sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='BMv2 event logger consumer')
+    parser.add_argument('switches', nargs='*',
+                        help='switch names, default every nanolog socket in /tmp')
+    parser.add_argument('--json', default=None,
+                        help='bmv2 JSON of the P4 program, for table and action names')
+    parser.add_argument('--interval', type=float, default=REPORT_INTERVAL)
+    args = parser.parse_args()
+
+    consumer = EventConsumer(P4Names(args.json))
+    for name in args.switches:
+        consumer.add(name)
+    if not args.switches:
+        consumer.addAll()
+    if not consumer.sockets:
+        parser.error('no nanolog sockets, start the switches with elogger=true')
+    print('reading events of %s' % ', '.join(sorted(consumer.sockets)))
+    try:
+        consumer.run(args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        consumer.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,319 @@
+# coding=utf-8
+"""
+Tails the console logs of all BMv2 switches (/tmp/bmv2-<name>-log) from a
+single asyncio task and turns table hit/miss, action, drop and port lines
+into structured events.
+
+Every log is read from the offset where the previous read stopped, so no
+byte is read twice, and a log that start() truncates or replaces is picked
+up from its new beginning. Per switch only counters and a bounded window of
+recent events are kept, never raw text, so memory does not grow with the
+log. Table and action lines are only written with loglevel=debug (or
+trace), e.g. mn --switch onosbmv2,loglevel=debug.
+
+    tailer = LogTailer()
+    tailer.addAll()
+    asyncio.ensure_future(tailer.run())
+    ...
+    for name, stats in tailer.stats.items():
+        print(name, stats.hitRates())
+
+python bmv2_logs.py [switch ...] prints a summary of every switch at most
+once per --interval seconds.
+"""
+import argparse
+import asyncio
+import collections
+import glob
+import os
+import re
+import time
+
+LOG_PATTERN = '/tmp/bmv2-%s-log'
+POLL_INTERVAL = 0.1  # seconds between reads when no log has grown
+READ_SIZE = 1 << 16  # bytes read per log and round, so no log starves others
+MAX_LINE = 1 << 14  # longer partial lines are dropped, not buffered
+HEAD_SIZE = 64  # bytes at the start of a log compared to notice a rewrite
+RECENT_EVENTS = 256  # events kept per switch
+SUMMARY_INTERVAL = 5  # seconds, at most one summary per switch
+
+# [time] [bmv2] [level] [thread n] [pkt id] [cxt n] message
+LINE_RE = re.compile(
+    r'^\[(?P<time>[\d:.]+)\] \[[^\]]*\] \[(?P<level>\w)\] \[thread \d+\]'
+    r'(?: \[(?P<pkt>[\d.]+)\])?(?: \[cxt \d+\])? (?P<msg>.*)$')
+EVENT_RES = [
+    ('hit', re.compile(r"^Table '(?P<name>[^']+)': hit")),
+    ('miss', re.compile(r"^Table '(?P<name>[^']+)': miss")),
+    ('action', re.compile(r'^Action entry is (?P<name>\S+)')),  # debug, once per table action
+    ('drop', re.compile(r'^Dropping packet at the end of (?P<name>\w+)')),
+    ('rx', re.compile(r'^Processing packet received on port (?P<name>\d+)')),
+    ('tx', re.compile(r'^Transmitting packet of size \d+ out of port '
+                      r'(?P<name>\d+)')),
+]
+
+
+class LogEvent(object):
+    __slots__ = ('switch', 'time', 'kind', 'name', 'packet')
+
+    def __init__(self, switch, time, kind, name, packet):
+        self.switch = switch
+        self.time = time
+        self.kind = kind
+        self.name = name
+        self.packet = packet
+
+    def __repr__(self):
+        return '%s %s %s %s %s' % (self.time, self.switch, self.kind,
+                                   self.name, self.packet or '-')
+
+
+def parseLine(switch, line):
+    """
+    Returns the LogEvent of a log line, or None for lines that are not table,
+    action, drop or port events.
+    """
+    m = LINE_RE.match(line)
+    if m is None:
+        return None
+    msg = m.group('msg')
+    for kind, regex in EVENT_RES:
+        e = regex.match(msg)
+        if e is not None:
+            return LogEvent(switch, m.group('time'), kind, e.group('name'),
+                            m.group('pkt'))
+    return None
+
+
+class SwitchLogStats(object):
+    """
+    Counters of one switch, plus its last RECENT_EVENTS events.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+        self.actions = collections.Counter()
+        self.drops = collections.Counter()
+        self.rx = collections.Counter()
+        self.tx = collections.Counter()
+        self.recent = collections.deque(maxlen=RECENT_EVENTS)
+        self.lines = 0
+        self.bytes = 0
+        self.truncations = 0
+        self.changed = False
+        self.counters = {'hit': self.hits, 'miss': self.misses,
+                         'action': self.actions, 'drop': self.drops,
+                         'rx': self.rx, 'tx': self.tx}
+
+    def add(self, event):
+        self.counters[event.kind][event.name] += 1
+        self.recent.append(event)
+        self.changed = True
+
+    def hitRates(self):
+        """
+        Returns {table: (hits, misses, hit rate)}.
+        """
+        rates = {}
+        for table in set(self.hits) | set(self.misses):
+            hits, misses = self.hits[table], self.misses[table]
+            rates[table] = (hits, misses, float(hits) / (hits + misses))
+        return rates
+
+    def summary(self):
+        parts = ['%s: %d lines, rx %d, tx %d, drops %d' % (
+            self.name, self.lines, sum(self.rx.values()),
+            sum(self.tx.values()), sum(self.drops.values()))]
+        for table, (hits, misses, rate) in sorted(self.hitRates().items()):
+            parts.append('  %s: %d hit, %d miss (%.1f%% hit)' % (
+                table, hits, misses, 100 * rate))
+        for action, count in self.actions.most_common(5):
+            parts.append('  %s: %d' % (action, count))
+        return '\n'.join(parts)
+
+
+class TailedLog(object):
+    """
+    Read position in one log file. The file stays open; if it shrinks, its
+    first bytes change (truncated and written again since the last read) or
+    its inode changes (removed and created again), reading restarts at its
+    beginning.
+    """
+
+    def __init__(self, switch, path):
+        self.switch = switch
+        self.path = path
+        self.fd = None
+        self.inode = None
+        self.offset = 0
+        self.partial = b''
+        self.head = b''
+
+    def reopen(self):
+        self.close()
+        try:
+            self.fd = os.open(self.path, os.O_RDONLY)
+        except OSError:
+            return False
+        self.inode = os.fstat(self.fd).st_ino
+        self.offset = 0
+        self.partial = b''
+        self.head = b''
+        return True
+
+    def rewritten(self, size):
+        try:
+            inode = os.stat(self.path).st_ino
+        except OSError:
+            inode = None
+        if (inode is not None and inode != self.inode) or size < self.offset:
+            return True
+        return bool(self.head) and os.pread(self.fd, len(self.head), 0) != self.head
+
+    def read(self, stats):
+        """
+        Reads at most READ_SIZE new bytes, returns the complete lines.
+        """
+        if self.fd is None and not self.reopen():
+            return []
+        size = os.fstat(self.fd).st_size
+        if self.rewritten(size):
+            stats.truncations += 1
+            if not self.reopen():
+                return []
+            size = os.fstat(self.fd).st_size
+        if size == self.offset:
+            return []
+        data = os.pread(self.fd, min(READ_SIZE, size - self.offset),
+                        self.offset)
+        if len(self.head) < HEAD_SIZE and self.offset < HEAD_SIZE:
+            self.head = (self.head + data)[:HEAD_SIZE]
+        self.offset += len(data)
+        stats.bytes += len(data)
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+        if len(self.partial) > MAX_LINE:
+            self.partial = b''
+        return lines
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class LogTailer(object):
+    """
+    Tails any number of switch logs from one asyncio task.
+    """
+
+    def __init__(self, fromStart=False):
+        self.logs = {}
+        self.stats = {}
+        self.fromStart = fromStart
+        self.listeners = []
+
+    def add(self, switch, path=None):
+        log = TailedLog(switch, path or LOG_PATTERN % switch)
+        if log.reopen() and not self.fromStart:
+            # Only what is logged from now on
+            log.offset = os.fstat(log.fd).st_size
+            log.head = os.pread(log.fd, HEAD_SIZE, 0)
+        self.logs[switch] = log
+        self.stats[switch] = SwitchLogStats(switch)
+
+    def addAll(self):
+        """
+        Adds every /tmp/bmv2-<name>-log that is not tailed yet.
+        """
+        prefix, suffix = LOG_PATTERN.split('%s')
+        for path in sorted(glob.glob(LOG_PATTERN % '*')):
+            name = path[len(prefix):-len(suffix)]
+            if name not in self.logs:
+                self.add(name, path)
+
+    def remove(self, switch):
+        self.logs.pop(switch).close()
+        return self.stats.pop(switch)
+
+    def onEvent(self, callback):
+        """
+        callback(event) is called for every parsed event.
+        """
+        self.listeners.append(callback)
+
+    def poll(self):
+        """
+        Reads every log once, returns the number of new lines.
+        """
+        count = 0
+        for switch, log in list(self.logs.items()):
+            stats = self.stats[switch]
+            lines = log.read(stats)
+            stats.lines += len(lines)
+            count += len(lines)
+            for raw in lines:
+                event = parseLine(switch, raw.decode('utf-8', 'replace'))
+                if event is not None:
+                    stats.add(event)
+                    for callback in self.listeners:
+                        callback(event)
+        return count
+
+    async def run(self, interval=POLL_INTERVAL):
+        # Logs that still have data are read again at once, idle ones wait
+        while True:
+            if not self.poll():
+                await asyncio.sleep(interval)
+            else:
+                await asyncio.sleep(0)
+
+    async def summaries(self, interval=SUMMARY_INTERVAL,
+                        callback=print):
+        """
+        Passes the summary of every switch whose counters changed to
+        callback, at most once per interval.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            for stats in list(self.stats.values()):
+                if stats.changed:
+                    stats.changed = False
+                    callback(stats.summary())
+
+    def close(self):
+        for log in self.logs.values():
+            log.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tail BMv2 switch logs')
+    parser.add_argument('switches', nargs='*',
+                        help='switch names, default all /tmp/bmv2-*-log')
+    parser.add_argument('--interval', type=float, default=SUMMARY_INTERVAL,
+                        help='seconds between summaries of one switch')
+    parser.add_argument('--from-start', action='store_true',
+                        help='parse what is already in the logs too')
+    args = parser.parse_args()
+
+    tailer = LogTailer(fromStart=args.from_start)
+    for name in args.switches:
+        tailer.add(name)
+    if not args.switches:
+        tailer.addAll()
+    print('tailing %d logs at %s' % (len(tailer.logs), time.strftime('%X')))
+
+    async def tail():
+        await asyncio.gather(tailer.run(), tailer.summaries(args.interval))
+
+    try:
+        asyncio.run(tail())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        tailer.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -14,11 +14,17 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+import errno
+import glob
+import heapq
 import json
 import multiprocessing
 import os
+import random
+import selectors
+import shutil
 import socket
-import sys
+import subprocess
 import threading
 import time
 from contextlib import closing
@@ -30,9 +36,33 @@ SIMPLE_SWITCH_GRPC = 'simple_switch_grpc'
 PKT_BYTES_TO_DUMP = 80
 VALGRIND_PREFIX = 'valgrind --leak-check=yes'
 SWITCH_START_TIMEOUT = 10  # seconds
+# Refused gRPC probes are retried after PROBE_BACKOFF_MIN seconds, doubling
+# up to PROBE_BACKOFF_MAX, so a switch is seen within ms of opening its port
+PROBE_BACKOFF_MIN = 0.001
+PROBE_BACKOFF_MAX = 0.02
+# A single supervisor thread watches all switches: keepalive files are checked
+# every SUPERVISOR_TICK seconds and each switch gets a gRPC probe every
+# SUPERVISOR_PROBE_INTERVAL seconds. A switch that fails
+# SUPERVISOR_PROBE_FAILURES probes in a row is considered hung.
+SUPERVISOR_TICK = 1
+SUPERVISOR_PROBE_INTERVAL = 10
+SUPERVISOR_PROBE_FAILURES = 3
+# Seconds bmv2 gets to exit on SIGTERM at shutdown before it is SIGKILLed
+SHUTDOWN_GRACE = 2
+# Switches with cpulimit/memlimit get their own cgroup v2 group below
+# CGROUP_ROOT/CGROUP_PARENT, cpu.max uses a period of CGROUP_PERIOD us.
+CGROUP_ROOT = '/sys/fs/cgroup'
+CGROUP_PARENT = 'mininet-bmv2'
+CGROUP_PERIOD = 100000
+PLACEMENT_STRATEGIES = ['spread', 'pack']
+# Startup latency histogram kept across runs
+STARTUP_LATENCY_FILE = '/tmp/bmv2-startup-latency.json'
+STARTUP_LATENCY_BOUNDS = [25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]  # ms
 BMV2_LOG_LINES = 5
 BMV2_DEFAULT_DEVICE_ID = 1
 DEFAULT_PIPECONF = "org.onosproject.pipelines.basic"
+OFFLOAD_FEATURES = ["rx", "tx", "sg"]
+IPV6_DISABLE_CONFS = ["all", "default", "lo"]
 
 # Stratum paths relative to stratum repo root
 STRATUM_BMV2 = 'stratum_bmv2'
@@ -66,47 +96,581 @@ def writeToFile(path, value):
         f.write(str(value))
 
 
-def watchDog(sw):
+def openPidfd(pid):
+    """
+    Returns a file descriptor that becomes readable when pid exits, or None if
+    the kernel (< 5.3) or Python (< 3.9) has no pidfd_open.
+    """
     try:
-        writeToFile(sw.keepaliveFile,
-                    "Remove this file to terminate %s" % sw.name)
+        return os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        return None
+
+
+def parseCpuList(cpus):
+    """
+    Returns the cores of a taskset style list ('0-3,6') or of a list of ints,
+    sorted.
+    """
+    if isinstance(cpus, (list, tuple, set)):
+        return sorted(int(c) for c in cpus)
+    cores = set()
+    for part in str(cpus).split(','):
+        first, _, last = part.strip().partition('-')
+        cores.update(range(int(first), int(last or first) + 1))
+    return sorted(cores)
+
+
+def planCores(count, strategy='spread', coresPerSwitch=1, switchesPerCore=1,
+              reserve=0):
+    """
+    Returns the cores for each of count switches, out of the cores this
+    process may run on minus the first reserve ones, which are left to the
+    controller and traffic generators. "spread" hands out core sets round
+    robin, switches only share one once every set is in use. "pack" puts
+    switchesPerCore switches on a set before moving to the next one.
+    """
+    if strategy not in PLACEMENT_STRATEGIES:
+        raise ValueError("unknown placement strategy %s" % strategy)
+    cores = sorted(os.sched_getaffinity(0))[reserve:]
+    if not cores:
+        raise Exception("No cores left after reserving %d" % reserve)
+    coresPerSwitch = min(coresPerSwitch, len(cores))
+    sets = [cores[i:i + coresPerSwitch] for i in
+            range(0, len(cores) - coresPerSwitch + 1, coresPerSwitch)]
+    if strategy == 'spread':
+        return [sets[i % len(sets)] for i in range(count)]
+    return [sets[(i // switchesPerCore) % len(sets)] for i in range(count)]
+
+
+def cgroupLimit(name, pid, cpulimit=None, memlimit=None):
+    """
+    Moves pid into its own cgroup v2 group with cpu.max set to cpulimit cores
+    and memory.max to memlimit. Returns the group path, or None if cgroup v2
+    or its cpu/memory controllers are not available (the switch then runs
+    without limits).
+    """
+    controllers = [c for c, limit in (("cpu", cpulimit), ("memory", memlimit))
+                   if limit]
+    parent = os.path.join(CGROUP_ROOT, CGROUP_PARENT)
+    group = os.path.join(parent, name)
+    try:
+        if not os.path.isfile(os.path.join(CGROUP_ROOT, "cgroup.controllers")):
+            raise OSError(errno.ENOENT,
+                          "cgroup v2 is not mounted on %s" % CGROUP_ROOT)
+        enable = " ".join("+" + c for c in controllers)
+        writeToFile(os.path.join(CGROUP_ROOT, "cgroup.subtree_control"), enable)
+        if not os.path.isdir(parent):
+            os.mkdir(parent)
+        writeToFile(os.path.join(parent, "cgroup.subtree_control"), enable)
+        if not os.path.isdir(group):
+            os.mkdir(group)
+        if cpulimit:
+            writeToFile(os.path.join(group, "cpu.max"), "%d %d" % (
+                int(float(cpulimit) * CGROUP_PERIOD), CGROUP_PERIOD))
+        if memlimit:
+            writeToFile(os.path.join(group, "memory.max"), memlimit)
+        writeToFile(os.path.join(group, "cgroup.procs"), pid)
+        return group
+    except (IOError, OSError) as e:
+        warn("*** %s runs without cgroup limits: %s\n" % (name, e))
+        return None
+
+
+def printPlacement(switches):
+    """
+    Prints the cores each switch process really runs on and its limits.
+    """
+    print("%-8s %8s %-12s %-12s %8s %10s" % (
+        "switch", "pid", "cpus", "affinity", "cpu max", "mem max"))
+    used = set()
+    for sw in switches:
+        pid = sw.bmv2popen.pid if sw.bmv2popen else None
+        try:
+            affinity = sorted(os.sched_getaffinity(pid)) if pid else []
+        except OSError:
+            affinity = []
+        used.update(affinity)
+        print("%-8s %8s %-12s %-12s %8s %10s" % (
+            sw.name, pid or "-",
+            ",".join(map(str, sw.cpus)) if sw.cpus else "any",
+            ",".join(map(str, affinity)) or "-",
+            sw.cpulimit or "-", sw.memlimit or "-"))
+    print("%d switches on %d of %d cores" % (
+        len(switches), len(used), os.cpu_count()))
+
+
+def reapProcesses(popens, grace=SHUTDOWN_GRACE):
+    """
+    Waits for all already signalled popens together and SIGKILLs the ones
+    still running after grace seconds. Returns how many were killed.
+    """
+    deadline = time.time() + grace
+    delay = PROBE_BACKOFF_MIN
+    pending = [p for p in popens if p.poll() is None]
+    while pending and time.time() < deadline:
+        time.sleep(min(delay, max(0, deadline - time.time())))
+        delay = min(delay * 2, PROBE_BACKOFF_MAX)
+        pending = [p for p in pending if p.poll() is None]
+    for popen in pending:
+        popen.kill()
+    for popen in pending:
+        popen.wait()
+    return len(pending)
+
+
+def deleteIntfs(names):
+    """
+    Deletes root namespace interfaces with a single ip -batch instead of one
+    "ip link del" per interface.
+    """
+    if not names:
+        return
+    result = subprocess.run(['ip', '-force', '-batch', '-'], input="".join(
+        "link del %s\n" % name for name in names), universal_newlines=True,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if result.returncode:
+        warn("*** Deleting interfaces: %s\n" % result.stdout.strip())
+
+
+def deleteLinks(links):
+    """
+    Deletes the veth pairs of all links with one ip -batch in the root
+    namespace (deleting one end removes its peer too) instead of the
+    "ip link del" per interface of Link.stop(). Returns how many were
+    deleted in the batch.
+    """
+    names = []
+    for link in links:
+        intfs = (link.intf1, link.intf2)
+        rootIntf = [i for i in intfs if not i.node.inNamespace]
+        if not rootIntf:
+            link.stop()
+            continue
+        names.append(rootIntf[0].name)
+        for intf in intfs:
+            intf.node.delIntf(intf)
+            intf.link = None
+        link.intf1 = link.intf2 = None
+    deleteIntfs(names)
+    return len(names)
+
+
+def deleteNetworkLinks(net):
+    start = time.time()
+    links = deleteLinks(net.links)
+    net.links = []
+    info("*** Deleted %d links in %.2fs\n" % (links, time.time() - start))
+
+
+def stopNetwork(net):
+    """
+    net.stop() with the links deleted in one batch first, Mininet.stop()
+    would delete them one by one before batchShutdown() stops the switches.
+    Use it instead of net.stop() in scripts.
+    """
+    start = time.time()
+    deleteNetworkLinks(net)
+    net.stop()
+    info("*** Network torn down in %.2fs\n" % (time.time() - start))
+
+
+def cliThenDeleteLinks(net):
+    """
+    The mn CLI, then the links deleted in one batch, so that the net.stop()
+    of mn only has the switches and hosts left:
+    sudo mn --custom new_bmv2.py --switch simple_switch_grpc --test batchcli
+    """
+    from mininet.cli import CLI
+    CLI(net)
+    deleteNetworkLinks(net)
+
+
+class StartupWaiter(object):
+    """
+    Waits for the gRPC port of many switches on a single selector.
+
+    Every switch gets a non-blocking connect to its port. Refused probes are
+    retried with exponential backoff, and a pidfd tells us when the process
+    dies, so a crashed switch fails right away instead of at the timeout.
+    Without pidfd support the processes are polled at PROBE_BACKOFF_MAX.
+    """
+
+    def __init__(self, switches, timeout=SWITCH_START_TIMEOUT):
+        self.sel = selectors.DefaultSelector()
+        self.timeout = timeout
+        self.waiting = set()
+        self.backoff = {}
+        self.retries = []  # heap of (when, seq, switch)
+        self.seq = 0
+        self.pidfds = {}
+        self.failed = []  # (switch, reason)
+        for sw in switches:
+            self.waiting.add(sw)
+            self.backoff[sw] = PROBE_BACKOFF_MIN
+            pidfd = openPidfd(sw.bmv2popen.pid)
+            if pidfd is not None:
+                self.pidfds[sw] = pidfd
+                self.sel.register(pidfd, selectors.EVENT_READ, (sw, None))
+            self.probe(sw)
+
+    def probe(self, sw):
+        port = sw.grpcPortInternal if sw.grpcPortInternal else sw.grpcPort
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        err = sock.connect_ex(('localhost', port))
+        if err == errno.EINPROGRESS:
+            self.sel.register(sock, selectors.EVENT_WRITE, (sw, sock))
+            return
+        # Loopback usually answers (or refuses) right away
+        sock.close()
+        self.probed(sw, err)
+
+    def probed(self, sw, err):
+        if err == 0:
+            self.finish(sw)
+            sw.bmv2Started()
+            return
+        delay = self.backoff[sw]
+        self.backoff[sw] = min(delay * 2, PROBE_BACKOFF_MAX)
+        self.seq += 1
+        heapq.heappush(self.retries, (time.time() + delay, self.seq, sw))
+
+    def finish(self, sw, reason=None):
+        self.waiting.discard(sw)
+        pidfd = self.pidfds.pop(sw, None)
+        if pidfd is not None:
+            self.sel.unregister(pidfd)
+            os.close(pidfd)
+        if reason is not None:
+            sw.starting = False
+            self.failed.append((sw, reason))
+
+    def checkExited(self, sw):
+        code = sw.bmv2popen.poll()
+        if code is not None:
+            self.finish(sw, "exited with status %d" % code)
+
+    def run(self):
+        """
+        Returns the list of (switch, reason) that did not start.
+        """
+        while self.waiting:
+            now = time.time()
+            while self.retries and self.retries[0][0] <= now:
+                _, _, sw = heapq.heappop(self.retries)
+                if sw in self.waiting:
+                    self.probe(sw)
+            for sw in list(self.waiting):
+                if sw not in self.pidfds:
+                    self.checkExited(sw)
+                if sw in self.waiting and now - sw.startTime > self.timeout:
+                    self.finish(sw, "timeout after %ds" % self.timeout)
+            if not self.waiting:
+                break
+            # Sleep until the next retry or deadline, unless something happens
+            wakeup = min(s.startTime for s in self.waiting) + self.timeout
+            if self.retries:
+                wakeup = min(wakeup, self.retries[0][0])
+            if len(self.pidfds) < len(self.waiting):
+                wakeup = min(wakeup, now + PROBE_BACKOFF_MAX)
+            for key, _ in self.sel.select(max(0, wakeup - time.time())):
+                sw, sock = key.data
+                if sock is None:
+                    self.checkExited(sw)
+                    continue
+                self.sel.unregister(sock)
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                sock.close()
+                if sw in self.waiting:
+                    self.probed(sw, err)
+        for key in list(self.sel.get_map().values()):
+            if key.data[1] is not None:
+                key.data[1].close()
+        self.sel.close()
+        return self.failed
+
+
+def recordStartupLatency(times, failures=0):
+    """
+    Adds switch startup times (in seconds) to the histogram kept across runs.
+    """
+    hist = startupLatencyHistogram()
+    for t in times:
+        ms = t * 1000
+        i = 0
+        while i < len(STARTUP_LATENCY_BOUNDS) and ms > STARTUP_LATENCY_BOUNDS[i]:
+            i += 1
+        hist["counts"][i] += 1
+    hist["samples"] += len(times)
+    hist["failures"] += failures
+    tmp = STARTUP_LATENCY_FILE + ".tmp"
+    with open(tmp, 'w') as f:
+        json.dump(hist, f)
+    os.replace(tmp, STARTUP_LATENCY_FILE)
+    return hist
+
+
+def startupLatencyHistogram():
+    """
+    Returns the switch startup latency histogram of all runs so far.
+    counts[i] is the number of starts that took up to bounds_ms[i], the last
+    count holds everything slower.
+    """
+    try:
+        with open(STARTUP_LATENCY_FILE) as f:
+            hist = json.load(f)
+        if hist.get("bounds_ms") == STARTUP_LATENCY_BOUNDS:
+            return hist
+    except (OSError, ValueError):
+        pass
+    return {"bounds_ms": STARTUP_LATENCY_BOUNDS,
+            "counts": [0] * (len(STARTUP_LATENCY_BOUNDS) + 1),
+            "samples": 0, "failures": 0}
+
+
+def reportDeath(sw, reason, restarts):
+    """
+    Default restart policy: reports the switch and leaves it down.
+    """
+    warn("\n*** WARN: switch %s died ☠️ (%s)\n" % (sw.name, reason))
+    sw.printBmv2Log()
+    print("-" * 80 + "\n")
+    return False
+
+
+def restartPolicy(maxRestarts=3):
+    """
+    Returns a restart policy that brings a dead switch back, up to
+    maxRestarts times. Use with Supervisor.get().policy = restartPolicy().
+    """
+    def policy(sw, reason, restarts):
+        reportDeath(sw, reason, restarts)
+        if restarts >= maxRestarts:
+            return False
+        info("*** Restarting %s (%d/%d)\n" % (sw.name, restarts + 1,
+                                              maxRestarts))
+        sw.restartBmv2()
+        return True
+    return policy
+
+
+class Liveness(object):
+    __slots__ = ('pid', 'pidfd', 'state', 'since', 'nextProbe', 'failures',
+                 'probeMs')
+
+    def __init__(self, pid, pidfd):
+        self.pid = pid
+        self.pidfd = pidfd
+        self.state = 'up'
+        self.since = time.time()
+        # Spread the probes of all switches over the probe interval
+        self.nextProbe = self.since + random.uniform(0, SUPERVISOR_PROBE_INTERVAL)
+        self.failures = 0
+        self.probeMs = None
+
+
+class Supervisor(object):
+    """
+    Watches every running switch from a single thread, instead of one
+    watchdog thread per switch opening a connection every second.
+
+    Process exits arrive on pidfds, keepalive files are checked every
+    SUPERVISOR_TICK and each switch gets one gRPC probe per
+    SUPERVISOR_PROBE_INTERVAL. policy(sw, reason, restarts) decides what
+    happens to a switch that died or hung, and returns True if it restarted
+    it. The thread exits when no switch is left running.
+    """
+    instance = None
+
+    @classmethod
+    def get(cls):
+        if cls.instance is None:
+            cls.instance = cls()
+        return cls.instance
+
+    def __init__(self, policy=reportDeath):
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.sel = selectors.DefaultSelector()
+        # Wakes the thread up when switches are added
+        self.wakeRead, self.wakeWrite = os.pipe()
+        self.sel.register(self.wakeRead, selectors.EVENT_READ, None)
+        self.incoming = []
+        self.watched = {}  # switch -> Liveness, dead and stopped ones included
+        self.restarts = {}  # switch name -> restarts so far
+        self.thread = None
+
+    def watch(self, sw):
+        """
+        Starts supervising a switch whose gRPC port is open.
+        """
+        with self.lock:
+            self.incoming.append(sw)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run,
+                                               name='bmv2-supervisor')
+                self.thread.start()
+        os.write(self.wakeWrite, b'x')
+
+    def adopt(self, sw):
+        old = self.watched.get(sw)
+        if old is not None:
+            self.release(old, old.state)
+        if sw.stopped or sw.bmv2popen is None:
+            return
+        pid = sw.bmv2popen.pid
+        live = Liveness(pid, openPidfd(pid))
+        if live.pidfd is not None:
+            self.sel.register(live.pidfd, selectors.EVENT_READ, sw)
+        self.watched[sw] = live
+
+    def release(self, live, state):
+        live.state = state
+        live.since = time.time()
+        if live.pidfd is not None:
+            self.sel.unregister(live.pidfd)
+            os.close(live.pidfd)
+            live.pidfd = None
+
+    def running(self):
+        return [(sw, l) for sw, l in self.watched.items() if l.state == 'up']
+
+    def run(self):
+        nextTick = 0
         while True:
-            if ONOSBmv2Switch.mininet_exception == 1 \
-                    or not os.path.isfile(sw.keepaliveFile):
-                sw.killBmv2(log=False)
-                return
-            if sw.stopped:
-                return
-            with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
-                port = sw.grpcPortInternal if sw.grpcPortInternal else sw.grpcPort
-                if s.connect_ex(('localhost', port)) == 0:
-                    time.sleep(1)
-                else:
-                    warn("\n*** WARN: switch %s died ☠️ \n" % sw.name)
-                    sw.printBmv2Log()
-                    print("-" * 80 + "\n")
+            with self.lock:
+                for sw in self.incoming:
+                    self.adopt(sw)
+                self.incoming = []
+                if not self.running():
+                    self.thread = None
                     return
-    except Exception as e:
-        warn("*** ERROR: " + str(e))
-        sw.killBmv2(log=True)
+            now = time.time()
+            if now >= nextTick:
+                nextTick = now + SUPERVISOR_TICK
+                self.checkAll()
+            for sw, live in self.running():
+                if now >= live.nextProbe:
+                    self.probe(sw, live)
+            wakeup = min([nextTick] + [l.nextProbe for _, l in self.running()])
+            for key, _ in self.sel.select(max(0, wakeup - time.time())):
+                if key.data is None:
+                    os.read(self.wakeRead, 4096)
+                elif self.watched[key.data].state == 'up':
+                    self.exited(key.data)
+
+    def checkAll(self):
+        failed = ONOSBmv2Switch.mininet_exception == 1
+        for sw, live in self.running():
+            if sw.stopped:
+                self.release(live, 'stopped')
+            elif failed or not os.path.isfile(sw.keepaliveFile):
+                # Mininet failed or removed the *.out files, stop the switch
+                sw.killBmv2(log=False)
+                self.release(live, 'stopped')
+            elif live.pidfd is None and sw.bmv2popen.poll() is not None:
+                self.exited(sw)
+
+    def exited(self, sw):
+        live = self.watched[sw]
+        popen = sw.bmv2popen
+        if sw.stopped or popen is None:
+            self.release(live, 'stopped')
+            return
+        self.release(live, 'dead')
+        self.died(sw, "exited with status %s" % popen.poll())
+
+    def probe(self, sw, live):
+        start = time.time()
+        ok = sw.grpcReady()
+        live.probeMs = (time.time() - start) * 1000
+        live.nextProbe += SUPERVISOR_PROBE_INTERVAL
+        live.failures = 0 if ok else live.failures + 1
+        if live.failures >= SUPERVISOR_PROBE_FAILURES:
+            self.release(live, 'hung')
+            self.died(sw, "no answer on gRPC port %d" % sw.grpcPort)
+
+    def died(self, sw, reason):
+        restarts = self.restarts.get(sw.name, 0)
+        try:
+            if self.policy(sw, reason, restarts):
+                self.restarts[sw.name] = restarts + 1
+        except Exception as e:
+            warn("*** ERROR: restart policy for %s: %s\n" % (sw.name, e))
+
+    def table(self):
+        """
+        Returns one (name, pid, state, seconds in state, last probe ms,
+        failed probes, restarts) row per switch.
+        """
+        now = time.time()
+        with self.lock:
+            rows = [(sw.name, l.pid, l.state, now - l.since, l.probeMs,
+                     l.failures, self.restarts.get(sw.name, 0))
+                    for sw, l in self.watched.items()]
+        return sorted(rows)
+
+
+def printLivenessTable():
+    print("%-8s %8s %-8s %10s %9s %6s %8s" % (
+        "switch", "pid", "state", "for (s)", "probe ms", "fails", "restarts"))
+    for name, pid, state, age, probeMs, failures, restarts \
+            in Supervisor.get().table():
+        print("%-8s %8d %-8s %10.0f %9s %6d %8d" % (
+            name, pid, state, age,
+            "-" if probeMs is None else "%.1f" % probeMs, failures, restarts))
 
 
 class ONOSHost(Host):
     def __init__(self, name, inNamespace=True, **params):
+        # Set before Host.__init__, which already runs commands
+        self.configPending = False
+        self.configStart = None
+        self.configDone = None
         Host.__init__(self, name, inNamespace=inNamespace, **params)
 
     def config(self, **params):
         r = super(Host, self).config(**params)
-        for off in ["rx", "tx", "sg"]:
-            cmd = "/sbin/ethtool --offload %s %s off" \
-                  % (self.defaultIntf(), off)
-            self.cmd(cmd)
-        # disable IPv6
-        self.cmd("sysctl -w net.ipv6.conf.all.disable_ipv6=1")
-        self.cmd("sysctl -w net.ipv6.conf.default.disable_ipv6=1")
-        self.cmd("sysctl -w net.ipv6.conf.lo.disable_ipv6=1")
+        # Disable offloading and IPv6 with a single command, and do not wait
+        # for it: Mininet configures the next host meanwhile, and the output
+        # is collected before this host runs anything else. The shell prints
+        # when it is done so configTime() is right however late that is.
+        self.configStart = time.time()
+        self.sendCmd(self.configScript() + "; echo $EPOCHREALTIME")
+        self.configPending = True
         return r
 
+    def configScript(self):
+        # The sysctls are written to /proc directly instead of running sysctl
+        script = ["echo 1 > /proc/sys/net/ipv6/conf/%s/disable_ipv6" % conf
+                  for conf in IPV6_DISABLE_CONFS]
+        if self.defaultIntf():
+            script.insert(0, "/sbin/ethtool --offload %s %s" % (
+                self.defaultIntf(),
+                " ".join("%s off" % off for off in OFFLOAD_FEATURES)))
+        return "; ".join(script)
+
+    def finishConfig(self):
+        if self.configPending:
+            self.configPending = False
+            lines = Host.waitOutput(self).strip().splitlines() or ['']
+            try:
+                self.configDone = float(lines.pop().replace(',', '.'))
+            except ValueError:
+                self.configDone = time.time()
+            if lines:
+                debug("%s config: %s\n" % (self.name, "\n".join(lines)))
+
+    def configTime(self):
+        if self.configDone is None:
+            return None
+        return self.configDone - self.configStart
+
+    def sendCmd(self, *args, **kwargs):
+        self.finishConfig()
+        return Host.sendCmd(self, *args, **kwargs)
+
 
 class ONOSBmv2Switch(Switch):
     """BMv2 software switch with gRPC server"""
@@ -117,12 +681,16 @@ class ONOSBmv2Switch(Switch):
     mininet_exception = multiprocessing.Value('i', 0)
 
     nextGrpcPort = 50001
+    # Switches placed so far with the placement option
+    placedSwitches = 0
 
     def __init__(self, name, json=None, debugger=False, loglevel="warn",
                  elogger=False, cpuport=255, notifications=False,
                  thrift=False, dryrun=False,
                  pipeconf=DEFAULT_PIPECONF, pktdump=False, valgrind=False,
                  gnmi=False, portcfg=True, onosdevid=None, stratum=False,
+                 parallelstart=True, cpus=None, placement=None, corespersw=1,
+                 swpercore=1, reservecores=0, cpulimit=None, memlimit=None,
                  **kwargs):
         Switch.__init__(self, name, **kwargs)
         self.grpcPort = ONOSBmv2Switch.nextGrpcPort
@@ -165,6 +733,25 @@ class ONOSBmv2Switch(Switch):
         # this as a signal to terminate the switch instance (if active).
         self.keepaliveFile = '/tmp/bmv2-%s-watchdog.out' % self.name
         self.targetName = STRATUM_BMV2 if self.useStratum else SIMPLE_SWITCH_GRPC
+        # With parallelstart, start() only launches the process. Mininet calls
+        # batchStartup() once all switches are launched, which waits for all of
+        # them at the same time.
+        self.parallelStart = parseBoolean(parallelstart)
+        self.starting = False
+        self.startTime = None
+        self.startupTime = None
+        # Cores bmv2 is pinned to, either given as cpus ("0-3") or the next
+        # ones of the placement strategy (spread or pack). cpulimit (cores)
+        # and memlimit ("512M") put the switch in its own cgroup.
+        if cpus is None and placement:
+            index = ONOSBmv2Switch.placedSwitches
+            ONOSBmv2Switch.placedSwitches += 1
+            cpus = planCores(index + 1, placement, int(corespersw),
+                             int(swpercore), int(reservecores))[index]
+        self.cpus = parseCpuList(cpus) if cpus is not None else None
+        self.cpulimit = cpulimit
+        self.memlimit = memlimit
+        self.cgroup = None
 
         # Remove files from previous executions
         self.cleanupTmpFiles()
@@ -277,6 +864,9 @@ nodes {{
             if self.thriftPort:
                 writeToFile("/tmp/bmv2-%s-thrift-port" % self.name, self.thriftPort)
             cmdString = self.getBmv2CmdString()
+        if self.cpus:
+            cmdString = "taskset -c %s %s" % (",".join(map(str, self.cpus)),
+                                              cmdString)
 
         if self.dryrun:
             info("\n*** DRY RUN (not executing %s)\n" % self.targetName)
@@ -290,20 +880,80 @@ nodes {{
                 self.logfd = open(self.logfile, "w")
                 self.logfd.write(cmdString + "\n\n" + "-" * 80 + "\n\n")
                 self.logfd.flush()
+                self.startTime = time.time()
+                self.startupTime = None
                 self.bmv2popen = self.popen(cmdString,
                                             stdout=self.logfd,
                                             stderr=self.logfd)
-                self.waitBmv2Start()
-                # We want to be notified if BMv2/Stratum dies...
-                threading.Thread(target=watchDog, args=[self]).start()
+                if self.cpulimit or self.memlimit:
+                    self.cgroup = cgroupLimit(self.name, self.bmv2popen.pid,
+                                              self.cpulimit, self.memlimit)
+                self.starting = True
+                # With parallelstart, batchStartup() takes it from here
+                if not self.parallelStart:
+                    self.waitBmv2Start()
+                return
 
-            self.doOnosNetcfg()
+            self.bmv2Started()
         except Exception:
             ONOSBmv2Switch.mininet_exception = 1
             self.killBmv2()
             self.printBmv2Log()
             raise
 
+    def bmv2Started(self):
+        """
+        Completes start() once the gRPC port is open.
+        """
+        if not self.dryrun:
+            self.starting = False
+            self.startupTime = time.time() - self.startTime
+            print("⚡️ %s @ %d (%.2fs)" % (self.targetName, self.grpcPort,
+                                          self.startupTime))
+            # We want to be notified if BMv2/Stratum dies...
+            writeToFile(self.keepaliveFile,
+                        "Remove this file to terminate %s" % self.name)
+            Supervisor.get().watch(self)
+        self.doOnosNetcfg()
+
+    @classmethod
+    def batchStartup(cls, switches):
+        """
+        Waits for all switches launched by start() concurrently. Most of a
+        switch start is spent waiting for its gRPC server, so the network is
+        up after the slowest switch instead of after the sum of all of them.
+        """
+        pending = [s for s in switches if s.starting]
+        failed = StartupWaiter(pending).run() if pending else []
+        timed = [s for s in switches if s.startupTime is not None]
+        if pending:
+            recordStartupLatency(
+                [s.startupTime for s in pending if s in timed], len(failed))
+        if failed:
+            ONOSBmv2Switch.mininet_exception = 1
+            # Do not leave the other switches of the batch running
+            for sw in switches:
+                sw.killBmv2()
+            for sw, _ in failed:
+                sw.printBmv2Log()
+            raise Exception("Switch did not start: %s" % ", ".join(
+                "%s (%s)" % (s.name, reason) for s, reason in failed))
+        if timed:
+            slowest = max(timed, key=lambda s: s.startupTime)
+            info("*** %d switches ready in %.2fs (slowest %s %.2fs)\n" % (
+                len(timed), time.time() - min(s.startTime for s in timed),
+                slowest.name, slowest.startupTime))
+        return switches
+
+    def restartBmv2(self):
+        """
+        Brings a dead switch back with the same ports and gRPC port.
+        """
+        self.killBmv2(log=True)
+        self.start(None)
+        if self.starting:
+            self.waitBmv2Start()
+
     def getBmv2CmdString(self):
         bmv2Args = [SIMPLE_SWITCH_GRPC] + self.bmv2Args()
         if self.valgrind:
@@ -356,39 +1006,45 @@ nodes {{
         args.append('--grpc-server-addr 0.0.0.0:%s' % self.grpcPort)
         return args
 
+    def grpcReady(self):
+        with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
+            port = self.grpcPortInternal if self.grpcPortInternal else self.grpcPort
+            return s.connect_ex(('localhost', port)) == 0
+
     def waitBmv2Start(self):
         # Wait for switch to open gRPC port, before sending ONOS the netcfg.
-        # Include time-out just in case something hangs.
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        endtime = time.time() + SWITCH_START_TIMEOUT
-        while True:
-            port = self.grpcPortInternal if self.grpcPortInternal else self.grpcPort
-            result = sock.connect_ex(('localhost', port))
-            if result == 0:
-                # No new line
-                print("⚡️ %s @ %d" % (self.targetName, self.grpcPort))
-                # The port is open. Let's go! (Close socket first)
-                sock.close()
-                break
-            # Port is not open yet. If there is time, we wait a bit.
-            if endtime > time.time():
-                sys.stdout.write('.')
-                sys.stdout.flush()
-                time.sleep(0.05)
-            else:
-                # Time's up.
-                raise Exception("Switch did not start before timeout")
+        # Fails as soon as the process exits, or after SWITCH_START_TIMEOUT
+        # just in case something hangs.
+        failed = StartupWaiter([self]).run()
+        recordStartupLatency([self.startupTime] if not failed else [],
+                             len(failed))
+        if failed:
+            raise Exception("Switch did not start: %s" % failed[0][1])
 
     def printBmv2Log(self):
         if os.path.isfile(self.logfile):
             print("-" * 80)
             print("%s log (from %s):" % (self.name, self.logfile))
-            with open(self.logfile, 'r') as f:
-                lines = f.readlines()
-                if len(lines) > BMV2_LOG_LINES:
-                    print("...")
-                for line in lines[-BMV2_LOG_LINES:]:
-                    print(line.rstrip())
+            lines = self.logTail(BMV2_LOG_LINES + 1)
+            if len(lines) > BMV2_LOG_LINES:
+                print("...")
+            for line in lines[-BMV2_LOG_LINES:]:
+                print(line.rstrip())
+
+    def logTail(self, n, blockSize=65536):
+        """
+        Returns the last n lines of the log, reading blocks backwards from
+        the end instead of the whole file.
+        """
+        with open(self.logfile, 'rb') as f:
+            pos = f.seek(0, os.SEEK_END)
+            data = b''
+            while pos > 0 and data.count(b'\n') <= n:
+                step = min(blockSize, pos)
+                pos -= step
+                f.seek(pos)
+                data = f.read(step) + data
+        return data.decode('utf-8', 'replace').splitlines()[-n:]
 
     def killBmv2(self, log=False):
         self.stopped = True
@@ -396,14 +1052,64 @@ nodes {{
             self.bmv2popen.terminate()
             self.bmv2popen.wait()
             self.bmv2popen = None
+        self.closeLog(log)
+        self.removeCgroup()
+
+    def removeCgroup(self):
+        if self.cgroup is not None:
+            try:
+                os.rmdir(self.cgroup)
+            except OSError as e:
+                warn("*** Could not remove %s: %s\n" % (self.cgroup, e))
+            self.cgroup = None
+
+    def closeLog(self, log=False):
         if self.logfd is not None:
             if log:
                 self.logfd.write("*** PROCESS TERMINATED BY MININET ***\n")
             self.logfd.close()
             self.logfd = None
 
-    def cleanupTmpFiles(self):
-        self.cmd("rm -rf /tmp/bmv2-%s-*" % self.name)
+    @classmethod
+    def batchShutdown(cls, switches, grace=SHUTDOWN_GRACE):
+        """
+        Stops all switches together. Every bmv2 gets SIGTERM at once, they are
+        reaped concurrently and whatever is left after grace seconds is
+        SIGKILLed, so shutdown takes at most grace seconds instead of the sum
+        of all switches. Mininet skips stop() for the switches returned here.
+        Mininet.stop() has deleted the links, and with them the interfaces,
+        before this is called; stopNetwork() deletes them in one batch.
+        """
+        start = time.time()
+        running = []
+        for sw in switches:
+            sw.stopped = True
+            if sw.bmv2popen is not None:
+                sw.bmv2popen.terminate()
+                running.append(sw)
+        killed = reapProcesses([s.bmv2popen for s in running], grace)
+        for sw in switches:
+            sw.bmv2popen = None
+            sw.closeLog(log=True)
+            sw.removeCgroup()
+            # Keep the log for post-mortems, start() removes it anyway
+            sw.cleanupTmpFiles(keepLog=True)
+        info("*** %d switches stopped in %.2fs (%d killed after %ds)\n" % (
+            len(running), time.time() - start, killed, grace))
+        return switches
+
+    def cleanupTmpFiles(self, keepLog=False):
+        # Removed in-process, a shell "rm -rf" per switch adds up quickly
+        for path in glob.glob("/tmp/bmv2-%s-*" % self.name):
+            if keepLog and path == self.logfile:
+                continue
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
 
     def stop(self, deleteIntfs=True):
         """Terminate switch."""
@@ -423,3 +1129,4 @@ switches = {
     'stratum_bmv2': ONOSStratumSwitch,
 }
 hosts = {'onoshost': ONOSHost}
+tests = {'batchcli': cliThenDeleteLinks}
@@ -0,0 +1,480 @@
+# coding=utf-8
+"""
+Content-addressed cache for p4c. Takes the same arguments as the compiler,
+and when the P4 source, every file it includes and the flags are the same
+as in an earlier compile, it copies the cached bmv2 JSON and p4info files
+to the requested outputs instead of compiling.
+
+Compiles are looked up in a shared store first, then in the writable store
+of the user, and misses are only ever written to the store of the user.
+Users can be root in their containers, so the shared store itself is not
+trusted: an admin seals it (--cache-seal DIR writes a catalog of the sha256
+of every file and prints the digest of the catalog) and gives the digest to
+the user containers from outside (P4C_CACHE_SHARED_DIGEST, set by the hub).
+The store is only used if its catalog has that digest, and an object only
+if every file of it is in the catalog with the same sha256; the files are
+checked as read into memory, before they are written to the outputs. An
+altered store is a miss, never someone else's program.
+
+A compile is looked up in two steps:
+
+  * manifest: keyed by the compiler, the flags, the working directory and
+    the source path. It lists every file the last compile read, with its
+    sha256, and the object it produced. If all files still hash the same,
+    the object is used without starting any process.
+  * object: keyed by the compiler, the flags and the preprocessed source
+    (p4c -E), so it covers every include and -D, and is found again from
+    another path of the same program or after an edit is undone.
+
+Objects are immutable. A miss compiles into a temporary directory in the
+writable store and renames it into place, under a per-key flock, so concurrent
+compiles of the same program run the compiler once and the others wait for
+its result, and a reader never sees a partial object. Failed compiles are
+not cached.
+
+    python3 p4c_cache.py --target bmv2 --arch v1model \\
+        --p4runtime-files build/basic.p4info.txtpb -o build basic.p4
+    make P4C="python3 p4c_cache.py --cache-compiler p4c-bm2-ss"
+
+Options starting with --cache- are for the cache and must come first:
+--cache-dir (writable store, default $P4C_CACHE_DIR or ~/.cache/p4c),
+--cache-shared (sealed store, default $P4C_CACHE_SHARED, none if unset),
+--cache-compiler (default $P4C_CACHE_COMPILER or p4c), --cache-verbose,
+which prints hit or miss to stderr, and --cache-seal DIR (admin).
+"""
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+COMPILER = os.environ.get('P4C_CACHE_COMPILER', 'p4c')
+STORE = os.environ.get('P4C_CACHE_DIR', os.path.expanduser('~/.cache/p4c'))
+SHARED = os.environ.get('P4C_CACHE_SHARED') or None
+SHARED_DIGEST = os.environ.get('P4C_CACHE_SHARED_DIGEST') or None
+CATALOG = 'catalog.json'
+VERSION = 1  # of the store layout, part of every key
+
+# Options whose value is an output path: replaced in the key and the command
+OUTPUT_OPTIONS = ('-o', '--p4runtime-files', '--p4runtime-file')
+# Options whose value is a single token, for telling values from the source
+VALUE_OPTIONS = OUTPUT_OPTIONS + ('-I', '-D', '-U', '--target', '--arch',
+                                  '--std', '--p4v', '--p4runtime-format', '-T')
+# Outputs the cache does not know about; compiles using them are not cached
+UNCACHED_OPTIONS = ('-E', '--help', '--version', '--toJSON', '--pp', '--dump',
+                    '--save-temps', '--p4runtime-entries-files',
+                    '--p4runtime-entries-file', '--bf-rt-schema', '--context')
+# cpp line markers: # 12 "path" flags
+LINE_MARKER = re.compile(rb'^#\s*(?:line\s+)?\d+\s+"([^"]+)"', re.M)
+
+
+class CompileResult(object):
+    """How a compile was served: status is hit, miss, failed or uncached"""
+    def __init__(self, status, returncode=0, key=None, log=b''):
+        self.status = status
+        self.returncode = returncode
+        self.key = key
+        self.log = log
+        self.elapsed = 0.0
+
+
+class Command(object):
+    """The compiler arguments, split into the parts the cache handles"""
+    def __init__(self, args):
+        self.args = list(args)
+        self.source = None
+        self.outputs = []     # (index in args, option, path, prefix of args[index])
+        self.uncached = None  # reason not to cache, if any
+        i = 0
+        while i < len(self.args):
+            arg = self.args[i]
+            name, eq, value = arg.partition('=')
+            if name in UNCACHED_OPTIONS:
+                self.uncached = arg
+            if arg in VALUE_OPTIONS and i + 1 < len(self.args):
+                if arg in OUTPUT_OPTIONS:
+                    self.outputs.append((i + 1, arg, self.args[i + 1], ''))
+                i += 2
+                continue
+            if eq and name in OUTPUT_OPTIONS:
+                self.outputs.append((i, name, value, name + '='))
+            elif arg.startswith('-o') and not arg.startswith('--'):
+                self.outputs.append((i, '-o', arg[2:], '-o'))
+            elif not arg.startswith('-'):
+                self.source = arg
+            i += 1
+        if self.source is None:
+            self.uncached = self.uncached or 'no source file'
+        elif not any(option == '-o' for _, option, _, _ in self.outputs):
+            self.uncached = self.uncached or 'no -o'
+
+    def outputPaths(self):
+        """[(option, path)], --p4runtime-files split at the commas"""
+        paths = []
+        for _, option, value, _ in self.outputs:
+            if option == '--p4runtime-files':
+                paths.extend((option, p) for p in value.split(',') if p)
+            else:
+                paths.append((option, value))
+        return paths
+
+    def flags(self):
+        """The arguments with the outputs and the source masked, for keys"""
+        masked = [os.path.basename(a) if a == self.source else a for a in self.args]
+        for n, (i, option, value, prefix) in enumerate(self.outputs):
+            suffixes = [os.path.splitext(p)[1] for p in value.split(',')]
+            masked[i] = prefix + '<output %d %s>' % (n, ','.join(suffixes))
+        return masked
+
+    def redirected(self, directory):
+        """The arguments with every output inside directory, under the names
+        objects keep them: out and p4runtime-<n><ext>"""
+        args = list(self.args)
+        n = 0
+        for i, option, value, prefix in self.outputs:
+            if option == '-o':
+                args[i] = prefix + os.path.join(directory, 'out')
+                continue
+            names = []
+            for path in value.split(','):
+                if path:
+                    names.append(os.path.join(directory, 'p4runtime-%d%s' % (
+                        n, os.path.splitext(path)[1])))
+                    n += 1
+            args[i] = prefix + ','.join(names)
+        return args
+
+    def preprocessArgs(self):
+        """The arguments for p4c -E: no outputs, the same includes and defines"""
+        drop = set()
+        for i, _, _, prefix in self.outputs:
+            drop.add(i)
+            if not prefix:
+                drop.add(i - 1)
+        return [a for i, a in enumerate(self.args) if i not in drop] + ['-E']
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def fileHash(path):
+    try:
+        with open(path, 'rb') as f:
+            return sha256(f.read())
+    except (OSError, IOError):
+        return None
+
+
+def makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def writeAtomic(path, data):
+    """Write a file next to path and rename it over path"""
+    makedirs(os.path.dirname(path) or '.')
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.p4c-cache-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp, 0o666 & ~currentUmask())
+        os.rename(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def currentUmask():
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+class Cache(object):
+    """A writable store, and optionally a shared one with the same layout
+    that is only read, and only as far as its catalog vouches for it:
+
+        compilers/<hash>   p4c --version of a compiler binary
+        manifests/<hash>   dependencies and object of a source path
+        objects/<hash>/    out, p4runtime-<n><ext> and log of a compile
+        locks/<hash>       flock while an object is compiled
+        tmp/               compiles in progress
+        catalog.json       shared store only: sha256 of every manifest and
+                           object file, written by --cache-seal
+    """
+    def __init__(self, store=STORE, compiler=COMPILER, shared=SHARED,
+                 sharedDigest=SHARED_DIGEST):
+        self.store = store
+        self.compiler = compiler
+        for sub in ('compilers', 'manifests', 'objects', 'locks', 'tmp'):
+            makedirs(os.path.join(store, sub))
+        # store -> catalog ({relative path: sha256}), None for the own store
+        self.catalogs = {}
+        if shared and os.path.abspath(shared) != os.path.abspath(store):
+            catalog = loadCatalog(shared, sharedDigest)
+            if catalog is not None:
+                self.catalogs[shared] = catalog
+        # Searched in this order, only self.store is ever written
+        self.stores = list(self.catalogs) + [store]
+
+    def _path(self, kind, key):
+        return os.path.join(self.store, kind, key)
+
+    def _read(self, store, relpath):
+        """Contents of a file of a store, None if missing or, in the shared
+        store, not what its catalog says"""
+        try:
+            with open(os.path.join(store, relpath), 'rb') as f:
+                data = f.read()
+        except (OSError, IOError):
+            return None
+        catalog = self.catalogs.get(store)
+        if catalog is not None and catalog.get(relpath) != sha256(data):
+            return None
+        return data
+
+    def _readObject(self, key):
+        """{path in the object: contents} of the object key from the first
+        store that has it complete and intact, None if none has"""
+        prefix = os.path.join('objects', key)
+        for store in self.stores:
+            objdir = os.path.join(store, prefix)
+            if not os.path.isdir(objdir):
+                continue
+            files = {}
+            for root, _, names in os.walk(objdir):
+                for name in names:
+                    relpath = os.path.relpath(os.path.join(root, name), store)
+                    files[os.path.relpath(relpath, prefix)] = self._read(store, relpath)
+            catalog = self.catalogs.get(store)
+            if catalog is not None:
+                listed = set(os.path.relpath(path, prefix) for path in catalog
+                             if path.startswith(prefix + os.sep))
+                if listed != set(files):
+                    continue
+            if files and None not in files.values():
+                return files
+        return None
+
+    def compilerId(self):
+        """The --version output of the compiler, run once per binary"""
+        path = shutil.which(self.compiler)
+        if path is None:
+            raise OSError(errno.ENOENT, 'compiler not found', self.compiler)
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        key = sha256(('%s %d %d %d' % (path, st.st_ino, st.st_size, st.st_mtime_ns)).encode())
+        cached = self._path('compilers', key)
+        try:
+            with open(cached, 'rb') as f:
+                return f.read()
+        except (OSError, IOError):
+            pass
+        version = subprocess.run([path, '--version'], stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT).stdout
+        identity = ('%s\n' % os.path.basename(path)).encode() + version
+        writeAtomic(cached, identity)
+        return identity
+
+    def _key(self, *parts):
+        h = hashlib.sha256(('p4c-cache %d\n' % VERSION).encode())
+        for part in parts:
+            part = part if isinstance(part, bytes) else json.dumps(part).encode()
+            h.update(b'%d\n' % len(part))
+            h.update(part)
+        return h.hexdigest()
+
+    def _manifest(self, key):
+        """The object of the first manifest whose files all hash the same"""
+        for store in self.stores:
+            data = self._read(store, os.path.join('manifests', key))
+            try:
+                manifest = json.loads(data.decode()) if data is not None else None
+            except ValueError:
+                manifest = None
+            if manifest is None:
+                continue
+            if all(fileHash(path) == digest for path, digest in manifest['deps'].items()):
+                return manifest['object']
+        return None
+
+    def _preprocess(self, command, compilerId):
+        """(object key, {path: sha256} of the files read) from p4c -E"""
+        proc = subprocess.run([self.compiler] + command.preprocessArgs(),
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if proc.returncode != 0:
+            return None, None
+        deps = {}
+        for match in LINE_MARKER.finditer(proc.stdout):
+            path = os.path.abspath(match.group(1).decode('utf-8', 'replace'))
+            if path not in deps and os.path.isfile(path):
+                deps[path] = fileHash(path)
+        key = self._key(compilerId, command.flags(), proc.stdout)
+        return key, deps
+
+    def _build(self, command, key):
+        """Compile into the own store under the lock of key; (True, process
+        or None if another compile finished it) or (False, failed process)"""
+        objdir = self._path('objects', key)
+        with open(self._path('locks', key), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.isdir(objdir):
+                return True, None  # compiled by someone we waited for
+            tmp = tempfile.mkdtemp(dir=self._path('tmp', ''), prefix=key[:16] + '.')
+            try:
+                proc = subprocess.run([self.compiler] + command.redirected(tmp),
+                                      stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                if proc.returncode != 0:
+                    return False, proc
+                with open(os.path.join(tmp, 'log'), 'wb') as f:
+                    f.write(proc.stdout)
+                os.chmod(tmp, 0o777 & ~currentUmask())
+                os.rename(tmp, objdir)
+                tmp = None
+                return True, proc
+            finally:
+                if tmp is not None:
+                    shutil.rmtree(tmp, ignore_errors=True)
+
+    def _install(self, command, files):
+        """Write the outputs of an object, as read by _readObject, to the
+        paths of the command"""
+        n = 0
+        for option, path in command.outputPaths():
+            if option == '-o':
+                if 'out' in files:
+                    writeAtomic(path, files['out'])
+                for name, data in files.items():
+                    if name.startswith('out' + os.sep):
+                        writeAtomic(os.path.join(path, os.path.relpath(name, 'out')), data)
+            else:
+                writeAtomic(path, files['p4runtime-%d%s' % (n, os.path.splitext(path)[1])])
+                n += 1
+        return files['log']
+
+    def compile(self, args):
+        """Serve one compile with the arguments of the compiler"""
+        start = time.time()
+        command = Command(args)
+        if command.uncached:
+            proc = subprocess.run([self.compiler] + command.args)
+            result = CompileResult('uncached', proc.returncode)
+            result.elapsed = time.time() - start
+            return result
+        compilerId = self.compilerId()
+        manifestKey = self._key(compilerId, command.flags(), os.getcwd(),
+                                os.path.abspath(command.source))
+        key = self._manifest(manifestKey)
+        files = self._readObject(key) if key is not None else None
+        status = 'hit'
+        if files is None:
+            key, deps = self._preprocess(command, compilerId)
+            if key is None:
+                # Let the compiler report the error in the source
+                proc = subprocess.run([self.compiler] + command.args,
+                                      stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                result = CompileResult('failed', proc.returncode, log=proc.stdout)
+                result.elapsed = time.time() - start
+                return result
+            files = self._readObject(key)
+            if files is None:
+                ok, proc = self._build(command, key)
+                if not ok:
+                    result = CompileResult('failed', proc.returncode, key, proc.stdout)
+                    result.elapsed = time.time() - start
+                    return result
+                if proc is not None:
+                    status = 'miss'
+                files = self._readObject(key)
+            writeAtomic(self._path('manifests', manifestKey),
+                        json.dumps({'deps': deps, 'object': key}).encode())
+        result = CompileResult(status, 0, key, self._install(command, files))
+        result.elapsed = time.time() - start
+        return result
+
+
+def loadCatalog(store, digest):
+    """The catalog of a shared store if its sha256 is digest, else None:
+    the digest comes from outside the store (the hub config), so a user
+    who can write to the store cannot make it vouch for other files"""
+    try:
+        with open(os.path.join(store, CATALOG), 'rb') as f:
+            data = f.read()
+    except (OSError, IOError):
+        return None
+    if not digest or sha256(data) != digest:
+        sys.stderr.write('p4c_cache: %s not used, its catalog does not match '
+                         '$P4C_CACHE_SHARED_DIGEST\n' % store)
+        return None
+    return json.loads(data.decode())
+
+
+def seal(store):
+    """Write the catalog of every manifest and object file of store, for
+    sharing it read-only; returns the digest the users need"""
+    catalog = {}
+    for kind in ('manifests', 'objects'):
+        for root, _, names in os.walk(os.path.join(store, kind)):
+            for name in names:
+                path = os.path.join(root, name)
+                catalog[os.path.relpath(path, store)] = fileHash(path)
+    data = json.dumps(catalog, sort_keys=True, indent=0).encode()
+    writeAtomic(os.path.join(store, CATALOG), data)
+    return sha256(data)
+
+
+def compileP4(args, store=STORE, compiler=COMPILER, shared=SHARED,
+              sharedDigest=SHARED_DIGEST):
+    """Compile with the arguments of p4c through the cache, e.g. from a
+    notebook: compileP4(['--target', 'bmv2', '--arch', 'v1model', '-o',
+    'build', 'basic.p4']). Returns a CompileResult."""
+    return Cache(store, compiler, shared, sharedDigest).compile(args)
+
+
+def main(argv):
+    store, compiler, shared, verbose = STORE, COMPILER, SHARED, False
+    while argv and argv[0].startswith('--cache-'):
+        option = argv.pop(0)
+        name, eq, value = option.partition('=')
+        if name == '--cache-verbose':
+            verbose = True
+            continue
+        if not eq:
+            if not argv:
+                sys.exit('p4c_cache: %s needs a value' % option)
+            value = argv.pop(0)
+        if name == '--cache-dir':
+            store = value
+        elif name == '--cache-shared':
+            shared = value
+        elif name == '--cache-compiler':
+            compiler = value
+        elif name == '--cache-seal':
+            print(seal(value))
+            return 0
+        else:
+            sys.exit('p4c_cache: unknown option %s' % option)
+    if argv and argv[0] == '--':
+        argv.pop(0)
+    result = compileP4(argv, store, compiler, shared)
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    out.write(result.log)
+    out.flush()
+    if verbose:
+        sys.stderr.write('p4c_cache: %s %s (%.0f ms)\n' % (
+            result.status, (result.key or '-')[:12], 1000 * result.elapsed))
+    return result.returncode
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))